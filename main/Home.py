@@ -22,6 +22,8 @@ from kortex_api.autogen.client_stubs.BaseCyclicClientRpc import BaseCyclicClient
 
 from kortex_api.autogen.messages import Session_pb2, Base_pb2, BaseCyclic_pb2
 
+from actions import ActionNotifier
+
 
 # Maximum allowed waiting time during actions (in seconds)
 TIMEOUT_DURATION = 20
@@ -51,22 +53,6 @@ def check_for_sequence_end_or_abort(e):
             e.set()
     return check
 
-# Create closure to set an event after an END or an ABORT
-def check_for_end_or_abort(e):
-    """Return a closure checking for END or ABORT notifications
-
-    Arguments:
-    e -- event to signal when the action is completed
-        (will be set when an END or ABORT occurs)
-    """
-    def check(notification, e = e):
-        print("EVENT : " + \
-              Base_pb2.ActionEvent.Name(notification.action_event))
-        if notification.action_event == Base_pb2.ACTION_END \
-        or notification.action_event == Base_pb2.ACTION_ABORT:
-            e.set()
-    return check
-
 #
 # Example related functions
 #
@@ -136,7 +122,7 @@ def create_cartesian_action(base_cyclic):
 # Example core functions
 #
 
-def example_move_to_home_position(base):
+def example_move_to_home_position(base, notifier):
     # Make sure the arm is in Single Level Servoing mode
     base_servo_mode = Base_pb2.ServoingModeInformation()
     base_servo_mode.servoing_mode = Base_pb2.SINGLE_LEVEL_SERVOING
@@ -167,18 +153,10 @@ def example_move_to_home_position(base):
 
 
 
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    base.ExecuteActionFromReference(action_handle_1)
-
+    future = notifier.execute_action_from_reference(action_handle_1, "Home")
 
     # Leave time to action to complete
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
+    finished = future.wait(TIMEOUT_DURATION)
 
     if not finished:
         print("Timeout on action notification wait")
@@ -239,7 +217,8 @@ def main():
 
         # Example core
         success = True
-        success &= example_move_to_home_position(base)
+        with ActionNotifier(base) as notifier:
+            success &= example_move_to_home_position(base, notifier)
         success &= example_create_sequence(base, base_cyclic)
         
         # You can also refer to the 110-Waypoints examples for an alternate way to execute
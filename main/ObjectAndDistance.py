@@ -1,71 +1,113 @@
-from ultralytics import YOLO
+import argparse
+import time
+
 import cv2
-import math
 
-# Load the YOLO Model
-model = YOLO('yolov8n.pt')
+from calibration import (DEFAULT_FOCAL_LENGTH, INTRINSICS_PATH, default_intrinsics, load_intrinsics, locate,
+                         scale_intrinsics, width_table)
+from camera import CAMERA_URL, CameraService
+from detector import BACKENDS, WEIGHTS, Detector
+from objects import ObjectRegistry
+from pipeline import VisionPipeline, print_pipeline_stats
+from roi import FULL_FRAME_EVERY, RoiInference
 
-# Use IP camera ("rtsp://192.168.1.10/color")
-# o or 1 uses laptop's camera
-cap = cv2.VideoCapture("rtsp://192.168.1.10/color")
+# Seconds between two frame rate / latency reports
+STATS_PERIOD = 5.0
 
-# ---  Distance Estimation Parameters ---
-KNOWN_WIDTH = 15  # Example: 15 cm
-FOCAL_LENGTH = 1000  # Example: 1000 pixels
+def update_registry(model, results, registry, widths, intrinsics):
+    """Feed the tracked boxes of results, with their distance and position, to the ObjectRegistry"""
+    boxes = results[0].boxes
+    if boxes.id is None or not len(boxes):
+        # Nothing the tracker has confirmed yet
+        registry.expire()
+        return
+    # One transfer of the box tensor: x1, y1, x2, y2, id, confidence, class
+    data = boxes.data.cpu().numpy()
+    class_ids = data[:, -1].astype(int)
+    distances, positions = locate(data[:, :4], class_ids, widths, intrinsics)
+    class_names = [model.names[class_id] for class_id in class_ids]
+    registry.update(data[:, 4].astype(int), class_names, data[:, -2], data[:, :4], distances, positions)
 
-def calculate_distance(known_width, focal_length, pixel_width):
-    """
-    Calculates the distance to an object based on its known width,
-    the camera's focal length, and the object's width in pixels.
-    """
-    return (known_width * focal_length) / pixel_width
+def main():
+    parser = argparse.ArgumentParser()
+    # Use IP camera ("rtsp://192.168.1.10/color")
+    # 0 or 1 uses laptop's camera
+    parser.add_argument("--source", default=CAMERA_URL, help="camera URL or device index")
+    parser.add_argument("--model", default=WEIGHTS, help="YOLO weights")
+    parser.add_argument("--backend", default="auto", choices=["auto"] + list(BACKENDS),
+                        help="inference backend, auto picks the fastest one benchmarked by detector.py")
+    parser.add_argument("--intrinsics", default=INTRINSICS_PATH,
+                        help="camera intrinsics saved by calibration.py")
+    parser.add_argument("--roi", action="store_true",
+                        help="run the model around the previous tracks only, with a full pass every few frames")
+    parser.add_argument("--workspace", type=str, default=None, metavar="XMIN,YMIN,XMAX,YMAX",
+                        help="part of the frame (pixels) the objects can be in, with --roi")
+    parser.add_argument("--full-frame-every", type=int, default=FULL_FRAME_EVERY,
+                        help="frames between two full passes, with --roi")
+    parser.add_argument("--frame-budget", type=float, default=None, metavar="MS",
+                        help="lower the inference size while inference takes longer than this, with --roi")
+    parser.add_argument("--headless", action="store_true",
+                        help="don't draw or show the frames (nodes without a display)")
+    args = parser.parse_args()
+    source = int(args.source) if args.source.isdigit() else args.source
 
-# List to store unique detected objects
-detected_objects = []
+    # Load and warm up the YOLO model while the camera connects
+    model = Detector(args.model, args.backend).start()
+    infer = model.track
+    if args.roi:
+        workspace = [int(value) for value in args.workspace.split(",")] if args.workspace else None
+        budget = args.frame_budget / 1000.0 if args.frame_budget else None
+        infer = RoiInference(model, workspace, args.full_frame_every, frame_budget=budget)
 
-while True:
-    ret, frame = cap.read()
+    calibrated = load_intrinsics(args.intrinsics)
+    if calibrated is None:
+        print("Camera not calibrated, using a focal length of {} pixels".format(DEFAULT_FOCAL_LENGTH))
+    intrinsics = None
 
-    if ret:
-        results = model.track(frame, persist=True)
-        detections = results[0].boxes.data.tolist()
+    # Every tracked object, with smoothed bbox, distance and position
+    registry = ObjectRegistry()
 
-        for detection in detections:
-            class_id = int(detection[5])
-            class_name = model.names[class_id]
-            confidence = detection[4]
-            bbox = detection[:4]
+    # Capture and inference run on their own threads, this loop only handles
+    # the newest result, so a slow model never makes the stream lag behind
+    with CameraService(source) as camera, \
+            VisionPipeline(camera, infer) as pipeline:
+        next_stats = time.monotonic() + STATS_PERIOD
+        try:
+            while True:
+                item = pipeline.get()
+                if item is not None:
+                    if intrinsics is None:
+                        # Known once the first frame gives the stream's resolution
+                        image_size = (item.frame.shape[1], item.frame.shape[0])
+                        intrinsics = default_intrinsics(image_size) if calibrated is None \
+                            else scale_intrinsics(calibrated, image_size)
+                        # Physical width of every class the model knows, for the distances
+                        widths = width_table(model.names)
+                    update_registry(model, item.result, registry, widths, intrinsics)
 
-            xmin, ymin, xmax, ymax = map(int, bbox)
-            pixel_width = xmax - xmin
-            distance = calculate_distance(KNOWN_WIDTH, FOCAL_LENGTH, pixel_width)
+                    if not args.headless:
+                        frame_ = item.result[0].plot()
+                        cv2.imshow('frame', frame_)
+                    pipeline.done(item)
 
-            # Check if the object is already in the list
-            is_unique = True
-            for obj in detected_objects:
-                if obj["class"] == class_name:
-                    is_unique = False
-                    break
+                if not args.headless:
+                    key = cv2.waitKey(1)
+                    if key == 27:  # ASCII Value of ESC key
+                        break
 
-            # Add the object to the list if it's unique
-            if is_unique:
-                detected_objects.append({
-                    "class": class_name,
-                    "confidence": confidence,
-                    "bbox": bbox,
-                    "distance": distance
-                })
+                if time.monotonic() >= next_stats:
+                    print_pipeline_stats(pipeline.stats())
+                    next_stats += STATS_PERIOD
+        except KeyboardInterrupt:
+            pass
 
-        frame_ = results[0].plot()
-        cv2.imshow('frame', frame_)
+    # Print the classes of the detected objects
+    print("Detected Objects:")
+    for class_name, count in registry.seen_classes.items():
+        print("{} ({} tracked)".format(class_name, count))
+    if not args.headless:
+        cv2.destroyAllWindows()
 
-        key = cv2.waitKey(1)
-        if key == 27:  # ASCII Value of ESC key
-            break
 
-# Print the list of unique detected objects
-print("Detected Objects:")
-for obj in detected_objects:
-    print(obj["class"])
-cap.release()
-cv2.destroyAllWindows()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
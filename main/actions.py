@@ -0,0 +1,345 @@
+import collections
+import threading
+import time
+
+from kortex_api.Exceptions.KServerException import KServerException
+from kortex_api.autogen.messages import Base_pb2
+
+import tracing
+
+
+# Outcome of one action, filled from its ACTION_END / ACTION_ABORT notification.
+# Host times come from time.monotonic(), device_timestamp is the notification's
+# own timestamp in seconds.
+ActionResult = collections.namedtuple("ActionResult", [
+    "name", "event", "abort_details",
+    "submitted", "started", "finished", "device_timestamp",
+])
+
+
+def _event_name(action_event):
+    return Base_pb2.ActionEvent.Name(action_event)
+
+
+def _action_type(action):
+    # ActionType of an Action, from the field of its action_parameters
+    parameters = action.WhichOneof("action_parameters")
+    try:
+        return Base_pb2.ActionType.Value((parameters or "").upper())
+    except ValueError:
+        return Base_pb2.UNSPECIFIED_ACTION
+
+
+class ActionFuture:
+    """Waitable handle on an action sent to the arm
+
+    Set by ActionNotifier when the END or ABORT notification of the action
+    arrives. A wait that times out (other than a poll with timeout 0)
+    calls on_timeout(future), the notifier uses it to stop expecting the
+    action. action_type is the ActionType its notifications must have,
+    UNSPECIFIED_ACTION for any.
+    """
+
+    def __init__(self, name, identifier=None, on_timeout=None, action_type=Base_pb2.UNSPECIFIED_ACTION):
+        self.name = name
+        self.identifier = identifier
+        self.action_type = action_type
+        self.submitted = time.monotonic()
+        self.started = None
+        self.on_timeout = on_timeout
+        self._event = threading.Event()
+        self._result = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the action ended or aborted, return False on timeout"""
+        if self._event.is_set():
+            return True
+        with tracing.span("notification", "wait " + self.name):
+            finished = self._event.wait(timeout)
+        if not finished and timeout and self.on_timeout is not None:
+            self.on_timeout(self)
+        return finished
+
+    def result(self, timeout=None):
+        """Return the ActionResult, or None if the action didn't finish in time"""
+        if not self.wait(timeout):
+            return None
+        return self._result
+
+    def succeeded(self, timeout=None):
+        result = self.result(timeout)
+        return result is not None and result.event == Base_pb2.ACTION_END
+
+    def _set_result(self, notification):
+        timestamp = notification.timestamp.sec + notification.timestamp.usec / 1e6
+        self._result = ActionResult(
+            name=self.name,
+            event=notification.action_event,
+            abort_details=notification.abort_details,
+            submitted=self.submitted,
+            started=self.started,
+            finished=time.monotonic(),
+            device_timestamp=timestamp,
+        )
+        self._event.set()
+
+    def __repr__(self):
+        if self._result is None:
+            return "<ActionFuture {} pending>".format(self.name)
+        return "<ActionFuture {} {} in {:.3f}s>".format(
+            self.name, _event_name(self._result.event),
+            self._result.finished - self._result.submitted)
+
+
+def wait_all(futures, timeout=None):
+    """Wait for every future to finish, return False if the timeout expired first"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for future in futures:
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if not future.wait(remaining):
+            return False
+    return True
+
+
+class ActionNotifier:
+    """Single long-lived action notification subscription for a session
+
+    Every action is registered before it is sent, so an END that comes back
+    before ExecuteAction returns is not lost. Notifications are matched to
+    their ActionFuture by handle identifier. Actions sent with ExecuteAction
+    have no handle until the arm assigns one, they are bound in order on
+    their first notification of the same action type (notifications carry
+    no action name), so an action of another type started by another
+    client isn't taken for ours. A future whose wait timed out is
+    forgotten. Every function of on_rejected is called with the exception
+    when the arm refuses to execute an action.
+
+    Arguments:
+    base -- BaseClient of the current session
+    recorder -- optional TelemetryRecorder every notification is recorded to
+    """
+
+    def __init__(self, base, recorder=None):
+        self.base = base
+        self.recorder = recorder
+        self._lock = threading.Lock()
+        self._by_identifier = {}
+        self._unbound = collections.deque()
+        self.on_rejected = []
+        self._notification_handle = base.OnNotificationActionTopic(
+            self._on_notification,
+            Base_pb2.NotificationOptions()
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._notification_handle is not None:
+            self.base.Unsubscribe(self._notification_handle)
+            self._notification_handle = None
+
+    def execute_action(self, action):
+        """ExecuteAction and return its ActionFuture"""
+        future = ActionFuture(action.name, on_timeout=self._discard, action_type=_action_type(action))
+        with self._lock:
+            self._unbound.append(future)
+        try:
+            self.base.ExecuteAction(action)
+        except Exception as e:
+            self._rejected(future, e)
+            raise
+        return future
+
+    def execute_waypoint_trajectory(self, waypoint_list, name=""):
+        """ExecuteWaypointTrajectory and return its ActionFuture"""
+        future = ActionFuture(name, on_timeout=self._discard, action_type=Base_pb2.EXECUTE_WAYPOINT_LIST)
+        with self._lock:
+            self._unbound.append(future)
+        try:
+            self.base.ExecuteWaypointTrajectory(waypoint_list)
+        except Exception as e:
+            self._rejected(future, e)
+            raise
+        return future
+
+    def execute_action_from_reference(self, action_handle, name=""):
+        """ExecuteActionFromReference and return its ActionFuture"""
+        future = ActionFuture(name, action_handle.identifier, self._discard, action_handle.action_type)
+        with self._lock:
+            self._by_identifier[action_handle.identifier] = future
+        try:
+            self.base.ExecuteActionFromReference(action_handle)
+        except Exception as e:
+            self._rejected(future, e)
+            raise
+        return future
+
+    def _rejected(self, future, error):
+        self._discard(future)
+        for function in list(self.on_rejected):
+            function(error)
+
+    def _discard(self, future):
+        # An action that never notified, left unbound it would take the START of the next one
+        with self._lock:
+            if self._by_identifier.get(future.identifier) is future:
+                del self._by_identifier[future.identifier]
+            if future in self._unbound:
+                self._unbound.remove(future)
+
+    def _on_notification(self, notification):
+        print("EVENT : " + _event_name(notification.action_event))
+        future = self._resolve(notification)
+        tracing.instant("notification", _event_name(notification.action_event),
+                        {"action": future.name if future is not None else ""})
+        if self.recorder is not None:
+            self.recorder.record_action(notification, future.name if future is not None else "")
+        if future is not None and notification.action_event in (Base_pb2.ACTION_END, Base_pb2.ACTION_ABORT):
+            future._set_result(notification)
+
+    def _resolve(self, notification):
+        # Future the notification belongs to, None if it isn't one of ours
+        identifier = notification.handle.identifier
+        with self._lock:
+            future = self._by_identifier.get(identifier)
+            if future is None and notification.action_event in (Base_pb2.ACTION_START, Base_pb2.ACTION_ABORT):
+                # First notification of an ad-hoc action, it now has a handle
+                future = self._bind(notification)
+            if future is None:
+                return None
+            if notification.action_event == Base_pb2.ACTION_START:
+                future.started = time.monotonic()
+            if notification.action_event in (Base_pb2.ACTION_END, Base_pb2.ACTION_ABORT):
+                del self._by_identifier[identifier]
+        return future
+
+    def _bind(self, notification):
+        # Oldest unbound future of the notification's action type, called with the lock held
+        action_type = notification.handle.action_type
+        for future in self._unbound:
+            if future.action_type in (action_type, Base_pb2.UNSPECIFIED_ACTION):
+                self._unbound.remove(future)
+                future.identifier = notification.handle.identifier
+                self._by_identifier[future.identifier] = future
+                return future
+        return None
+
+
+class ActionRegistry:
+    """Session-scoped index of the actions stored on the arm
+
+    The REACH_JOINT_ANGLES and SEND_GRIPPER_COMMAND lists are read once and
+    indexed by name. They are only read again after invalidate() or when a
+    name (or a cached handle) can't be resolved any more.
+    The servoing mode last sent is remembered so SetServoingMode is only
+    called when the mode actually changes. It is forgotten when a
+    SetServoingMode or an action fails, the mode may have been changed by
+    another client (each session, so each reconnection, starts with a new
+    registry). Every function of on_change is
+    called after invalidate() and when a refresh() finds different actions,
+    so caches holding action handles (e.g. the SequenceCompiler's) go too.
+
+    Arguments:
+    base -- BaseClient of the current session
+    notifier -- ActionNotifier of the same session, used by execute()
+    """
+
+    ACTION_TYPES = (Base_pb2.REACH_JOINT_ANGLES, Base_pb2.SEND_GRIPPER_COMMAND)
+
+    def __init__(self, base, notifier):
+        self.base = base
+        self.notifier = notifier
+        self._lock = threading.Lock()
+        self._actions = None
+        self._servoing_mode = None
+        self.on_change = []
+        notifier.on_rejected.append(lambda error: self.forget_servoing_mode())
+
+    def _changed(self):
+        for function in list(self.on_change):
+            function()
+
+    def invalidate(self):
+        """Forget the cached actions and servoing mode (e.g. after re-teaching a position)"""
+        with self._lock:
+            self._actions = None
+            self._servoing_mode = None
+        self._changed()
+
+    def refresh(self):
+        """Read the action lists from the arm and rebuild the name index"""
+        actions = {}
+        for action_type in self.ACTION_TYPES:
+            requested_type = Base_pb2.RequestedActionType()
+            requested_type.action_type = action_type
+            action_list = self.base.ReadAllActions(requested_type)
+            actions[action_type] = {action.name: action for action in action_list.action_list}
+        with self._lock:
+            previous, self._actions = self._actions, actions
+        if previous is not None and previous != actions:
+            self._changed()
+        return actions
+
+    def get_action(self, name, action_type=Base_pb2.REACH_JOINT_ANGLES):
+        """Return the stored Action called name, or None if the arm doesn't have it"""
+        with self._lock:
+            actions = self._actions
+        if actions is not None and name in actions.get(action_type, {}):
+            return actions[action_type][name]
+
+        # Unknown name, the list may be stale (or was never read)
+        actions = self.refresh()
+        return actions.get(action_type, {}).get(name)
+
+    def get_handle(self, name, action_type=Base_pb2.REACH_JOINT_ANGLES):
+        """Return the handle of the stored action called name, or None if the arm doesn't have it"""
+        action = self.get_action(name, action_type)
+        if action is None:
+            return None
+        return action.handle
+
+    def forget_servoing_mode(self):
+        """Send the next SetServoingMode whatever the mode, the arm's mode is unknown"""
+        with self._lock:
+            self._servoing_mode = None
+
+    def set_servoing_mode(self, servoing_mode=Base_pb2.SINGLE_LEVEL_SERVOING):
+        """Send SetServoingMode only when the mode differs from the last one sent"""
+        with self._lock:
+            if self._servoing_mode == servoing_mode:
+                return
+        base_servo_mode = Base_pb2.ServoingModeInformation()
+        base_servo_mode.servoing_mode = servoing_mode
+        try:
+            self.base.SetServoingMode(base_servo_mode)
+        except Exception:
+            self.forget_servoing_mode()
+            raise
+        with self._lock:
+            self._servoing_mode = servoing_mode
+
+    def execute(self, name, action_type=Base_pb2.REACH_JOINT_ANGLES):
+        """Execute the stored action called name and return its ActionFuture (None if it doesn't exist)
+
+        A handle the arm rejects is treated as stale: the index is rebuilt and
+        the action is executed once more with the fresh handle.
+        """
+        action_handle = self.get_handle(name, action_type)
+        if action_handle is None:
+            return None
+        try:
+            return self.notifier.execute_action_from_reference(action_handle, name)
+        except KServerException:
+            print("Action handle for {} is stale, reloading the action list".format(name))
+            self.invalidate()
+            action_handle = self.get_handle(name, action_type)
+            if action_handle is None:
+                return None
+            return self.notifier.execute_action_from_reference(action_handle, name)
@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import tracing
+from startup import Subsystem
+from simulator import RPC_JITTER, RPC_LATENCY, SimulatedArm, SimulatedBase, SimulatedBaseCyclic, SimulatedCamera
+
+# Commands run by default, in order: (phrase, color code asked by 'pick up').
+# Repeated commands show what the session caches save after the first run,
+# the last pick what the slot cache saves after the scan of the one before.
+COMMANDS = [
+    ("go home", None),
+    ("take rest", None),
+    ("go home", None),
+    ("go left", None),
+    ("turn right", None),
+    ("open gripper", None),
+    ("hold object", None),
+    ("pick up", "Green"),
+    ("pick up", "Green"),
+    ("pick up", "Blue"),
+    ("pick up", "Green"),
+    ("rotate base left", None),
+    ("go left then up then forward", None),
+    ("take rest", None),
+]
+# RPCs of the feedback monitor's polling thread, not counted against commands
+BACKGROUND_PREFIX = "monitor."
+# Relative increase of a command's wall-clock time or RPC count reported as a regression
+TOLERANCE = 0.2
+
+
+class _SilentSpeaker:
+    # Takes the place of voiceass' SpeechWorker, announcements cost nothing here
+
+    def say(self, text, priority=False, interrupt=False):
+        pass
+
+    def wait_idle(self, timeout=None):
+        return True
+
+    def stop(self):
+        pass
+
+
+def _union_length(intervals, start, end):
+    # Total length covered by intervals, clipped to [start, end]
+    total, covered_to = 0.0, start
+    for begin, finish in sorted((max(begin, start), min(finish, end)) for begin, finish in intervals):
+        if finish <= covered_to:
+            continue
+        total += finish - max(begin, covered_to)
+        covered_to = finish
+    return total
+
+
+def measure(arm, name, run):
+    """Run run() and return what the simulated arm saw of it as a dict"""
+    arm.reset_log()
+    start = time.monotonic()
+    success = run()
+    end = time.monotonic()
+    events = list(arm.events)
+    rpcs = {}
+    for rpc_name, count in arm.rpc_counts.items():
+        if not rpc_name.startswith(BACKGROUND_PREFIX):
+            rpcs[rpc_name] = count
+    rpc_intervals = [(event.start, event.end) for event in events
+                     if event.kind == "rpc" and not event.name.startswith(BACKGROUND_PREFIX)]
+    motion_intervals = [(event.start, event.end) for event in events if event.kind == "motion"]
+    wall = end - start
+    return {
+        "name": name,
+        "success": bool(success),
+        "wall": wall,
+        "rpc_count": sum(rpcs.values()),
+        "rpcs": rpcs,
+        # rpc: some RPC in flight, motion: the arm moving, idle: neither
+        # (host processing, notification lag, vision)
+        "phases": {
+            "rpc": _union_length(rpc_intervals, start, end),
+            "motion": _union_length(motion_intervals, start, end),
+            "idle": wall - _union_length(rpc_intervals + motion_intervals, start, end),
+        },
+    }
+
+
+def _run_command(command, session, color_code):
+    # As the executor's robot thread does, so --trace nests the command's spans in it
+    with tracing.span("command", command.name):
+        return command.handler(session, color_code)
+
+
+def run_voiceass(arm, commands, voiceass_args=()):
+    """Run voiceass command handlers against the simulated arm, return one dict per command"""
+    import voiceass
+    voiceass.speaker = Subsystem("text-to-speech", _SilentSpeaker)
+    base = SimulatedBase(arm)
+    args = voiceass.create_parser().parse_args(list(voiceass_args))
+    session = voiceass.open_session(base, SimulatedBaseCyclic(arm, label=BACKGROUND_PREFIX),
+                                    SimulatedBaseCyclic(arm), args, SimulatedCamera(arm))
+    results = []
+    try:
+        for phrase, color_code in commands:
+            command = voiceass.lookup_command(phrase)
+            if command is None:
+                raise ValueError("Unknown command {}".format(phrase))
+            result = measure(arm, command.name, lambda: _run_command(command, session, color_code))
+            result["color_code"] = color_code
+            results.append(result)
+    finally:
+        voiceass.close_session(session)
+    return results
+
+
+def run_home(arm):
+    """Run the two Home.py examples against the simulated arm"""
+    import Home
+    from actions import ActionNotifier
+    base = SimulatedBase(arm)
+    results = []
+    with ActionNotifier(base) as notifier:
+        results.append(measure(arm, "example_move_to_home_position",
+                               lambda: Home.example_move_to_home_position(base, notifier)))
+    base_cyclic = SimulatedBaseCyclic(arm)
+    results.append(measure(arm, "example_create_sequence",
+                           lambda: Home.example_create_sequence(base, base_cyclic)))
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Regressions of results against a baseline run, as a list of messages"""
+    regressions = []
+    for section in ("commands", "home"):
+        for index, (new, old) in enumerate(zip(results.get(section, []), baseline.get(section, []))):
+            if new["name"] != old["name"]:
+                continue
+            label = "{} #{} {}".format(section, index, new["name"])
+            if new["wall"] > old["wall"] * (1.0 + tolerance):
+                regressions.append("{}: {:.3f}s, was {:.3f}s".format(label, new["wall"], old["wall"]))
+            # Streaming loops make an RPC count that varies a little with timing
+            if new["rpc_count"] > old["rpc_count"] * (1.0 + tolerance):
+                regressions.append("{}: {} RPCs, was {}".format(label, new["rpc_count"], old["rpc_count"]))
+            if old["success"] and not new["success"]:
+                regressions.append("{}: failed".format(label))
+    return regressions
+
+
+def print_results(results):
+    print("command                         ok    wall    RPCs    rpc  motion    idle")
+    for section in ("commands", "home"):
+        for result in results.get(section, []):
+            phases = result["phases"]
+            print("{:<30} {:>3} {:7.3f} {:7d} {:6.3f} {:7.3f} {:7.3f}".format(
+                result["name"][:30], "yes" if result["success"] else "no", result["wall"], result["rpc_count"],
+                phases["rpc"], phases["motion"], phases["idle"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the voiceass commands and Home.py against a simulated arm, "
+                                                 "other options are passed on to voiceass")
+    parser.add_argument("--output", default="benchmark.json", help="where to write the JSON results")
+    parser.add_argument("--baseline", default=None, help="earlier results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="relative wall-clock or RPC count increase reported as a regression")
+    parser.add_argument("--rpc-latency", type=float, default=RPC_LATENCY, help="RPC round-trip (seconds)")
+    parser.add_argument("--rpc-jitter", type=float, default=RPC_JITTER, help="random RPC delay added (seconds)")
+    parser.add_argument("--motion-scale", type=float, default=0.1,
+                        help="factor on the simulated motion durations, 1 for the real arm's speed")
+    parser.add_argument("--skip-home", action="store_true", help="don't run the Home.py examples")
+    # Anything else (e.g. --sequential-scan, --realtime-jog) is passed on to voiceass
+    args, args.voiceass_args = parser.parse_known_args()
+
+    def new_arm():
+        return SimulatedArm(args.rpc_latency, args.rpc_jitter, args.motion_scale)
+
+    results = {
+        "created": time.time(),
+        "config": {
+            "rpc_latency": args.rpc_latency,
+            "rpc_jitter": args.rpc_jitter,
+            "motion_scale": args.motion_scale,
+            "voiceass_args": args.voiceass_args,
+        },
+        "commands": run_voiceass(new_arm(), COMMANDS, args.voiceass_args),
+        "home": [] if args.skip_home else run_home(new_arm()),
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print_results(results)
+    print("Results written to {}".format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+    exit(main())
@@ -0,0 +1,183 @@
+import argparse
+import collections
+import glob
+import json
+import os
+
+import cv2
+import numpy as np
+
+# Where the intrinsics are saved and loaded from by default
+INTRINSICS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "camera_intrinsics.json")
+# Inner corners of the checkerboard (columns, rows) and side of one square (meters)
+PATTERN_SIZE = (9, 6)
+SQUARE_SIZE = 0.025
+# Focal length used until the camera is calibrated (pixels)
+DEFAULT_FOCAL_LENGTH = 1000.0
+# Boxes narrower than this (pixels) get no distance, their width is mostly noise
+MIN_PIXEL_WIDTH = 2.0
+
+# Physical width of the objects of every class (meters)
+OBJECT_WIDTHS = {
+    "bottle": 0.07,
+    "cup": 0.08,
+    "wine glass": 0.07,
+    "bowl": 0.15,
+    "cell phone": 0.075,
+    "book": 0.15,
+    "mouse": 0.06,
+    "remote": 0.05,
+    "scissors": 0.08,
+    "apple": 0.08,
+    "orange": 0.08,
+    "banana": 0.2,
+    "person": 0.45,
+}
+# Width of the classes not in OBJECT_WIDTHS (meters)
+DEFAULT_OBJECT_WIDTH = 0.15
+
+# Pinhole intrinsics: focal lengths and principal point (pixels), distortion
+# coefficients as OpenCV orders them, image_size as (width, height) and the
+# RMS reprojection error of the calibration (None when not calibrated)
+CameraIntrinsics = collections.namedtuple("CameraIntrinsics", [
+    "fx", "fy", "cx", "cy", "distortion", "image_size", "rms",
+])
+
+
+def default_intrinsics(image_size):
+    """Uncalibrated intrinsics: DEFAULT_FOCAL_LENGTH, centered principal point, no distortion"""
+    width, height = image_size
+    return CameraIntrinsics(DEFAULT_FOCAL_LENGTH, DEFAULT_FOCAL_LENGTH, width / 2.0, height / 2.0,
+                            [0.0] * 5, (width, height), None)
+
+
+def camera_matrix(intrinsics):
+    return np.array([[intrinsics.fx, 0.0, intrinsics.cx],
+                     [0.0, intrinsics.fy, intrinsics.cy],
+                     [0.0, 0.0, 1.0]])
+
+
+def calibrate(image_paths, pattern_size=PATTERN_SIZE, square_size=SQUARE_SIZE):
+    """Estimate the CameraIntrinsics from pictures of a checkerboard
+
+    Arguments:
+    image_paths -- the pictures, taken with the camera to calibrate from
+        various angles and distances
+    pattern_size -- inner corners of the checkerboard (columns, rows)
+    square_size -- side of one square (meters)
+    """
+    board = np.zeros((pattern_size[0] * pattern_size[1], 3), np.float32)
+    board[:, :2] = np.mgrid[0:pattern_size[0], 0:pattern_size[1]].T.reshape(-1, 2) * square_size
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+    object_points, image_points, image_size = [], [], None
+    for path in image_paths:
+        gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            print("Can't read {}".format(path))
+            continue
+        if image_size is None:
+            image_size = gray.shape[::-1]
+        elif gray.shape[::-1] != image_size:
+            print("Skipping {}, its size differs from the first picture".format(path))
+            continue
+        found, corners = cv2.findChessboardCorners(gray, pattern_size)
+        if not found:
+            print("No checkerboard found in {}".format(path))
+            continue
+        object_points.append(board)
+        image_points.append(cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria))
+
+    if len(image_points) < 3:
+        raise ValueError("Need at least 3 pictures with the checkerboard, found it in {}".format(len(image_points)))
+    rms, matrix, distortion, _, _ = cv2.calibrateCamera(object_points, image_points, image_size, None, None)
+    return CameraIntrinsics(float(matrix[0, 0]), float(matrix[1, 1]), float(matrix[0, 2]), float(matrix[1, 2]),
+                            distortion.ravel().tolist(), tuple(image_size), float(rms))
+
+
+def save_intrinsics(intrinsics, path=INTRINSICS_PATH):
+    with open(path, "w") as f:
+        json.dump(intrinsics._asdict(), f, indent=2)
+
+
+def load_intrinsics(path=INTRINSICS_PATH):
+    """Return the saved CameraIntrinsics, None if the camera wasn't calibrated"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        values = json.load(f)
+    values["image_size"] = tuple(values["image_size"])
+    return CameraIntrinsics(**values)
+
+
+def scale_intrinsics(intrinsics, image_size):
+    """Intrinsics for frames of image_size (width, height) taken by the same camera"""
+    if tuple(image_size) == tuple(intrinsics.image_size):
+        return intrinsics
+    sx = image_size[0] / float(intrinsics.image_size[0])
+    sy = image_size[1] / float(intrinsics.image_size[1])
+    return intrinsics._replace(fx=intrinsics.fx * sx, fy=intrinsics.fy * sy, cx=intrinsics.cx * sx,
+                               cy=intrinsics.cy * sy, image_size=tuple(image_size))
+
+
+def width_table(class_names, widths=OBJECT_WIDTHS, default=DEFAULT_OBJECT_WIDTH):
+    """Array of physical widths indexed by class id, class_names maps ids to names (e.g. model.names)"""
+    table = np.full(max(class_names) + 1, default)
+    for class_id, name in class_names.items():
+        table[class_id] = widths.get(name, default)
+    return table
+
+
+def locate(boxes, class_ids, widths, intrinsics):
+    """Distance and position in the camera frame of every detection of a frame
+
+    Arguments:
+    boxes -- N x 4 array of [xmin, ymin, xmax, ymax] (pixels)
+    class_ids -- N class ids
+    widths -- width_table() of the model
+    intrinsics -- CameraIntrinsics of the frame
+
+    Returns (distances, positions): N depths along the optical axis and N x 3
+    [x, y, z] positions (meters, x right, y down, z forward). Both are NaN
+    for boxes narrower than MIN_PIXEL_WIDTH.
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    if any(intrinsics.distortion):
+        # Measure the boxes on the undistorted image
+        matrix = camera_matrix(intrinsics)
+        corners = cv2.undistortPoints(boxes.reshape(-1, 1, 2), matrix, np.array(intrinsics.distortion), P=matrix)
+        boxes = corners.reshape(-1, 4)
+    pixel_widths = boxes[:, 2] - boxes[:, 0]
+    valid = pixel_widths >= MIN_PIXEL_WIDTH
+    distances = np.full(len(boxes), np.nan)
+    distances[valid] = widths[np.asarray(class_ids, dtype=int)[valid]] * intrinsics.fx / pixel_widths[valid]
+
+    centers_x = (boxes[:, 0] + boxes[:, 2]) / 2.0
+    centers_y = (boxes[:, 1] + boxes[:, 3]) / 2.0
+    positions = np.column_stack([
+        (centers_x - intrinsics.cx) * distances / intrinsics.fx,
+        (centers_y - intrinsics.cy) * distances / intrinsics.fy,
+        distances,
+    ])
+    return distances, positions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the camera from checkerboard pictures")
+    parser.add_argument("images", nargs="+", help="checkerboard pictures (globs are expanded)")
+    parser.add_argument("--pattern", default="{}x{}".format(*PATTERN_SIZE),
+                        help="inner corners of the checkerboard, columns x rows")
+    parser.add_argument("--square", type=float, default=SQUARE_SIZE, help="side of one square (meters)")
+    parser.add_argument("--output", default=INTRINSICS_PATH, help="where to save the intrinsics")
+    args = parser.parse_args()
+
+    paths = sorted(path for pattern in args.images for path in (glob.glob(pattern) or [pattern]))
+    pattern_size = tuple(int(value) for value in args.pattern.lower().split("x"))
+    intrinsics = calibrate(paths, pattern_size, args.square)
+    save_intrinsics(intrinsics, args.output)
+    print("fx {:.1f} fy {:.1f} cx {:.1f} cy {:.1f}, RMS error {:.3f} px, saved to {}".format(
+        intrinsics.fx, intrinsics.fy, intrinsics.cx, intrinsics.cy, intrinsics.rms, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import threading
+import time
+
+import cv2
+
+import tracing
+
+# Color stream of the arm's wrist camera
+CAMERA_URL = "rtsp://192.168.1.10/color"
+
+
+class CameraService:
+    """Background reader that keeps only the newest frame of a video stream
+
+    The stream is opened once and read continuously on a single thread, so
+    callers never pay the RTSP connect / keyframe wait and never get stale
+    buffered frames. When the stream fails it is released and reopened.
+
+    Arguments:
+    source -- anything cv2.VideoCapture accepts (URL or device index)
+    reconnect_delay -- seconds to wait before reopening a failed stream
+    """
+
+    def __init__(self, source=CAMERA_URL, reconnect_delay=1.0):
+        self.source = source
+        self.reconnect_delay = reconnect_delay
+        self._condition = threading.Condition()
+        self._frame = None
+        self._timestamp = None
+        self._running = False
+        self._thread = None
+        self.reconnects = 0
+        self.frames = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="camera", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def latest_frame(self, after=None, timeout=5.0):
+        """Return (timestamp, frame) of the newest frame
+
+        Arguments:
+        after -- only return a frame captured after this time.monotonic() value,
+            e.g. the moment the arm settled
+        timeout -- seconds to wait for such a frame, (None, None) is returned
+            when it expires
+        """
+        deadline = time.monotonic() + timeout
+        with tracing.span("camera", "latest_frame"), self._condition:
+            while self._timestamp is None or (after is not None and self._timestamp <= after):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._running:
+                    return None, None
+                self._condition.wait(remaining)
+            return self._timestamp, self._frame
+
+    def _open(self):
+        cap = cv2.VideoCapture(self.source)
+        # Keep the decoder's own queue as short as possible
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return cap
+
+    def _run(self):
+        cap = None
+        while self._running:
+            if cap is None:
+                cap = self._open()
+                if not cap.isOpened():
+                    print("Error: Could not open camera {}, retrying".format(self.source))
+                    cap.release()
+                    cap = None
+                    time.sleep(self.reconnect_delay)
+                    continue
+
+            ret, frame = cap.read()
+            if not ret:
+                print("Failed to grab frame, reconnecting to camera")
+                cap.release()
+                cap = None
+                self.reconnects += 1
+                time.sleep(self.reconnect_delay)
+                continue
+
+            with self._condition:
+                self._frame = frame
+                self._timestamp = time.monotonic()
+                self.frames += 1
+                self._condition.notify_all()
+
+        if cap is not None:
+            cap.release()
+        with self._condition:
+            self._condition.notify_all()
@@ -1,76 +1,219 @@
 import cv2
 import numpy as np
 
+import tracing
+import utilities
+from camera import CameraService
+
+UNKNOWN_COLOR = "Unknown"
+LOW_SATURATION_COLOR = "Gray or Black (Low Saturation/Value)"
+
+
+def clip_roi(roi, shape):
+    """The part of the [xmin, ymin, xmax, ymax] roi inside an image of shape, empty if there is none"""
+    height, width = shape[:2]
+    x1, y1, x2, y2 = [int(value) for value in roi]
+    x1, x2 = min(max(x1, 0), width), min(max(x2, 0), width)
+    y1, y2 = min(max(y1, 0), height), min(max(y2, 0), height)
+    return [x1, y1, max(x1, x2), max(y1, y2)]
+
+
+class ColorClassifier:
+    """Names the dominant color of HSV pixels with a masked hue histogram
+
+    Pixels from any number of ROIs / frames can be classified at once: every
+    pixel that is saturated and bright enough votes for the hue bin its hue
+    falls in, the rest vote for LOW_SATURATION_COLOR. Hue bins are looked up
+    in a table, so red wrapping around 180 is handled like any other bin.
+
+    Arguments:
+    hue_bins -- (name, lower, upper) hue bins, see utilities.COLOR_HUE_BINS
+    saturation_min, value_min -- pixels at or below these have no reliable hue
+    confidence -- share of votes the leading color needs to stop sampling
+    min_frames, max_frames -- bounds on the frames sampled by vote()
+    """
+
+    def __init__(self, hue_bins=utilities.COLOR_HUE_BINS,
+                 saturation_min=utilities.SATURATION_MIN, value_min=utilities.VALUE_MIN,
+                 confidence=0.8, min_frames=2, max_frames=10):
+        self.saturation_min = saturation_min
+        self.value_min = value_min
+        self.confidence = confidence
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+
+        self.labels = [name for name, _, _ in hue_bins] + [UNKNOWN_COLOR, LOW_SATURATION_COLOR]
+        self._low_saturation_bin = len(self.labels) - 1
+        # hue -> bin index, for every possible 8-bit hue
+        self._hue_lut = np.full(256, len(hue_bins), dtype=np.intp)
+        hues = np.arange(256)
+        for index, (_, lower, upper) in enumerate(hue_bins):
+            if lower <= upper:
+                self._hue_lut[(hues >= lower) & (hues < upper)] = index
+            else:
+                self._hue_lut[(hues >= lower) | (hues < upper)] = index
+        # Pixel indices of the last ROIs given to slot_histograms(), see _roi_pixels
+        self._roi_key = None
+        self._roi_pixel_index = None
+        self._roi_index = None
+
+    def _bins(self, pixels):
+        # Label index of every row of an (N, 3) array of HSV pixels
+        bins = self._hue_lut[pixels[:, 0]]
+        colorful = (pixels[:, 1] > self.saturation_min) & (pixels[:, 2] > self.value_min)
+        return np.where(colorful, bins, self._low_saturation_bin)
+
+    def histogram(self, hsv_pixels):
+        """Return the vote count of every label for an (..., 3) array of HSV pixels"""
+        return np.bincount(self._bins(np.asarray(hsv_pixels).reshape(-1, 3)), minlength=len(self.labels))
+
+    def slot_histograms(self, hsv_image, rois):
+        """Return the vote counts of every ROI of an HSV image, one row per ROI
+
+        rois are [xmin, ymin, xmax, ymax] in image coordinates (they may
+        overlap), the pixels of all of them are classified in one pass. They
+        are clipped to the image, a ROI outside of it has no votes.
+        """
+        pixel_index, roi_index = self._roi_pixels(hsv_image.shape[:2], rois)
+        bins = self._bins(np.asarray(hsv_image).reshape(-1, 3)[pixel_index])
+        labels = len(self.labels)
+        counts = np.bincount(roi_index * labels + bins, minlength=len(rois) * labels)
+        return counts.reshape(len(rois), labels)
+
+    def _roi_pixels(self, shape, rois):
+        # Flat pixel indices of every ROI and the ROI each one belongs to,
+        # computed once for a given frame size and set of ROIs
+        key = (tuple(shape), tuple(tuple(int(value) for value in roi) for roi in rois))
+        if key != self._roi_key:
+            height, width = shape
+            pixel_index, roi_index = [], []
+            for index, roi in enumerate(key[1]):
+                x1, y1, x2, y2 = clip_roi(roi, shape)
+                if [x1, y1, x2, y2] != list(roi):
+                    print("ROI {} doesn't fit in the {}x{} frame, using {}".format(
+                        list(roi), width, height, [x1, y1, x2, y2]))
+                ys, xs = np.mgrid[y1:y2, x1:x2]
+                pixel_index.append((ys * width + xs).ravel())
+                roi_index.append(np.full(pixel_index[-1].size, index, dtype=np.intp))
+            self._roi_pixel_index = np.concatenate(pixel_index)
+            self._roi_index = np.concatenate(roi_index)
+            self._roi_key = key
+        return self._roi_pixel_index, self._roi_index
+
+    def decide(self, counts):
+        """Return (label, confidence) of a histogram"""
+        total = counts.sum()
+        if total == 0:
+            return UNKNOWN_COLOR, 0.0
+        best = int(np.argmax(counts))
+        return self.labels[best], float(counts[best] / total)
+
+    def decide_rows(self, counts):
+        """Return (labels, confidences) of every row of a histogram matrix"""
+        totals = counts.sum(axis=1)
+        best = np.argmax(counts, axis=1)
+        confidences = counts[np.arange(len(counts)), best] / np.maximum(totals, 1).astype(float)
+        labels = [self.labels[index] if total else UNKNOWN_COLOR for index, total in zip(best, totals)]
+        return labels, confidences
+
+    @tracing.traced("vision")
+    def classify(self, hsv_pixels):
+        """Return (label, confidence) for a stack of HSV pixels (one or many ROIs)"""
+        return self.decide(self.histogram(hsv_pixels))
+
+    @tracing.traced("vision")
+    def vote(self, hsv_rois):
+        """Accumulate ROIs until the leading color is confident enough
+
+        hsv_rois can be a lazy iterable (e.g. reading the camera), sampling stops
+        as soon as min_frames have been seen and the vote passes confidence.
+        Returns (label, confidence, frames_used).
+        """
+        counts = np.zeros(len(self.labels), dtype=np.int64)
+        label, confidence, frames_used = UNKNOWN_COLOR, 0.0, 0
+        for hsv_roi in hsv_rois:
+            counts += self.histogram(hsv_roi)
+            frames_used += 1
+            label, confidence = self.decide(counts)
+            if frames_used >= self.min_frames and confidence >= self.confidence:
+                break
+            if frames_used >= self.max_frames:
+                break
+        return label, confidence, frames_used
+
+    @tracing.traced("vision")
+    def vote_slots(self, hsv_images, rois):
+        """Like vote() for every ROI of each image at once
+
+        Sampling stops when every ROI passes confidence (after min_frames)
+        or after max_frames. Returns (labels, confidences, frames_used), with
+        one label and confidence per ROI.
+        """
+        counts = np.zeros((len(rois), len(self.labels)), dtype=np.int64)
+        labels, confidences, frames_used = [UNKNOWN_COLOR] * len(rois), np.zeros(len(rois)), 0
+        for hsv_image in hsv_images:
+            counts += self.slot_histograms(hsv_image, rois)
+            frames_used += 1
+            labels, confidences = self.decide_rows(counts)
+            if frames_used >= self.min_frames and np.all(confidences >= self.confidence):
+                break
+            if frames_used >= self.max_frames:
+                break
+        return labels, confidences, frames_used
+
+
+# Shared default classifier
+classifier = ColorClassifier()
+
 # Define a function to get the dominant color in a given region of interest (ROI)
 def get_dominant_color(hsv_roi):
-    # Calculate the mean of each channel in the HSV space
-    mean_hue = np.mean(hsv_roi[:, :, 0])
-    mean_saturation = np.mean(hsv_roi[:, :, 1])
-    mean_value = np.mean(hsv_roi[:, :, 2])
-
-    # Determine the color based on the hue
-    if mean_saturation > 50 and mean_value > 50:
-        if 0 <= mean_hue < 15 or 165 < mean_hue <= 180:
-            color = "Red"
-        elif 15 <= mean_hue < 35:
-            color = "Yellow"
-        elif 35 <= mean_hue < 85:
-            color = "Green"
-        elif 85 <= mean_hue < 125:
-            color = "Blue"
-        elif 125 <= mean_hue < 165:
-            color = "Purple"
-        else:
-            color = "Unknown"
-    else:
-        color = "Gray or Black (Low Saturation/Value)"
-
+    color, _ = classifier.classify(hsv_roi)
     return color
-def get_the_color(color_code):
-    # Access the internal camera with ID 1
-    # Use IP camera ("rtsp://192.168.1.10/color")
-    cap = cv2.VideoCapture("rtsp://192.168.1.10/color")
-    print("I'm in the Color Code")
 
-    if not cap.isOpened():
-        print("Error: Could not open camera.")
-        exit()
+def center_roi(frame, roi_size=50):
+    # Define the region of interest (ROI) in the center of the frame
+    height, width, _ = frame.shape
+    cx, cy = width // 2, height // 2
+    return frame[max(cy - roi_size, 0):cy + roi_size, max(cx - roi_size, 0):cx + roi_size]
 
-    # Parameters for capturing multiple frames
-    num_frames = 10  # Number of frames to capture
-    colors_detected = []
+def camera_rois(camera, after=None, roi_size=50):
+    # Yield the HSV center ROI of every new frame, each newer than the previous one
+    timestamp = after
+    while True:
+        timestamp, frame = camera.latest_frame(after=timestamp)
+        if frame is None:
+            print("Failed to grab frame")
+            return
+        yield cv2.cvtColor(center_roi(frame, roi_size), cv2.COLOR_BGR2HSV)
 
-    for _ in range(num_frames):
-        # Capture a single frame
-        ret, frame = cap.read()
-        if not ret:
+def camera_regions(camera, region, after=None):
+    # Yield the HSV [xmin, ymin, xmax, ymax] region of every new frame, each newer than the previous one
+    x1, y1, x2, y2 = region
+    timestamp = after
+    while True:
+        timestamp, frame = camera.latest_frame(after=timestamp)
+        if frame is None:
             print("Failed to grab frame")
-            continue
-
-        # Define the region of interest (ROI) in the center of the frame
-        height, width, _ = frame.shape
-        cx, cy = width // 2, height // 2
-        roi_size = 50  # Size of the central area
-        roi = frame[cy - roi_size:cy + roi_size, cx - roi_size:cx + roi_size]
-
-        # Convert the ROI to HSV color space
-        hsv_roi = cv2.cvtColor(roi, cv2.COLOR_BGR2HSV)
-
-        # Get the dominant color in the ROI and add it to the list
-        dominant_color = get_dominant_color(hsv_roi)
-        colors_detected.append(dominant_color)
-
-    # Release the camera after capturing the frames
-    cap.release()
-
-    # Calculate the most frequently detected color
-    if colors_detected:
-        most_common_color = max(set(colors_detected), key=colors_detected.count)
-        print("Detected color (most common across frames):", most_common_color)
-        if most_common_color == color_code:
-            return True
-        else:
-            return False
+            return
+        yield cv2.cvtColor(frame[y1:y2, x1:x2], cv2.COLOR_BGR2HSV)
+
+def get_the_color(camera, color_code, after=None, color_classifier=None):
+    # Frames come from the session's CameraService, the stream stays open between checks
+    print("I'm in the Color Code")
+    color_classifier = color_classifier or classifier
+
+    # Only use frames captured after 'after' (e.g. once the arm has settled),
+    # stop sampling as soon as the vote is clear
+    color, confidence, frames_used = color_classifier.vote(camera_rois(camera, after))
+
+    if frames_used:
+        print("Detected color: {} ({:.0%} of {} frames)".format(color, confidence, frames_used))
+        return color == color_code
     else:
         print("No color detected.")
-print(get_the_color("Blue"))
\ No newline at end of file
+        return False
+
+
+if __name__ == "__main__":
+    with CameraService() as camera:
+        print(get_the_color(camera, "Blue"))
@@ -0,0 +1,202 @@
+import collections
+import re
+
+import numpy as np
+
+# Cartesian jog deltas: x, y, z (meters), theta_x, theta_y, theta_z (degrees)
+POSE_DELTA_NAMES = [
+    "pick", "drop", "up", "rest", "right", "left", "front", "back",
+    "go_left", "go_right", "go_up", "go_down", "go_back", "go_forward",
+    "turn_left", "turn_right", "turn_around",
+]
+POSE_DELTAS = np.array([
+    #  x      y      z     tx   ty    tz
+    [0.0,  0.35,  0.0,   0.0, 0.0,   0.0],   # pick
+    [0.0,  0.0,  -0.15,  0.0, 0.0,   0.0],   # drop
+    [0.0,  0.0,   0.15,  0.0, 0.0,   0.0],   # up
+    [0.0,  0.0,  -0.045, 0.0, 0.0,   0.0],   # rest
+    [0.0,  0.0,   0.0,   0.0, 0.0,  10.0],   # right
+    [0.0,  0.0,   0.0,   0.0, 0.0, -10.0],   # left
+    [0.0,  0.1,   0.0,   0.0, 0.0,   0.0],   # front
+    [0.0, -0.1,   0.0,   0.0, 0.0,   0.0],   # back
+    [0.0, -0.05,  0.0,   0.0, 0.0,   0.0],   # go_left
+    [0.0,  0.05,  0.0,   0.0, 0.0,   0.0],   # go_right
+    [0.0,  0.0,   0.05,  0.0, 0.0,   0.0],   # go_up
+    [0.0,  0.0,  -0.05,  0.0, 0.0,   0.0],   # go_down
+    [-0.05, 0.0,  0.0,   0.0, 0.0,   0.0],   # go_back
+    [0.05, 0.0,   0.0,   0.0, 0.0,   0.0],   # go_forward
+    [0.0,  0.0,   0.0,   0.0, 0.0, -90.0],   # turn_left
+    [0.0,  0.0,   0.0,   0.0, 0.0,  90.0],   # turn_right
+    [0.0,  0.0,   0.0,   0.0, 0.0, -180.0],  # turn_around
+])
+POSE_DELTA_INDEX = {name: index for index, name in enumerate(POSE_DELTA_NAMES)}
+
+# Words speech-to-text adds around commands that don't change their meaning
+FILLER_WORDS = {"please", "the", "a", "now", "robot", "kinova", "can", "you", "could"}
+# Words joining the steps of a chained command, "go left then up then forward"
+CHAIN_WORDS = {"then", "and"}
+# Largest radius (meters) a corner between two jog steps is rounded with
+BLENDING_RADIUS = 0.02
+# Share of the shorter segment next to a corner the blending may take
+BLENDING_SHARE = 0.4
+
+
+def tool_pose(feedback):
+    """Tool pose of a BaseCyclic feedback as [x, y, z, theta_x, theta_y, theta_z]"""
+    base = feedback.base
+    return np.array([
+        base.tool_pose_x, base.tool_pose_y, base.tool_pose_z,
+        base.tool_pose_theta_x, base.tool_pose_theta_y, base.tool_pose_theta_z,
+    ])
+
+
+def pose_delta(name):
+    """Row of the jog delta table called name (KeyError if there is none)"""
+    return POSE_DELTAS[POSE_DELTA_INDEX[name]]
+
+
+def apply_pose_delta(pose, name):
+    """Return pose moved by the jog delta called name (KeyError if there is none)"""
+    return pose + pose_delta(name)
+
+
+def jog_waypoints(pose, names, blending_radius=BLENDING_RADIUS):
+    """Poses the jog deltas called names lead to one after the other, and their blending radii
+
+    Steps that don't move the tool are left out. A corner is rounded by
+    at most blending_radius and BLENDING_SHARE of the shorter segment next
+    to it; the last waypoint, where the arm stops, isn't blended.
+    Returns (poses, radii), one row / value per waypoint.
+    """
+    deltas = np.array([pose_delta(name) for name in names]).reshape(-1, 6)
+    deltas = deltas[np.any(deltas != 0.0, axis=1)]
+    poses = pose + np.cumsum(deltas, axis=0)
+    points = np.vstack([np.asarray(pose)[:3], poses[:, :3]])
+    lengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    radii = np.minimum(blending_radius, BLENDING_SHARE * np.minimum(lengths[:-1], lengths[1:]))
+    return poses, np.append(radii, 0.0)[:len(poses)]
+
+
+def normalize(text):
+    """Lower case, no punctuation or filler words, single spaces"""
+    words = re.sub(r"[^a-z0-9 ]+", " ", text.lower().replace("_", " ")).split()
+    return " ".join(word for word in words if word not in FILLER_WORDS)
+
+
+def split_chain(text, known=None):
+    """Steps of a chained command: "go left then up" gives ["go left", "go up"]
+
+    A one-word step borrows the first word of the step before it, unless
+    known(word) says it is a phrase of its own ("go left then stop").
+    """
+    steps, current = [], []
+    for word in normalize(text).split():
+        if word in CHAIN_WORDS:
+            if current:
+                steps.append(current)
+            current = []
+        else:
+            current.append(word)
+    if current:
+        steps.append(current)
+    verb = None
+    for step in steps:
+        if len(step) == 1 and verb is not None and not (known is not None and known(step[0])):
+            step.insert(0, verb)
+        verb = step[0]
+    return [" ".join(step) for step in steps]
+
+
+def _deletes(text, distance):
+    # Every string obtained by deleting up to 'distance' characters
+    results = {text}
+    edge = {text}
+    for _ in range(distance):
+        edge = {word[:i] + word[i + 1:] for word in edge for i in range(len(word))}
+        results |= edge
+    return results
+
+
+def _edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+# A registered command. handler is called by the application with its own arguments.
+Command = collections.namedtuple("Command", ["name", "handler", "priority"])
+# Result of a lookup, command is None when the text wasn't recognized
+Match = collections.namedtuple("Match", ["command", "text", "phrase", "distance"])
+
+
+class CommandRegistry:
+    """Maps spoken or typed phrases and their synonyms to commands
+
+    Phrases are normalized first (case, punctuation, filler words) and looked
+    up in a dict. Noisy speech-to-text output is matched through a
+    symmetric-delete index: every phrase is also stored under all its
+    variants with up to max_distance characters removed, so a near miss is
+    found with a few dict lookups whatever the number of commands, and then
+    confirmed by its edit distance (one edit per four characters of the
+    phrase, at most max_distance).
+
+    Arguments:
+    max_distance -- largest edit distance accepted for a fuzzy match
+    """
+
+    def __init__(self, max_distance=2):
+        self.max_distance = max_distance
+        self._commands = {}
+        self._phrases = {}
+        self._deletes = collections.defaultdict(set)
+
+    def add(self, name, handler, synonyms=(), priority=False):
+        """Register handler under name and its synonyms"""
+        command = Command(name, handler, priority)
+        self._commands[name] = command
+        for phrase in (name,) + tuple(synonyms):
+            phrase = normalize(phrase)
+            self._phrases[phrase] = command
+            for variant in _deletes(phrase, self.max_distance):
+                self._deletes[variant].add(phrase)
+        return command
+
+    def command(self, name, synonyms=(), priority=False):
+        """Decorator form of add()"""
+        def register(handler):
+            self.add(name, handler, synonyms, priority)
+            return handler
+        return register
+
+    def phrases(self):
+        return sorted(self._phrases)
+
+    def lookup_chain(self, text):
+        """Return the Match of every step of a chained command, [lookup(text)] if it isn't one"""
+        steps = split_chain(text or "", lambda word: word in self._phrases)
+        if len(steps) < 2:
+            return [self.lookup(text)]
+        return [self.lookup(step) for step in steps]
+
+    def lookup(self, text):
+        """Return the Match for text, Match.command is None when nothing is close enough"""
+        phrase = normalize(text or "")
+        command = self._phrases.get(phrase)
+        if command is not None:
+            return Match(command, text, phrase, 0)
+
+        best = None
+        for variant in _deletes(phrase, self.max_distance):
+            for candidate in self._deletes.get(variant, ()):
+                distance = _edit_distance(phrase, candidate)
+                # Short phrases only tolerate small slips, "stop" and "drop" are two edits apart
+                allowed = min(self.max_distance, max(1, len(candidate) // 4))
+                if distance <= allowed and (best is None or distance < best[0]):
+                    best = (distance, candidate)
+        if best is None:
+            return Match(None, text, None, None)
+        return Match(self._phrases[best[1]], text, best[1], best[0])
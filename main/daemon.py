@@ -0,0 +1,420 @@
+import argparse
+import asyncio
+import base64
+import contextlib
+import functools
+import importlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+# Unix socket the daemon listens on, only the user running it can connect
+SOCKET_PATH = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp", "kinova_robot-{}.sock".format(os.getuid()))
+# Seconds between two checks of the connection, well under the 2 s
+# connection inactivity timeout DeviceConnection asks the arm for
+KEEPALIVE_PERIOD = 0.5
+# Age (seconds) past which the feedback monitor's last sample means the TCP session is gone
+STALE_FEEDBACK = 1.0
+# Delay before reconnecting (seconds), doubled after every failed attempt up to the maximum
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 10.0
+# Seconds a request waits for the daemon to be connected before it is refused
+CONNECT_WAIT = 10.0
+
+# RPCs that only read, run at once instead of waiting behind the running command
+READ_ONLY_PREFIXES = ("Read", "Get", "Refresh", "Compute")
+# RPCs that must not wait behind the command they are meant to interrupt
+IMMEDIATE_RPCS = ("Stop", "ApplyEmergencyStop", "PauseAction", "PauseSequence")
+
+
+def _message_class(full_name):
+    # Kortex messages are top level in the module named after their package,
+    # e.g. Kinova.Api.Base.Pose is Base_pb2.Pose
+    package, _, name = full_name.rpartition(".")
+    module = importlib.import_module("kortex_api.autogen.messages.{}_pb2".format(package.rsplit(".", 1)[-1]))
+    return getattr(module, name)
+
+
+def _encode(message):
+    if message is None:
+        return None, None
+    return message.DESCRIPTOR.full_name, base64.b64encode(message.SerializeToString()).decode("ascii")
+
+
+def _decode(type_name, payload):
+    if type_name is None:
+        return None
+    message = _message_class(type_name)()
+    message.ParseFromString(base64.b64decode(payload))
+    return message
+
+
+class RobotDaemon:
+    """Holds the arm's TCP and UDP sessions and serves local clients over a Unix socket
+
+    The connections are made once and the voiceass session (feedback
+    monitor, stored actions, compiled sequences, camera) is opened on them
+    once, so clients skip connecting, logging in and the heavy imports. A
+    keepalive checks both connections every KEEPALIVE_PERIOD seconds; when
+    one dropped, everything is torn down and reconnected with backoff.
+
+    Clients send one JSON object per line and get one back:
+    {"op": "command", "text": ..., "color": ...} runs a voiceass command,
+    {"op": "rpc", "service": "Base" or "BaseCyclic", "method": ..., "request_type": ..., "request": ...}
+    calls one RPC (protobuf messages base64-encoded), "status" and
+    "shutdown" do what they say. Commands and RPCs that change the arm's
+    state go through one CommandExecutor, so tools sharing the daemon never
+    move the arm at the same time; priority commands ("stop", "cancel")
+    preempt them as they do in voiceass.
+
+    Arguments:
+    args -- parsed connection (--ip, --username, --password) and voiceass options
+    socket_path -- Unix socket to listen on
+    keepalive -- seconds between two connection checks
+    """
+
+    def __init__(self, args, socket_path=SOCKET_PATH, keepalive=KEEPALIVE_PERIOD):
+        self.args = args
+        self.socket_path = socket_path
+        self.keepalive = keepalive
+        self.session = None
+        self.executor = None
+        self.reconnects = 0
+        self.commands = 0
+        self.clients = 0
+        self._started = time.monotonic()
+        self._base_cyclic_rt = None
+        self._connections = None
+        self._writers = set()
+        # Set when the running command is preempted, shared by every session of the daemon
+        self.cancelled = threading.Event()
+        self._connected = None
+        self._stopping = None
+
+    async def serve(self):
+        """Connect, then serve clients until a "shutdown" request"""
+        from executor import CommandExecutor
+        self._connected = asyncio.Event()
+        self._stopping = asyncio.Event()
+        await self._connect()
+        # The session is replaced on reconnection, the executor stops whichever is current
+        self.executor = CommandExecutor(self.session.base, cancelled=self.cancelled, stop=self._stop_motion)
+        worker = asyncio.create_task(self.executor.run())
+        keepalive = asyncio.create_task(self._keepalive())
+        if os.path.exists(self.socket_path):
+            # Left behind by a daemon that didn't shut down cleanly
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self._handle_client, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        print("Serving on {}".format(self.socket_path))
+        try:
+            await self._stopping.wait()
+        finally:
+            server.close()
+            for writer in list(self._writers):
+                # Ends the clients' readline() so their handlers return
+                writer.close()
+            await server.wait_closed()
+            keepalive.cancel()
+            await self.executor.close()
+            await worker
+            await asyncio.get_running_loop().run_in_executor(None, self._disconnect)
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def _open(self):
+        # Blocking, runs on a worker thread
+        from kortex_api.autogen.client_stubs.BaseClientRpc import BaseClient
+        from kortex_api.autogen.client_stubs.BaseCyclicClientRpc import BaseCyclicClient
+        import utilities
+        import voiceass
+        connections = contextlib.ExitStack()
+        try:
+            router = connections.enter_context(utilities.DeviceConnection.createTcpConnection(self.args))
+            router_real_time = connections.enter_context(utilities.DeviceConnection.createUdpConnection(self.args))
+            base = BaseClient(router)
+            base_cyclic_rt = BaseCyclicClient(router_real_time)
+            session = voiceass.open_session(base, BaseCyclicClient(router), base_cyclic_rt, self.args,
+                                            cancelled=self.cancelled)
+            if not self.args.no_preload:
+                voiceass.preload(session)
+        except Exception:
+            connections.close()
+            raise
+        self._connections = connections
+        self._base_cyclic_rt = base_cyclic_rt
+        self.session = session
+
+    def _disconnect(self):
+        # Blocking and best effort, the connection may already be gone
+        import voiceass
+        if self.session is not None:
+            try:
+                voiceass.close_session(self.session)
+            except Exception as e:
+                print("Closing the session failed: {}".format(e))
+        if self._connections is not None:
+            try:
+                self._connections.close()
+            except Exception as e:
+                print("Closing the connections failed: {}".format(e))
+        self.session = None
+        self._connections = None
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                await loop.run_in_executor(None, self._open)
+                break
+            except Exception as e:
+                print("Connecting to {} failed ({}), retrying in {:.0f}s".format(self.args.ip, e, delay))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        if self.executor is not None:
+            self.executor.base = self.session.base
+        self._connected.set()
+
+    def _check(self):
+        # UDP: the jogger only streams while jogging, poll it so it stays alive.
+        # TCP: the feedback monitor polls it, it has to keep getting answers.
+        self._base_cyclic_rt.RefreshFeedback()
+        if self.session.monitor.latest(STALE_FEEDBACK) is None:
+            raise RuntimeError("no feedback for {}s".format(STALE_FEEDBACK))
+
+    async def _keepalive(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.keepalive)
+            try:
+                await loop.run_in_executor(None, self._check)
+            except Exception as e:
+                print("Connection lost ({}), reconnecting".format(e))
+                self._connected.clear()
+                self.reconnects += 1
+                await loop.run_in_executor(None, self._disconnect)
+                await self._connect()
+
+    async def _handle_client(self, reader, writer):
+        self.clients += 1
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    reply = await self._dispatch(request)
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e)}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        finally:
+            self.clients -= 1
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _dispatch(self, request):
+        op = request.get("op")
+        if op == "status":
+            return self.status()
+        if op == "shutdown":
+            self._stopping.set()
+            return {"ok": True}
+        if op not in ("command", "rpc"):
+            return {"ok": False, "error": "Unknown op {}".format(op)}
+        try:
+            await asyncio.wait_for(self._connected.wait(), CONNECT_WAIT)
+        except asyncio.TimeoutError:
+            return {"ok": False, "error": "Not connected to the arm"}
+        if op == "command":
+            return await self._command(request["text"], request.get("color"))
+        return await self._rpc(request["service"], request["method"], request.get("request_type"),
+                               request.get("request"))
+
+    def status(self):
+        return {
+            "ok": True,
+            "connected": self._connected.is_set(),
+            "uptime": time.monotonic() - self._started,
+            "reconnects": self.reconnects,
+            "clients": self.clients,
+            "commands": self.commands,
+            "busy": self.executor.busy(),
+        }
+
+    def _stop_motion(self):
+        import voiceass
+        voiceass.stop_motion(self.session)
+
+    def _run_command(self, handler, color_code):
+        # The session is looked up when the command runs, it changes on reconnection
+        return handler(self.session, color_code)
+
+    async def _command(self, text, color_code=None):
+        import voiceass
+        try:
+            command = voiceass.lookup_command(text)
+        except ValueError as e:
+            # A chain with a step that must be given on its own
+            return {"ok": False, "error": str(e)}
+        if command is None:
+            return {"ok": False, "error": "Sorry, I don't know the command '{}'".format(text)}
+        if self.session.recorder is not None:
+            self.session.recorder.record_command(command.name)
+        self.commands += 1
+        result = await self.executor.execute(command.name, self._run_command, command.handler,
+                                             color_code.capitalize() if color_code else None,
+                                             priority=command.priority)
+        if result is None:
+            return {"ok": False, "command": command.name, "error": "Command was dropped"}
+        return {"ok": True, "command": command.name, "success": bool(result)}
+
+    async def _rpc(self, service, method, request_type, payload):
+        clients = {"Base": self.session.base, "BaseCyclic": self.session.base_cyclic}
+        if service not in clients:
+            return {"ok": False, "error": "Unknown service {}".format(service)}
+        if method.startswith("_") or method.startswith("OnNotification") or not hasattr(clients[service], method):
+            # Notifications need a callback in this process, use a command instead
+            return {"ok": False, "error": "{}.{} can't be called remotely".format(service, method)}
+        request = _decode(request_type, payload)
+
+        def call():
+            rpc = getattr(clients[service], method)
+            return rpc() if request is None else rpc(request)
+
+        if method.startswith(READ_ONLY_PREFIXES) or method in IMMEDIATE_RPCS:
+            reply = await asyncio.get_running_loop().run_in_executor(None, call)
+        else:
+            done = asyncio.get_running_loop().create_future()
+            # Wrapped so a None reply isn't taken for a dropped command
+            await self.executor.submit("{}.{}".format(service, method), lambda: [call()], done=done)
+            reply = await done
+            if not reply:
+                return {"ok": False, "error": "{}.{} was dropped or failed".format(service, method)}
+            reply = reply[0]
+        reply_type, reply = _encode(reply)
+        return {"ok": True, "reply_type": reply_type, "reply": reply}
+
+
+class RemoteService:
+    """Stand-in for a BaseClient or BaseCyclicClient that calls through the daemon
+
+    service.ReadAllActions(request) returns the same message the real
+    client does.
+    """
+
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return functools.partial(self._client.rpc, self._name, method)
+
+
+class DaemonClient:
+    """Connection of a local tool to a running RobotDaemon
+
+    Only needs the standard library (and protobuf for rpc()), so tools
+    built on it start in milliseconds.
+
+    Arguments:
+    socket_path -- the daemon's Unix socket
+    timeout -- seconds to wait for a reply, None to wait as long as the command runs
+    """
+
+    def __init__(self, socket_path=SOCKET_PATH, timeout=None):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(socket_path)
+        self._file = self._socket.makefile("rwb")
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def request(self, op, **fields):
+        """Send one request, return the reply, raise RuntimeError if it failed"""
+        fields["op"] = op
+        self._file.write(json.dumps(fields).encode() + b"\n")
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise RuntimeError("The daemon closed the connection")
+        reply = json.loads(line)
+        if not reply["ok"]:
+            raise RuntimeError(reply["error"])
+        return reply
+
+    def command(self, text, color_code=None):
+        """Run a voiceass command, return whether it succeeded"""
+        return self.request("command", text=text, color=color_code)["success"]
+
+    def rpc(self, service, method, request=None):
+        request_type, payload = _encode(request)
+        reply = self.request("rpc", service=service, method=method, request_type=request_type, request=payload)
+        return _decode(reply["reply_type"], reply["reply"])
+
+    def service(self, name):
+        """RemoteService for "Base" or "BaseCyclic\""""
+        return RemoteService(self, name)
+
+    def status(self):
+        return self.request("status")
+
+    def shutdown(self):
+        self.request("shutdown")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep the arm's sessions open and share them between local tools")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="Unix socket of the daemon")
+    actions = parser.add_subparsers(dest="action")
+    actions.required = True
+    actions.add_parser("serve", help="connect to the arm and serve clients "
+                                     "(connection and voiceass options are accepted)")
+    send = actions.add_parser("send", help="run a voiceass command through the daemon")
+    send.add_argument("text", help="command, e.g. 'go home'")
+    send.add_argument("--color", default=None, help="color code for 'pick up'")
+    actions.add_parser("status", help="print the daemon's state")
+    actions.add_parser("shutdown", help="close the sessions and stop the daemon")
+    args, rest = parser.parse_known_args()
+
+    if args.action == "serve":
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+        import utilities
+        import voiceass
+        robot_args = utilities.parseConnectionArguments(voiceass.create_parser(), rest)
+        asyncio.run(RobotDaemon(robot_args, args.socket).serve())
+        return 0
+    if rest:
+        parser.error("unrecognized arguments: {}".format(" ".join(rest)))
+    with DaemonClient(args.socket) as client:
+        if args.action == "send":
+            success = client.command(args.text, args.color)
+            print("Done" if success else "Failed")
+            return 0 if success else 1
+        if args.action == "status":
+            for key, value in sorted(client.status().items()):
+                if key != "ok":
+                    print("{}: {}".format(key, value))
+        elif args.action == "shutdown":
+            client.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,227 @@
+import argparse
+import collections
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+import tracing
+
+# Default weights of the detector
+WEIGHTS = "yolov8n.pt"
+# Where exported models and the benchmark results are cached
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "kinova_detector")
+# Inference size the models are exported and warmed up at (pixels)
+IMAGE_SIZE = 640
+
+# Backends in the order they are tried when nothing was benchmarked yet:
+# name -> (ultralytics export format, module it needs, file or directory the export produces)
+BACKENDS = collections.OrderedDict([
+    ("openvino", ("openvino", "openvino", "{stem}_openvino_model")),
+    ("onnx", ("onnx", "onnxruntime", "{stem}.onnx")),
+    ("torch", (None, "torch", None)),
+])
+
+# Timings of one backend, in seconds: cold_start is loading the model,
+# warm_up the first inference, mean / p95 the steady-state inferences after it
+BenchmarkResult = collections.namedtuple("BenchmarkResult", [
+    "backend", "cold_start", "warm_up", "mean", "p95", "frames",
+])
+
+
+def weights_hash(path):
+    """Short SHA-256 of the weights file, exports are cached under it"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def available_backends():
+    return [name for name, (_, module, _) in BACKENDS.items() if importlib.util.find_spec(module) is not None]
+
+
+class Detector:
+    """YOLO model loaded on first use, optionally as a faster CPU export
+
+    Nothing is loaded when the Detector is created. load() (or the first
+    track() / predict()) loads the model, start() does it and runs a dummy
+    frame through it on a background thread, so the one-time warm-up cost
+    is paid while the camera connects.
+
+    With backend "onnx" or "openvino" the weights are exported once and the
+    export is cached under CACHE_DIR by weights hash, so changed weights are
+    exported again. "auto" takes the fastest backend of the last
+    benchmark() of these weights, or the first available one of BACKENDS.
+
+    Arguments:
+    weights -- YOLO .pt weights
+    backend -- "auto" or one of BACKENDS
+    cache_dir -- where exports and benchmark results are kept
+    image_size -- inference size (pixels)
+    """
+
+    def __init__(self, weights=WEIGHTS, backend="auto", cache_dir=CACHE_DIR, image_size=IMAGE_SIZE):
+        self.weights = weights
+        self.requested_backend = backend
+        self.cache_dir = cache_dir
+        self.image_size = image_size
+        self.backend = None
+        self.model = None
+        self.load_time = None
+        self.warm_up_time = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+
+    @property
+    def names(self):
+        return self.load().names
+
+    def start(self):
+        """Load and warm up the model on a background thread"""
+        if self._thread is None and not self._ready.is_set():
+            self._thread = threading.Thread(target=self.warm_up, name="detector", daemon=True)
+            self._thread.start()
+        return self
+
+    def wait_ready(self, timeout=None):
+        """Block until the model is loaded and warmed up, return False on timeout"""
+        return self._ready.wait(timeout)
+
+    def load(self):
+        with self._lock:
+            if self.model is None:
+                from ultralytics import YOLO
+                backend = self._choose_backend()
+                path = self._model_path(backend)
+                started = time.perf_counter()
+                self.model = YOLO(path, task="detect")
+                self.load_time = time.perf_counter() - started
+                self.backend = backend
+                print("Loaded {} ({} backend) in {:.2f}s".format(path, backend, self.load_time))
+            return self.model
+
+    def warm_up(self):
+        model = self.load()
+        with self._lock:
+            if not self._ready.is_set():
+                started = time.perf_counter()
+                model.predict(np.zeros((self.image_size, self.image_size, 3), np.uint8),
+                              imgsz=self.image_size, verbose=False)
+                self.warm_up_time = time.perf_counter() - started
+                self._ready.set()
+        return self
+
+    @tracing.traced("inference")
+    def track(self, frame, **kwargs):
+        if not self._ready.is_set():
+            self.warm_up()
+        kwargs.setdefault("imgsz", self.image_size)
+        return self.model.track(frame, persist=True, verbose=False, **kwargs)
+
+    @tracing.traced("inference")
+    def predict(self, frame, **kwargs):
+        if not self._ready.is_set():
+            self.warm_up()
+        kwargs.setdefault("imgsz", self.image_size)
+        return self.model.predict(frame, verbose=False, **kwargs)
+
+    def _cache_path(self, *names):
+        return os.path.join(self.cache_dir, weights_hash(self.weights), *names)
+
+    def _choose_backend(self):
+        available = available_backends()
+        if self.requested_backend != "auto":
+            if self.requested_backend not in available:
+                raise ValueError("Backend {} isn't available here, only {}".format(self.requested_backend, available))
+            return self.requested_backend
+        fastest = load_benchmark(self)
+        if fastest:
+            for result in sorted(fastest, key=lambda result: result.mean):
+                if result.backend in available:
+                    return result.backend
+        return available[0]
+
+    def _model_path(self, backend):
+        export_format, _, produced = BACKENDS[backend]
+        if export_format is None:
+            return self.weights
+        from ultralytics import YOLO
+        if not os.path.exists(self.weights):
+            # Let ultralytics download the stock weights, they have to be hashed
+            YOLO(self.weights)
+        stem = os.path.splitext(os.path.basename(self.weights))[0]
+        cached = self._cache_path(produced.format(stem=stem))
+        if not os.path.exists(cached):
+            print("Exporting {} to {}, done once for these weights".format(self.weights, export_format))
+            # Dynamic input shapes, so smaller inference sizes can be used (see roi.py)
+            exported = YOLO(self.weights).export(format=export_format, imgsz=self.image_size, dynamic=True)
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            shutil.move(str(exported), cached)
+        return cached
+
+
+def load_benchmark(detector):
+    """BenchmarkResults last saved for the detector's weights, None if never benchmarked"""
+    if not os.path.exists(detector.weights):
+        return None
+    path = detector._cache_path("benchmark.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return [BenchmarkResult(**result) for result in json.load(f)]
+
+
+def benchmark(weights=WEIGHTS, backends=None, frames=50, cache_dir=CACHE_DIR, image_size=IMAGE_SIZE):
+    """Time every backend on this host and save the results for Detector(backend="auto")
+
+    Exports are made (and cached) before timing, cold_start only covers
+    loading the model.
+    """
+    backends = backends or available_backends()
+    frame = np.random.default_rng(0).integers(0, 255, (480, 640, 3), dtype=np.uint8)
+    results = []
+    for backend in backends:
+        detector = Detector(weights, backend, cache_dir, image_size)
+        detector._model_path(detector._choose_backend())
+        detector.warm_up()
+        times = []
+        for _ in range(frames):
+            started = time.perf_counter()
+            detector.predict(frame)
+            times.append(time.perf_counter() - started)
+        results.append(BenchmarkResult(backend, detector.load_time, detector.warm_up_time,
+                                       float(np.mean(times)), float(np.percentile(times, 95)), frames))
+    path = Detector(weights, cache_dir=cache_dir)._cache_path("benchmark.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump([result._asdict() for result in results], f, indent=2)
+    return results
+
+
+def print_benchmark(results):
+    print("backend    cold start   warm-up    mean     p95")
+    for result in results:
+        print("{:<10} {:9.3f}s {:8.3f}s {:6.1f}ms {:6.1f}ms".format(
+            result.backend, result.cold_start, result.warm_up, result.mean * 1000, result.p95 * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the detector backends on this host")
+    parser.add_argument("--weights", default=WEIGHTS)
+    parser.add_argument("--backend", action="append", choices=list(BACKENDS),
+                        help="backend to time, can be repeated (default: every available one)")
+    parser.add_argument("--frames", type=int, default=50, help="steady-state inferences per backend")
+    args = parser.parse_args()
+    print_benchmark(benchmark(args.weights, args.backend, args.frames))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+
+import tracing
+
+# Default number of commands that can wait behind the running one
+MAX_QUEUED_COMMANDS = 8
+
+# A submitted command, handler(*args) runs on the robot worker thread,
+# done is an optional asyncio future given the handler's result
+Command = collections.namedtuple("Command", ["name", "handler", "args", "priority", "submitted", "done"])
+
+
+def _call(command):
+    # Runs on the robot thread, so the command's RPCs and waits nest in its span
+    with tracing.span("command", command.name):
+        return command.handler(*command.args)
+
+
+def _resolve(done, result):
+    if done is not None and not done.done():
+        done.set_result(result)
+
+
+class CommandExecutor:
+    """Runs blocking Kortex commands one at a time without blocking the event loop
+
+    Normal commands wait their turn in a bounded queue. A priority command
+    (e.g. "stop") sets cancelled, calls stop() to abort the running action,
+    drops every queued command and runs next. Handlers check cancelled
+    between their steps and give up once it is set; it is cleared before
+    every command.
+
+    Arguments:
+    base -- BaseClient used to stop the running action
+    max_queued -- commands allowed to wait, submit() refuses more
+    cancelled -- threading.Event the handlers check, a new one if None
+    stop -- called (on another thread than the handler's) to stop the
+        running motion, base.Stop if None
+    """
+
+    def __init__(self, base, max_queued=MAX_QUEUED_COMMANDS, cancelled=None, stop=None):
+        self.base = base
+        self.max_queued = max_queued
+        self.cancelled = cancelled if cancelled is not None else threading.Event()
+        self.stop = stop or base.Stop
+        self.success = True
+        self._closing = False
+        self._queue = None
+        self._current = None
+        # Kortex calls of the commands all run on this one thread, in order
+        self._robot_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="robot")
+
+    def _get_queue(self):
+        # Created lazily so it belongs to the running loop
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_queued)
+        return self._queue
+
+    def busy(self):
+        return self._current is not None
+
+    async def submit(self, name, handler, *args, priority=False, done=None):
+        """Queue handler(*args), return False if the queue is full
+
+        done, an asyncio future, is given the handler's result once it ran
+        (False if it raised, None if the command was dropped).
+        """
+        queue = self._get_queue()
+        command = Command(name, handler, args, priority, time.monotonic(), done)
+        if priority:
+            await self.preempt()
+        if self._closing:
+            # It would be queued behind the end of run()
+            print("Closing, dropping command '{}'".format(name))
+            _resolve(done, None)
+            return False
+        try:
+            queue.put_nowait(command)
+        except asyncio.QueueFull:
+            print("Busy, dropping command '{}' ({} commands queued)".format(name, queue.qsize()))
+            _resolve(done, None)
+            return False
+        if self.busy():
+            print("Command '{}' queued behind '{}'".format(name, self._current.name))
+        return True
+
+    async def execute(self, name, handler, *args, priority=False):
+        """Queue handler(*args) and wait until it ran, return its result (None if it was dropped)"""
+        done = asyncio.get_running_loop().create_future()
+        await self.submit(name, handler, *args, priority=priority, done=done)
+        return await done
+
+    async def preempt(self):
+        """Drop the queued commands and stop the running action
+
+        A close() already queued is kept, run() still ends.
+        """
+        queue = self._get_queue()
+        dropped = []
+        while not queue.empty():
+            dropped.append(queue.get_nowait())
+            queue.task_done()
+        for command in dropped:
+            if command is not None:
+                print("Cancelled queued command '{}'".format(command.name))
+                _resolve(command.done, None)
+        if None in dropped:
+            queue.put_nowait(None)
+        if self.busy():
+            print("Stopping '{}'".format(self._current.name))
+            # Set first, so the handler doesn't start its next step after the stop
+            self.cancelled.set()
+            # The robot thread is blocked in the running command, stop from another one
+            await asyncio.get_running_loop().run_in_executor(None, self.stop)
+
+    async def join(self):
+        """Wait until every queued command has run"""
+        await self._get_queue().join()
+
+    async def close(self):
+        """Stop the run() loop once the queued commands are done"""
+        self._closing = True
+        await self._get_queue().put(None)
+
+    async def run(self):
+        """Worker loop, run it as a task next to the input loop"""
+        queue = self._get_queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            command = await queue.get()
+            if command is None:
+                queue.task_done()
+                break
+            self._current = command
+            self.cancelled.clear()
+            started = time.monotonic()
+            result = False
+            try:
+                result = await loop.run_in_executor(self._robot_thread, _call, command)
+                self.success &= bool(result)
+            except (Exception, SystemExit) as e:
+                # Not even a handler's sys.exit() ends the loop, the session has to be closed properly
+                print("Command '{}' failed: {!r}".format(command.name, e))
+                self.success = False
+            finally:
+                _resolve(command.done, result)
+                self._current = None
+                queue.task_done()
+            finished = time.monotonic()
+            print("Command '{}' waited {:.3f}s, ran {:.3f}s".format(
+                command.name, started - command.submitted, finished - started))
+        self._robot_thread.shutdown(wait=True)
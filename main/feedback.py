@@ -0,0 +1,146 @@
+import collections
+import threading
+import time
+
+import numpy as np
+
+# Default polling rate of RefreshFeedback (Hz)
+FEEDBACK_RATE = 100.0
+# Default length of the kept history (seconds)
+HISTORY_DURATION = 60.0
+
+# One feedback sample (or, from history(), arrays of them, oldest first).
+# tool_pose is [x, y, z, theta_x, theta_y, theta_z] (meters, degrees), joint
+# angles in degrees, joint velocities in deg/s, timestamp from time.monotonic().
+FeedbackSample = collections.namedtuple("FeedbackSample", [
+    "timestamp", "tool_pose", "joint_angles", "joint_velocities", "gripper_position",
+])
+
+
+class FeedbackMonitor:
+    """Polls RefreshFeedback on a background thread into a NumPy ring buffer
+
+    Every row of the preallocated buffer holds one sample: timestamp, tool
+    pose, joint angles, joint velocities and gripper position. The writer
+    fills a row completely before publishing its index, so latest() reads it
+    without taking a lock. history() returns a copy of the last seconds.
+
+    Arguments:
+    base_cyclic -- BaseCyclicClient to poll
+    rate -- polls per second
+    history_duration -- seconds of samples kept
+    recorder -- optional TelemetryRecorder every polled feedback is recorded to
+    """
+
+    def __init__(self, base_cyclic, rate=FEEDBACK_RATE, history_duration=HISTORY_DURATION, recorder=None):
+        self.base_cyclic = base_cyclic
+        self.recorder = recorder
+        self.rate = rate
+        self.capacity = int(rate * history_duration)
+        self.actuator_count = None
+        self.errors = 0
+        self._buffer = None
+        self._columns = None
+        self._count = 0
+        self._latest = -1
+        self._running = False
+        self._thread = None
+        self._updated = threading.Condition()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self._thread is None:
+            # The first poll is synchronous so latest() is valid as soon as start() returns
+            feedback = self.base_cyclic.RefreshFeedback()
+            self.actuator_count = len(feedback.actuators)
+            n = self.actuator_count
+            # timestamp, pose (6), joint angles (n), joint velocities (n), gripper
+            self._buffer = np.zeros((self.capacity, 8 + 2 * n))
+            self._columns = (slice(0, 1), slice(1, 7), slice(7, 7 + n), slice(7 + n, 7 + 2 * n),
+                             slice(7 + 2 * n, 8 + 2 * n))
+            self._store(feedback, time.monotonic())
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="feedback", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def latest(self, max_age=None):
+        """Return the newest FeedbackSample, None if it is older than max_age seconds"""
+        index = self._latest
+        if index < 0:
+            return None
+        sample = self._sample(self._buffer[index].copy())
+        if max_age is not None and time.monotonic() - sample.timestamp > max_age:
+            return None
+        return sample
+
+    def wait_next(self, after, timeout=None):
+        """Block until a sample newer than the time.monotonic() value 'after' is stored"""
+        with self._updated:
+            return self._updated.wait_for(lambda: self.latest().timestamp > after, timeout)
+
+    def history(self, seconds):
+        """Return the samples of the last seconds as a FeedbackSample of arrays, oldest first"""
+        end = self._latest + 1
+        # The oldest row of a full buffer is the one being overwritten next, skip it
+        count = min(self._count, self.capacity - 1)
+        if count == 0:
+            return None
+        order = np.arange(end - count, end) % self.capacity
+        rows = self._buffer[order]
+        rows = rows[rows[:, 0] >= time.monotonic() - seconds]
+        return self._sample(rows)
+
+    def _sample(self, rows):
+        timestamps, pose, angles, velocities, gripper = (rows[..., column] for column in self._columns)
+        if rows.ndim == 1:
+            return FeedbackSample(float(timestamps[0]), pose, angles, velocities, float(gripper[0]))
+        return FeedbackSample(timestamps[:, 0], pose, angles, velocities, gripper[:, 0])
+
+    def _store(self, feedback, timestamp):
+        index = (self._latest + 1) % self.capacity
+        row = self._buffer[index]
+        base = feedback.base
+        row[0] = timestamp
+        row[1:7] = (base.tool_pose_x, base.tool_pose_y, base.tool_pose_z,
+                    base.tool_pose_theta_x, base.tool_pose_theta_y, base.tool_pose_theta_z)
+        n = self.actuator_count
+        row[7:7 + n] = [actuator.position for actuator in feedback.actuators]
+        row[7 + n:7 + 2 * n] = [actuator.velocity for actuator in feedback.actuators]
+        motors = feedback.interconnect.gripper_feedback.motor
+        row[7 + 2 * n] = motors[0].position if len(motors) else np.nan
+        # Publish only once the row is complete
+        self._latest = index
+        self._count += 1
+        with self._updated:
+            self._updated.notify_all()
+
+    def _run(self):
+        period = 1.0 / self.rate
+        next_poll = time.monotonic()
+        while self._running:
+            next_poll += period
+            try:
+                feedback = self.base_cyclic.RefreshFeedback()
+                self._store(feedback, time.monotonic())
+                if self.recorder is not None:
+                    self.recorder.record_feedback(feedback)
+            except Exception as e:
+                self.errors += 1
+                print("Feedback poll failed: {}".format(e))
+            delay = next_poll - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_poll = time.monotonic()
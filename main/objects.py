@@ -0,0 +1,127 @@
+import collections
+import threading
+import time
+
+import numpy as np
+
+# Weight of a new measurement in the smoothed bbox, distance and position
+SMOOTHING = 0.4
+# Seconds after which a track that wasn't seen again is forgotten
+TRACK_TIMEOUT = 2.0
+
+# State of one tracked object. bbox is [xmin, ymin, xmax, ymax] (pixels),
+# position [x, y, z] in the camera frame (meters, NaN if unknown), bbox,
+# distance and position are smoothed, first_seen / last_seen are
+# time.monotonic() values and hits the number of frames it was seen in.
+TrackedObject = collections.namedtuple("TrackedObject", [
+    "track_id", "class_name", "confidence", "bbox", "distance", "position", "first_seen", "last_seen", "hits",
+])
+
+
+def _smooth(old, new, alpha):
+    # Exponential smoothing where a NaN measurement (or estimate) is ignored
+    return np.where(np.isnan(old), new, np.where(np.isnan(new), old, old + alpha * (new - old)))
+
+
+class _Track:
+    __slots__ = ("class_name", "confidence", "bbox", "distance", "position", "first_seen", "last_seen", "hits")
+
+    def __init__(self, class_name, confidence, bbox, distance, position, now):
+        self.class_name = class_name
+        self.confidence = confidence
+        self.bbox = np.array(bbox, dtype=float)
+        self.distance = distance
+        self.position = np.array(position, dtype=float)
+        self.first_seen = now
+        self.last_seen = now
+        self.hits = 1
+
+
+class ObjectRegistry:
+    """Objects seen by the camera, keyed by the tracker's IDs
+
+    Every update() refreshes the tracks of one frame in O(1) each: bbox,
+    distance and position are exponentially smoothed (a new measurement
+    weighs smoothing, a NaN one is ignored),
+    tracks not seen for timeout seconds are dropped. Every object of a class
+    is kept, not only the first one. Safe to query from another thread
+    (e.g. the manipulation code) while the vision loop updates it.
+
+    Arguments:
+    smoothing -- weight of a new measurement, 1 disables smoothing
+    timeout -- seconds after which an unseen track expires
+    """
+
+    def __init__(self, smoothing=SMOOTHING, timeout=TRACK_TIMEOUT):
+        self.smoothing = smoothing
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._tracks = {}
+        self._by_class = collections.defaultdict(set)
+        # Every class ever seen, with the number of tracks it had
+        self.seen_classes = collections.Counter()
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def update(self, track_ids, class_names, confidences, bboxes, distances, positions=None, now=None):
+        """Add the detections of one frame, all arguments have one entry per detection"""
+        now = time.monotonic() if now is None else now
+        alpha = self.smoothing
+        if positions is None:
+            positions = np.full((len(bboxes), 3), np.nan)
+        with self._lock:
+            for track_id, class_name, confidence, bbox, distance, position in zip(
+                    track_ids, class_names, confidences, bboxes, distances, positions):
+                track_id = int(track_id)
+                track = self._tracks.get(track_id)
+                if track is None or track.class_name != class_name:
+                    if track is not None:
+                        self._by_class[track.class_name].discard(track_id)
+                    else:
+                        self.seen_classes[class_name] += 1
+                    self._tracks[track_id] = _Track(class_name, float(confidence), bbox, float(distance), position,
+                                                    now)
+                    self._by_class[class_name].add(track_id)
+                    continue
+                track.bbox += alpha * (np.asarray(bbox, dtype=float) - track.bbox)
+                track.distance = float(_smooth(track.distance, float(distance), alpha))
+                track.position = _smooth(track.position, np.asarray(position, dtype=float), alpha)
+                track.confidence = float(confidence)
+                track.last_seen = now
+                track.hits += 1
+            self._expire(now)
+
+    def get(self, track_id):
+        with self._lock:
+            track = self._tracks.get(track_id)
+            return None if track is None else self._object(track_id, track)
+
+    def objects(self, class_name=None):
+        """Every live object, or only those of class_name"""
+        with self._lock:
+            ids = self._tracks if class_name is None else self._by_class.get(class_name, ())
+            return [self._object(track_id, self._tracks[track_id]) for track_id in ids]
+
+    def nearest(self, class_name=None):
+        """Closest live object (of class_name if given), None if there is none"""
+        objects = [obj for obj in self.objects(class_name) if not np.isnan(obj.distance)]
+        return min(objects, key=lambda obj: obj.distance) if objects else None
+
+    def within(self, distance, class_name=None):
+        """Live objects (of class_name if given) closer than distance, nearest first"""
+        return sorted((obj for obj in self.objects(class_name) if obj.distance <= distance),
+                      key=lambda obj: obj.distance)
+
+    def expire(self, now=None):
+        with self._lock:
+            self._expire(time.monotonic() if now is None else now)
+
+    def _expire(self, now):
+        stale = [track_id for track_id, track in self._tracks.items() if now - track.last_seen > self.timeout]
+        for track_id in stale:
+            self._by_class[self._tracks.pop(track_id).class_name].discard(track_id)
+
+    def _object(self, track_id, track):
+        return TrackedObject(track_id, track.class_name, track.confidence, track.bbox.copy(), track.distance,
+                             track.position.copy(), track.first_seen, track.last_seen, track.hits)
@@ -0,0 +1,164 @@
+import collections
+import threading
+import time
+
+# Seconds of history the frame rates are measured over
+RATE_WINDOW = 2.0
+
+# Output of the inference stage. captured and inferred are time.monotonic()
+# values of the frame capture and of the end of inference.
+InferenceResult = collections.namedtuple("InferenceResult", ["frame", "result", "captured", "inferred"])
+
+# Frame rates of every stage (frames per second), end-to-end latency from
+# capture to the end of the last stage (seconds) and frames dropped between
+# inference and the last stage.
+PipelineStats = collections.namedtuple("PipelineStats", [
+    "capture_fps", "inference_fps", "output_fps", "latency_mean", "latency_max", "dropped",
+])
+
+
+class DropOldestQueue:
+    """Bounded queue whose put() never blocks, the oldest item is dropped instead
+
+    Arguments:
+    maxsize -- number of items kept
+    """
+
+    def __init__(self, maxsize=1):
+        self._items = collections.deque(maxlen=maxsize)
+        self._condition = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self._condition:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+            self._items.append(item)
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """Return the oldest item, None if there is none after timeout seconds"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._items, timeout):
+                return None
+            return self._items.popleft()
+
+
+class RateMeter:
+    """Events per second over the last RATE_WINDOW seconds
+
+    tick() counts one event, or takes the running total of an external
+    counter (e.g. the frames a CameraService read) to count several.
+    """
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self._total = 0
+        self._ticks = collections.deque()
+
+    def tick(self, now=None, total=None):
+        now = time.monotonic() if now is None else now
+        self._total = self._total + 1 if total is None else total
+        self._ticks.append((now, self._total))
+        while now - self._ticks[0][0] > self.window:
+            self._ticks.popleft()
+
+    def rate(self):
+        if len(self._ticks) < 2 or self._ticks[-1][0] == self._ticks[0][0]:
+            return 0.0
+        (first_time, first_total), (last_time, last_total) = self._ticks[0], self._ticks[-1]
+        return (last_total - first_total) / (last_time - first_time)
+
+
+class VisionPipeline:
+    """Capture, inference and output running at their own pace
+
+    Capture is a CameraService, which only keeps the newest frame, so a slow
+    model never makes the stream back up: the inference thread always takes
+    the newest frame it hasn't seen yet. Its results go through a
+    DropOldestQueue of queue_size to the output stage, the caller's loop
+    calling get() and done() (drawing and cv2.imshow() have to stay on the
+    main thread), which only ever sees recent results.
+
+    Arguments:
+    camera -- started CameraService
+    infer -- called as infer(frame) on the inference thread, its return
+        value is the InferenceResult's result
+    queue_size -- results kept for the output stage
+    """
+
+    def __init__(self, camera, infer, queue_size=1):
+        self.camera = camera
+        self.infer = infer
+        self.results = DropOldestQueue(queue_size)
+        self.errors = 0
+        self._capture_rate = RateMeter()
+        self._inference_rate = RateMeter()
+        self._output_rate = RateMeter()
+        self._latencies = collections.deque(maxlen=100)
+        self._running = False
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="inference", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get(self, timeout=1.0):
+        """Return the next InferenceResult, None on timeout"""
+        return self.results.get(timeout)
+
+    def done(self, item):
+        """Mark item as fully handled by the output stage, for its frame rate and the end-to-end latency"""
+        now = time.monotonic()
+        self._output_rate.tick(now)
+        self._latencies.append(now - item.captured)
+
+    def stats(self):
+        latencies = list(self._latencies)
+        return PipelineStats(
+            capture_fps=self._capture_rate.rate(),
+            inference_fps=self._inference_rate.rate(),
+            output_fps=self._output_rate.rate(),
+            latency_mean=sum(latencies) / len(latencies) if latencies else 0.0,
+            latency_max=max(latencies) if latencies else 0.0,
+            dropped=self.results.dropped,
+        )
+
+    def _run(self):
+        last = None
+        while self._running:
+            captured, frame = self.camera.latest_frame(after=last, timeout=1.0)
+            if frame is None:
+                continue
+            self._capture_rate.tick(captured, self.camera.frames)
+            last = captured
+            try:
+                result = self.infer(frame)
+            except Exception as e:
+                self.errors += 1
+                print("Inference failed: {}".format(e))
+                continue
+            inferred = time.monotonic()
+            self._inference_rate.tick(inferred)
+            self.results.put(InferenceResult(frame, result, captured, inferred))
+
+
+def print_pipeline_stats(stats):
+    print("capture {:.1f} fps, inference {:.1f} fps, output {:.1f} fps, latency {:.0f} ms (max {:.0f}), "
+          "{} dropped".format(stats.capture_fps, stats.inference_fps, stats.output_fps,
+                              stats.latency_mean * 1000, stats.latency_max * 1000, stats.dropped))
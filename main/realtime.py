@@ -0,0 +1,220 @@
+import collections
+import concurrent.futures
+import time
+
+import numpy as np
+from kortex_api.RouterClient import RouterClientSendOptions
+from kortex_api.autogen.messages import Base_pb2, BaseCyclic_pb2
+
+# Period of the low-level joint loop over the UDP router (seconds)
+JOINT_LOOP_PERIOD = 0.001
+# Period at which twist commands are re-sent in single-level servoing (seconds)
+TWIST_LOOP_PERIOD = 0.01
+# Speed limits used to turn a pose delta into a timed Cartesian jog
+MAX_LINEAR_SPEED = 0.1    # (meters per second)
+MAX_ANGULAR_SPEED = 30.0  # (degrees per second)
+# Time taken to bring joint velocities back to zero before leaving low-level servoing
+RAMP_DOWN_DURATION = 0.1
+# Below this, time.sleep() overshoots too much and the loop spins instead
+SPIN_THRESHOLD = 0.0005
+# UDP frames in a row that may go unanswered before a joint jog gives up
+MAX_LOST_FRAMES = 50
+
+# Timing of one fixed-period loop, in seconds. deadline_misses counts cycles
+# whose work ran past the start of the next cycle, lost_frames the UDP
+# commands whose feedback didn't come back in time.
+LoopMetrics = collections.namedtuple("LoopMetrics", [
+    "cycles", "period", "mean_period", "max_jitter", "mean_jitter", "deadline_misses", "duration", "lost_frames",
+])
+
+
+class _LoopTimer:
+    # Paces a loop at a fixed period and records its jitter
+
+    def __init__(self, period):
+        self.period = period
+        self.starts = []
+        self.misses = 0
+        self.lost = 0
+        self._next = None
+
+    def wait(self):
+        now = time.perf_counter()
+        if self._next is None:
+            self._next = now
+        else:
+            self._next += self.period
+            if now > self._next:
+                self.misses += 1
+                # Don't try to catch up, restart the schedule from here
+                self._next = now
+            else:
+                remaining = self._next - now
+                if remaining > SPIN_THRESHOLD:
+                    time.sleep(remaining - SPIN_THRESHOLD)
+                while time.perf_counter() < self._next:
+                    pass
+        self.starts.append(time.perf_counter())
+
+    def metrics(self):
+        starts = np.array(self.starts)
+        if len(starts) < 2:
+            return LoopMetrics(len(starts), self.period, 0.0, 0.0, 0.0, self.misses, 0.0, self.lost)
+        periods = np.diff(starts)
+        jitter = np.abs(periods - self.period)
+        return LoopMetrics(
+            cycles=len(starts),
+            period=self.period,
+            mean_period=float(periods.mean()),
+            max_jitter=float(jitter.max()),
+            mean_jitter=float(jitter.mean()),
+            deadline_misses=self.misses,
+            duration=float(starts[-1] - starts[0]),
+            lost_frames=self.lost,
+        )
+
+
+def print_loop_metrics(name, metrics):
+    print("{}: {} cycles in {:.3f}s, period {:.3f} ms (target {:.3f}), jitter mean {:.3f} / max {:.3f} ms, "
+          "{} deadline misses, {} lost frames".format(
+              name, metrics.cycles, metrics.duration, metrics.mean_period * 1000, metrics.period * 1000,
+              metrics.mean_jitter * 1000, metrics.max_jitter * 1000, metrics.deadline_misses, metrics.lost_frames))
+
+
+class RealTimeJogger:
+    """Velocity jogging without the high-level action planner
+
+    Joint jogs switch the arm to LOW_LEVEL_SERVOING and stream position
+    setpoints (integrated from the joint velocities) through the
+    BaseCyclicClient of the UDP router at JOINT_LOOP_PERIOD. The velocities
+    are ramped down and the arm is put back in SINGLE_LEVEL_SERVOING when the
+    jog ends, also on errors. A frame whose feedback doesn't come back in
+    time is counted and skipped, MAX_LOST_FRAMES in a row end the jog.
+
+    The arm has no Cartesian low-level interface (it would need inverse
+    kinematics every cycle), so Cartesian jogs stream SendTwistCommand in
+    single-level servoing at TWIST_LOOP_PERIOD and end with base.Stop().
+
+    When cancelled is set both loops stop early (joint jogs still ramp
+    down) and jog_delta() returns False. The metrics of the last loop are
+    kept in last_metrics.
+
+    Arguments:
+    base -- BaseClient (TCP router)
+    base_cyclic_rt -- BaseCyclicClient created on the UDP router
+    actions -- ActionRegistry of the session, keeps track of the servoing mode
+    recorder -- optional TelemetryRecorder the feedback of every cycle is recorded to
+    cancelled -- optional threading.Event of the session's preempted commands
+    """
+
+    def __init__(self, base, base_cyclic_rt, actions, recorder=None, cancelled=None):
+        self.base = base
+        self.base_cyclic_rt = base_cyclic_rt
+        self.actions = actions
+        self.recorder = recorder
+        self.cancelled = cancelled
+        self.last_metrics = None
+        self._send_options = RouterClientSendOptions()
+        self._send_options.andForget = False
+        self._send_options.delay_ms = 0
+        # A lost UDP frame must not stall the loop
+        self._send_options.timeout_ms = 3
+
+    def _interrupted(self):
+        return self.cancelled is not None and self.cancelled.is_set()
+
+    def jog_joints(self, velocities, duration, period=JOINT_LOOP_PERIOD):
+        """Move the joints at velocities (deg/s from the base joint up, missing ones stay still) for duration seconds"""
+        feedback = self.base_cyclic_rt.RefreshFeedback()
+        positions = np.array([actuator.position for actuator in feedback.actuators])
+        if len(velocities) > len(positions):
+            raise ValueError("The arm has {} joints, got {} velocities".format(len(positions), len(velocities)))
+        velocities = np.concatenate([np.asarray(velocities, dtype=float), np.zeros(len(positions) - len(velocities))])
+
+        command = BaseCyclic_pb2.Command()
+        for position in positions:
+            actuator_command = command.actuators.add()
+            actuator_command.flags = 1  # servoing
+            actuator_command.position = position
+
+        timer = _LoopTimer(period)
+        self.actions.set_servoing_mode(Base_pb2.LOW_LEVEL_SERVOING)
+        try:
+            frame_id = 0
+            lost = 0
+            started = time.perf_counter()
+            ramp_start = started + duration
+            ramp_end = ramp_start + RAMP_DOWN_DURATION
+            while True:
+                timer.wait()
+                now = time.perf_counter()
+                if now < ramp_start and self._interrupted():
+                    # Cancelled, ramp down from here
+                    ramp_start, ramp_end = now, now + RAMP_DOWN_DURATION
+                if now >= ramp_end:
+                    break
+                # Full speed, then a linear ramp to zero so the arm isn't jerked to a stop
+                scale = 1.0 if now < ramp_start else (ramp_end - now) / RAMP_DOWN_DURATION
+                positions = (positions + velocities * scale * period) % 360.0
+                frame_id = (frame_id + 1) & 0xffff
+                command.frame_id = frame_id
+                for actuator_command, position, velocity in zip(command.actuators, positions, velocities):
+                    actuator_command.command_id = frame_id
+                    actuator_command.position = position
+                    actuator_command.velocity = velocity * scale
+                try:
+                    feedback = self.base_cyclic_rt.Refresh(command, 0, self._send_options)
+                except concurrent.futures.TimeoutError:
+                    # A lost frame, the next setpoint supersedes it
+                    timer.lost += 1
+                    lost += 1
+                    if lost >= MAX_LOST_FRAMES:
+                        raise
+                    continue
+                lost = 0
+                if self.recorder is not None:
+                    self.recorder.record_feedback(feedback)
+        finally:
+            self.actions.set_servoing_mode(Base_pb2.SINGLE_LEVEL_SERVOING)
+            self.last_metrics = timer.metrics()
+        return self.last_metrics
+
+    def jog_twist(self, twist, duration, period=TWIST_LOOP_PERIOD):
+        """Move the tool at twist (m/s and deg/s, base frame) for duration seconds"""
+        twist_command = Base_pb2.TwistCommand()
+        twist_command.reference_frame = Base_pb2.CARTESIAN_REFERENCE_FRAME_BASE
+        twist_command.duration = 0
+        (twist_command.twist.linear_x, twist_command.twist.linear_y, twist_command.twist.linear_z,
+         twist_command.twist.angular_x, twist_command.twist.angular_y, twist_command.twist.angular_z) = \
+            [float(value) for value in twist]
+
+        timer = _LoopTimer(period)
+        self.actions.set_servoing_mode(Base_pb2.SINGLE_LEVEL_SERVOING)
+        try:
+            end = time.perf_counter() + duration
+            while True:
+                timer.wait()
+                if time.perf_counter() >= end or self._interrupted():
+                    break
+                self.base.SendTwistCommand(twist_command)
+        except Exception:
+            # E.g. another client changed the servoing mode under us
+            self.actions.forget_servoing_mode()
+            raise
+        finally:
+            self.base.Stop()
+            self.last_metrics = timer.metrics()
+        return self.last_metrics
+
+    def jog_delta(self, delta):
+        """Cartesian jog by a pose delta [x, y, z, theta_x, theta_y, theta_z] at the speed limits
+
+        Returns False when the jog was cancelled.
+        """
+        delta = np.asarray(delta, dtype=float)
+        duration = max(np.abs(delta[:3]).max() / MAX_LINEAR_SPEED, np.abs(delta[3:]).max() / MAX_ANGULAR_SPEED)
+        if duration == 0:
+            return True
+        metrics = self.jog_twist(delta / duration, duration)
+        print_loop_metrics("Twist jog", metrics)
+        return not self._interrupted()
@@ -0,0 +1,292 @@
+import collections
+import glob
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# Records per chunk file before rolling over to a new one
+CHUNK_RECORDS = 1 << 20
+# A chunk is also closed after this many seconds, even if not full
+CHUNK_DURATION = 3600.0
+# Pending records above which new ones are dropped rather than queued
+MAX_PENDING = 100000
+# Period of the writer thread (seconds)
+FLUSH_PERIOD = 0.1
+# Length of the text column of event records (bytes)
+EVENT_TEXT_LENGTH = 32
+
+# Kinds of event record
+EVENT_ACTION = 1      # code: ActionEvent, identifier: action handle
+EVENT_SEQUENCE = 2    # code: EventIdSequenceInfoNotification, identifier: task index
+EVENT_COMMAND = 3     # text: command name
+EVENT_VISION = 4      # text: color, value: confidence, identifier: slot
+
+EVENT_DTYPE = np.dtype([
+    ("timestamp", "<f8"), ("kind", "u1"), ("code", "<i4"), ("identifier", "<u4"),
+    ("value", "<f4"), ("text", "S{}".format(EVENT_TEXT_LENGTH)),
+])
+
+
+def feedback_dtype(actuator_count):
+    """Record layout of one BaseCyclic feedback sample"""
+    return np.dtype([
+        ("timestamp", "<f8"), ("tool_pose", "<f8", (6,)),
+        ("joint_angles", "<f4", (actuator_count,)), ("joint_velocities", "<f4", (actuator_count,)),
+        ("joint_torques", "<f4", (actuator_count,)), ("gripper_position", "<f4"),
+    ])
+
+
+# One chunk file of a stream, as listed in the stream's manifest
+Chunk = collections.namedtuple("Chunk", ["path", "start", "end", "count"])
+
+
+class _Stream:
+    # Append-only sequence of fixed-size records split over memory-mapped chunk files.
+    # Only used from the writer thread.
+
+    def __init__(self, directory, name, dtype, chunk_records, chunk_duration):
+        self.directory = directory
+        self.name = name
+        self.dtype = dtype
+        self.chunk_records = chunk_records
+        self.chunk_duration = chunk_duration
+        self.chunks = []
+        self._map = None
+        self._count = 0
+        self._opened_at = None
+        self._manifest = os.path.join(directory, name + ".json")
+        if os.path.exists(self._manifest):
+            with open(self._manifest) as f:
+                self.chunks = [Chunk(**chunk) for chunk in json.load(f)["chunks"]]
+
+    def append(self, records):
+        while len(records):
+            if self._map is None or self._count == self.chunk_records or \
+                    time.monotonic() - self._opened_at > self.chunk_duration:
+                self._roll_over()
+            count = min(len(records), self.chunk_records - self._count)
+            self._map[self._count:self._count + count] = records[:count]
+            self._count += count
+            records = records[count:]
+
+    def flush(self):
+        if self._map is None or self._count == 0:
+            return
+        self._map.flush()
+        timestamps = self._map["timestamp"]
+        self.chunks[-1] = self.chunks[-1]._replace(
+            start=float(timestamps[0]), end=float(timestamps[self._count - 1]), count=self._count)
+        self._write_manifest()
+
+    def close(self):
+        self.flush()
+        if self._map is not None:
+            path = self.chunks[-1].path
+            # Give back the unused end of the last chunk
+            del self._map
+            self._map = None
+            with open(os.path.join(self.directory, path), "r+b") as f:
+                f.truncate(self._count * self.dtype.itemsize)
+            if self._count == 0:
+                os.remove(os.path.join(self.directory, path))
+                self.chunks.pop()
+                self._write_manifest()
+
+    def _roll_over(self):
+        if self._map is not None:
+            self.close()
+        path = "{}-{:06d}.bin".format(self.name, len(self.chunks))
+        self._map = np.memmap(os.path.join(self.directory, path), dtype=self.dtype, mode="w+",
+                              shape=(self.chunk_records,))
+        self._count = 0
+        self._opened_at = time.monotonic()
+        self.chunks.append(Chunk(path, 0.0, 0.0, 0))
+
+    def _write_manifest(self):
+        manifest = {"dtype": self.dtype.descr, "chunks": [chunk._asdict() for chunk in self.chunks]}
+        temporary = self._manifest + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temporary, self._manifest)
+
+
+class TelemetryRecorder:
+    """Records feedback samples and events of a session to disk
+
+    The record_*() calls only timestamp their arguments and queue them, the
+    protobuf messages are unpacked and written by a background thread every
+    FLUSH_PERIOD, a batch at a time. Every stream ("feedback" and "events")
+    is a set of memory-mapped chunk files of fixed-size NumPy records plus a
+    JSON manifest of their time ranges; a new chunk is started when one is
+    full or CHUNK_DURATION old, and only the current chunk is mapped, so
+    memory use doesn't grow with the length of the shift. When more than
+    max_pending records are waiting, new ones are dropped and counted in
+    dropped instead of slowing down the caller.
+
+    Timestamps are time.time() seconds, so recordings of different sessions
+    can be compared.
+
+    Arguments:
+    directory -- where the chunk files go, created if missing
+    actuator_count -- number of joints of the arm
+    chunk_records -- records per chunk file
+    chunk_duration -- seconds after which a chunk is closed even if not full
+    max_pending -- queued records above which new ones are dropped
+    """
+
+    def __init__(self, directory, actuator_count=7, chunk_records=CHUNK_RECORDS,
+                 chunk_duration=CHUNK_DURATION, max_pending=MAX_PENDING):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.actuator_count = actuator_count
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.errors = 0
+        self._feedback = _Stream(directory, "feedback", feedback_dtype(actuator_count), chunk_records, chunk_duration)
+        self._events = _Stream(directory, "events", EVENT_DTYPE, chunk_records, chunk_duration)
+        # deque.append() is atomic, producers never take a lock
+        self._pending_feedback = collections.deque()
+        self._pending_events = collections.deque()
+        self._running = False
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="recorder", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._feedback.close()
+        self._events.close()
+        if self.dropped:
+            print("Telemetry recorder dropped {} records".format(self.dropped))
+
+    def record_feedback(self, feedback, timestamp=None):
+        """Queue a BaseCyclic_pb2.Feedback"""
+        if len(self._pending_feedback) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending_feedback.append((timestamp or time.time(), feedback))
+
+    def record_event(self, kind, code=0, identifier=0, value=0.0, text="", timestamp=None):
+        """Queue an event record, kind is one of the EVENT_ constants"""
+        if len(self._pending_events) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending_events.append((timestamp or time.time(), kind, code, identifier, value,
+                                     text.encode("utf-8")[:EVENT_TEXT_LENGTH]))
+
+    def record_action(self, notification, name=""):
+        """Queue a Base_pb2.ActionNotification, name is the name of the action if known"""
+        self.record_event(EVENT_ACTION, notification.action_event, notification.handle.identifier,
+                          notification.abort_details, name)
+
+    def record_sequence(self, notification, name=""):
+        """Queue a Base_pb2.SequenceInfoNotification, name is the name of the sequence if known"""
+        self.record_event(EVENT_SEQUENCE, notification.event_identifier, notification.task_index,
+                          notification.abort_details, name)
+
+    def record_command(self, name):
+        self.record_event(EVENT_COMMAND, text=name)
+
+    def record_vision(self, slot, color, confidence):
+        self.record_event(EVENT_VISION, identifier=slot, value=confidence, text=color)
+
+    def _drain(self, pending):
+        count = len(pending)
+        return [pending.popleft() for _ in range(count)]
+
+    def _write(self):
+        batch = self._drain(self._pending_feedback)
+        if batch:
+            n = self.actuator_count
+            records = np.zeros(len(batch), dtype=self._feedback.dtype)
+            records["timestamp"] = [timestamp for timestamp, _ in batch]
+            feedbacks = [feedback for _, feedback in batch]
+            records["tool_pose"] = [
+                (f.base.tool_pose_x, f.base.tool_pose_y, f.base.tool_pose_z,
+                 f.base.tool_pose_theta_x, f.base.tool_pose_theta_y, f.base.tool_pose_theta_z)
+                for f in feedbacks]
+            records["joint_angles"] = [[a.position for a in f.actuators[:n]] for f in feedbacks]
+            records["joint_velocities"] = [[a.velocity for a in f.actuators[:n]] for f in feedbacks]
+            records["joint_torques"] = [[a.torque for a in f.actuators[:n]] for f in feedbacks]
+            records["gripper_position"] = [
+                f.interconnect.gripper_feedback.motor[0].position
+                if len(f.interconnect.gripper_feedback.motor) else np.nan
+                for f in feedbacks]
+            self._feedback.append(records)
+        batch = self._drain(self._pending_events)
+        if batch:
+            self._events.append(np.array(batch, dtype=EVENT_DTYPE))
+
+    def _run(self):
+        while self._running:
+            time.sleep(FLUSH_PERIOD)
+            try:
+                self._write()
+                self._feedback.flush()
+                self._events.flush()
+            except Exception as e:
+                self.errors += 1
+                print("Telemetry recorder failed: {}".format(e))
+        # What was queued before stop()
+        self._write()
+
+
+class TelemetryReader:
+    """Reads back the streams of a TelemetryRecorder directory
+
+    Chunks are memory-mapped read-only, a time range within one chunk is
+    returned as a view of the file without copying.
+
+    Arguments:
+    directory -- directory given to the TelemetryRecorder
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def streams(self):
+        return sorted(os.path.splitext(os.path.basename(path))[0]
+                      for path in glob.glob(os.path.join(self.directory, "*.json")))
+
+    def chunks(self, stream, start=None, end=None):
+        """Yield the records of stream between start and end (time.time() seconds), one array per chunk"""
+        with open(os.path.join(self.directory, stream + ".json")) as f:
+            manifest = json.load(f)
+        dtype = np.dtype([tuple(field) for field in manifest["dtype"]])
+        for chunk in manifest["chunks"]:
+            chunk = Chunk(**chunk)
+            if chunk.count == 0 or (start is not None and chunk.end < start) or \
+                    (end is not None and chunk.start > end):
+                continue
+            records = np.memmap(os.path.join(self.directory, chunk.path), dtype=dtype, mode="r",
+                                shape=(chunk.count,))
+            timestamps = records["timestamp"]
+            first = 0 if start is None else np.searchsorted(timestamps, start, side="left")
+            last = chunk.count if end is None else np.searchsorted(timestamps, end, side="right")
+            yield records[first:last]
+
+    def read(self, stream, start=None, end=None):
+        """Records of stream between start and end as one array (a copy if they span several chunks)"""
+        parts = list(self.chunks(stream, start, end))
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return None
+        return np.concatenate(parts)
@@ -0,0 +1,174 @@
+import collections
+import time
+
+import numpy as np
+
+# A whole-frame (or whole-workspace) pass is made every this many frames
+FULL_FRAME_EVERY = 10
+# Extra room around the previous tracks, as a fraction of the box around them
+ROI_MARGIN = 0.25
+# Smallest side of an ROI (pixels), tiny crops lose the context the model needs
+MIN_ROI_SIZE = 96
+# Inference sizes the model is stepped through to stay within the frame budget
+IMAGE_SIZES = (640, 512, 416, 320)
+# Weight of a new inference time in the smoothed one
+TIME_SMOOTHING = 0.2
+
+# What the last frame went through: region is [xmin, ymin, xmax, ymax] of the
+# full frame, image_size the inference size, full whether it was a full pass
+RoiPass = collections.namedtuple("RoiPass", ["region", "image_size", "full", "inference_time"])
+
+
+def _round_size(size):
+    # Models take multiples of 32
+    return max(32, int(np.ceil(size / 32.0)) * 32)
+
+
+class _Tracker:
+    # The ultralytics BYTETracker, fed full-frame boxes so track IDs survive
+    # changes of ROI. Mirrors what model.track() does after each predict().
+
+    def __init__(self, config="bytetrack.yaml"):
+        from ultralytics.trackers.byte_tracker import BYTETracker
+        from ultralytics.utils.checks import check_yaml
+        try:
+            from ultralytics.utils import YAML
+            values = YAML.load(check_yaml(config))
+        except ImportError:
+            from ultralytics.utils import yaml_load
+            values = yaml_load(check_yaml(config))
+        from ultralytics.utils import IterableSimpleNamespace
+        self._tracker = BYTETracker(IterableSimpleNamespace(**values))
+
+    def update(self, result):
+        import torch
+        tracks = self._tracker.update(result.boxes.cpu().numpy(), result.orig_img)
+        if len(tracks) == 0:
+            return result[:0]
+        result = result[tracks[:, -1].astype(int)]
+        result.update(boxes=torch.as_tensor(tracks[:, :-1]))
+        return result
+
+
+class RoiInference:
+    """Runs the detector on regions of interest instead of the whole frame
+
+    The region of a frame is the box around the tracks of the previous frame
+    (plus margin), clipped to the workspace. A full pass (the workspace, or
+    the whole frame without one) is made every full_frame_every frames, when
+    there are no tracks and when a track was lost, so new objects are still
+    found. For the arm's wrist camera the workspace box in front of the
+    gripper is fixed in the image; roi_source(frame) can give a region
+    computed otherwise (e.g. projected from the tool pose), it replaces the
+    workspace when it returns one.
+
+    With a frame_budget the inference size is lowered through image_sizes
+    while the smoothed inference time is over budget, and raised again when
+    the next size up should fit in it.
+
+    Detections are tracked with full-frame coordinates and returned as the
+    same list of ultralytics Results model.track() gives, so callers don't
+    see the difference.
+
+    Arguments:
+    detector -- Detector to run
+    workspace -- [xmin, ymin, xmax, ymax] (pixels) outside of which nothing matters, None for the whole frame
+    full_frame_every -- frames between two full passes
+    margin -- room around the previous tracks, fraction of their box size
+    frame_budget -- seconds an inference may take, None to keep image_sizes[0]
+    image_sizes -- inference sizes, largest first
+    roi_source -- optional roi_source(frame) returning a region or None
+    """
+
+    def __init__(self, detector, workspace=None, full_frame_every=FULL_FRAME_EVERY, margin=ROI_MARGIN,
+                 frame_budget=None, image_sizes=IMAGE_SIZES, roi_source=None):
+        self.detector = detector
+        self.workspace = workspace
+        self.full_frame_every = full_frame_every
+        self.margin = margin
+        self.frame_budget = frame_budget
+        self.image_sizes = image_sizes
+        self.roi_source = roi_source
+        self.last_pass = None
+        self._size_index = 0
+        self._inference_time = None
+        self._frames = 0
+        self._previous_ids = set()
+        self._previous_boxes = np.zeros((0, 4))
+        self._tracker = None
+
+    def __call__(self, frame):
+        if self._tracker is None:
+            self._tracker = _Tracker()
+        height, width = frame.shape[:2]
+        base = self._base_region(frame, width, height)
+        full = self._frames % self.full_frame_every == 0 or not len(self._previous_boxes)
+        region = base if full else self._track_region(base)
+        self._frames += 1
+
+        x1, y1, x2, y2 = region
+        crop = frame[y1:y2, x1:x2]
+        image_size = min(self.image_sizes[self._size_index], _round_size(max(x2 - x1, y2 - y1)))
+        started = time.perf_counter()
+        result = self.detector.predict(np.ascontiguousarray(crop), imgsz=image_size)[0]
+        elapsed = time.perf_counter() - started
+        self._adapt(elapsed)
+
+        result = self._to_full_frame(result, frame, x1, y1)
+        result = self._tracker.update(result)
+        boxes = result.boxes
+        ids = set(boxes.id.int().tolist()) if boxes.id is not None else set()
+        if self._previous_ids - ids:
+            # A track was lost, look at everything on the next frame
+            self._frames = 0
+        self._previous_ids = ids
+        self._previous_boxes = boxes.xyxy.cpu().numpy()
+        self.last_pass = RoiPass(region, image_size, full, elapsed)
+        return [result]
+
+    def _base_region(self, frame, width, height):
+        region = self.roi_source(frame) if self.roi_source is not None else None
+        if region is None:
+            region = self.workspace
+        if region is None:
+            return (0, 0, width, height)
+        return self._clip(region, (0, 0, width, height))
+
+    def _track_region(self, base):
+        boxes = self._previous_boxes
+        x1, y1 = boxes[:, 0].min(), boxes[:, 1].min()
+        x2, y2 = boxes[:, 2].max(), boxes[:, 3].max()
+        margin_x = max((x2 - x1) * self.margin, (MIN_ROI_SIZE - (x2 - x1)) / 2.0)
+        margin_y = max((y2 - y1) * self.margin, (MIN_ROI_SIZE - (y2 - y1)) / 2.0)
+        return self._clip((x1 - margin_x, y1 - margin_y, x2 + margin_x, y2 + margin_y), base)
+
+    def _clip(self, region, bounds):
+        x1, y1, x2, y2 = (int(round(value)) for value in region)
+        bx1, by1, bx2, by2 = bounds
+        x1, x2 = max(bx1, min(x1, bx2 - 1)), max(bx1 + 1, min(x2, bx2))
+        y1, y2 = max(by1, min(y1, by2 - 1)), max(by1 + 1, min(y2, by2))
+        return (x1, y1, x2, y2)
+
+    def _adapt(self, elapsed):
+        if self._inference_time is None:
+            self._inference_time = elapsed
+        else:
+            self._inference_time += TIME_SMOOTHING * (elapsed - self._inference_time)
+        if self.frame_budget is None:
+            return
+        if self._inference_time > self.frame_budget and self._size_index < len(self.image_sizes) - 1:
+            self._size_index += 1
+            self._inference_time = None
+        elif self._size_index > 0:
+            # Inference time grows with the number of pixels
+            scale = (self.image_sizes[self._size_index - 1] / float(self.image_sizes[self._size_index])) ** 2
+            if self._inference_time * scale < self.frame_budget:
+                self._size_index -= 1
+                self._inference_time = None
+
+    def _to_full_frame(self, result, frame, x1, y1):
+        from ultralytics.engine.results import Results
+        data = result.boxes.data.clone()
+        data[:, [0, 2]] += x1
+        data[:, [1, 3]] += y1
+        return Results(frame, path="", names=result.names, boxes=data)
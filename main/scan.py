@@ -0,0 +1,371 @@
+import collections
+import json
+import os
+import time
+
+import numpy as np
+from kortex_api.autogen.messages import Base_pb2
+
+import color
+
+# Joint speed (deg/s) under which every actuator must stay for the arm to count as settled
+SETTLED_VELOCITY = 0.5
+# Consecutive feedback samples that must be under SETTLED_VELOCITY
+SETTLED_SAMPLES = 3
+# Largest joint angle error (degrees) to the action's target for a still arm to count as arrived
+SETTLED_ANGLE = 1.0
+# Longest wait between two checks of the action notification (seconds)
+SETTLE_POLL_PERIOD = 0.01
+
+# Stored joint-angle action from which the camera sees every slot at once
+OVERVIEW_POSITION = "Bottle_Overview_Pos"
+# [xmin, ymin, xmax, ymax] (pixels) of every slot in a 640x480 frame taken
+# at OVERVIEW_POSITION, used when SLOT_ROIS_PATH doesn't exist
+SLOT_ROIS = collections.OrderedDict([
+    (1, [80, 190, 180, 290]),
+    (2, [270, 190, 370, 290]),
+    (3, [460, 190, 560, 290]),
+])
+# Where the slot ROIs measured on the actual setup are saved
+SLOT_ROIS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "slot_rois.json")
+
+# Timings of one watch position, in seconds:
+# move -- motion sent until the arm was settled
+# vision -- settled until the color verdict
+# notification_lag -- settled until the ACTION_END/ABORT of the motion came
+#     back, i.e. the wait a sequential scan pays before it can start sampling
+#     (None if it never came)
+# settled_by -- "feedback" or "notification"
+ScanTiming = collections.namedtuple("ScanTiming", [
+    "slot", "position", "color", "confidence", "frames",
+    "move", "vision", "notification_lag", "settled_by",
+])
+
+
+def joint_target(action):
+    """Joint angles (degrees) a REACH_JOINT_ANGLES action goes to, in joint order"""
+    angles = sorted(action.reach_joint_angles.joint_angles.joint_angles, key=lambda angle: angle.joint_identifier)
+    return np.array([angle.value for angle in angles])
+
+
+def wait_until_settled(monitor, future, timeout, target=None):
+    """Return (time, how) at which the arm stopped after the action of future
+
+    Whichever comes first: every joint below SETTLED_VELOCITY for the last
+    SETTLED_SAMPLES samples of the FeedbackMonitor since the action started,
+    or the END / ABORT notification of the action. The joints are still
+    for a moment after ACTION_START too, so the still samples only count
+    once some joint went over SETTLED_VELOCITY since the start, or when
+    the joint angles are within SETTLED_ANGLE of target (e.g. the arm was
+    already there). Returns (None, None) on timeout.
+    """
+    deadline = time.monotonic() + timeout
+    window = 2.0 * SETTLED_SAMPLES / monitor.rate
+    moved = False
+    while time.monotonic() < deadline:
+        if future.done():
+            return future.result().finished, "notification"
+        if future.started is not None:
+            recent = monitor.history(window)
+            if recent is not None:
+                since_start = recent.timestamp > future.started
+                velocities = recent.joint_velocities[since_start]
+                moved = moved or bool(np.any(np.abs(velocities) >= SETTLED_VELOCITY))
+                still = len(velocities) >= SETTLED_SAMPLES and \
+                    np.all(np.abs(velocities[-SETTLED_SAMPLES:]) < SETTLED_VELOCITY)
+                if still and not moved and target is not None and len(target) == recent.joint_angles.shape[1]:
+                    error = (recent.joint_angles[since_start][-1] - target + 180.0) % 360.0 - 180.0
+                    moved = bool(np.all(np.abs(error) <= SETTLED_ANGLE))
+                if still and moved:
+                    return recent.timestamp[since_start][-1], "feedback"
+        monitor.wait_next(time.monotonic(), SETTLE_POLL_PERIOD)
+    return None, None
+
+
+def save_slot_rois(slot_rois, path=SLOT_ROIS_PATH):
+    with open(path, "w") as f:
+        json.dump({str(slot): list(roi) for slot, roi in slot_rois.items()}, f, indent=2)
+
+
+def load_slot_rois(path=SLOT_ROIS_PATH):
+    """Return the saved slot -> ROI map, SLOT_ROIS if none was saved"""
+    if not os.path.exists(path):
+        return SLOT_ROIS
+    with open(path) as f:
+        values = json.load(f)
+    return collections.OrderedDict(sorted((int(slot), roi) for slot, roi in values.items()))
+
+
+def move_to_watch_position(actions, monitor, position, pipelined=True, timeout=30):
+    """Send the arm to a stored joint-angle position and wait until it is settled
+
+    Returns (future, sent_at, settled_at, settled_by): future is None if
+    the position isn't stored, settled_at None on timeout.
+    """
+    actions.set_servoing_mode(Base_pb2.SINGLE_LEVEL_SERVOING)
+    sent_at = time.monotonic()
+    future = actions.execute(position, Base_pb2.REACH_JOINT_ANGLES)
+    if future is None:
+        print("Can't find watch position {}".format(position))
+        return None, sent_at, None, None
+    if pipelined:
+        # Already read by execute(), no RPC
+        target = joint_target(actions.get_action(position, Base_pb2.REACH_JOINT_ANGLES))
+        settled_at, settled_by = wait_until_settled(monitor, future, timeout, target)
+    else:
+        result = future.result(timeout)
+        settled_at, settled_by = (result.finished, "notification") if result else (None, None)
+    if settled_at is None:
+        print("Timeout waiting for the arm to reach {}".format(position))
+    return future, sent_at, settled_at, settled_by
+
+
+def _aborted(future):
+    return future.done() and future.result().event == Base_pb2.ACTION_ABORT
+
+
+def _interrupted(future, cancelled=None):
+    # The motion was aborted, or the command was preempted (the stopped arm
+    # can look settled before the ABORT notification is in)
+    return (cancelled is not None and cancelled.is_set()) or (future is not None and _aborted(future))
+
+
+def _slot_view(image, roi):
+    # The roi of image, None if it is outside of the image
+    if image is None:
+        return None
+    x1, y1, x2, y2 = color.clip_roi(roi, image.shape)
+    return image[y1:y2, x1:x2] if x2 > x1 and y2 > y1 else None
+
+
+def _keep_last(images, kept):
+    # Pass images through, keeping the last one in kept[0]
+    for image in images:
+        kept[:] = [image]
+        yield image
+
+
+def _overview_region(slot_rois):
+    # (slots, region around all ROIs, ROIs relative to the region). The region
+    # starts inside the frame, frames smaller than its end just crop it shorter.
+    slots = list(slot_rois)
+    rois = np.array([slot_rois[slot] for slot in slots], dtype=int)
+    region = [max(rois[:, 0].min(), 0), max(rois[:, 1].min(), 0), rois[:, 2].max(), rois[:, 3].max()]
+    rois -= [region[0], region[1], region[0], region[1]]
+    return slots, region, rois
+
+
+def scan_for_color(actions, monitor, camera, color_code, watch_positions,
+                   pipelined=True, timeout=30, classifier=None, recorder=None, slots=None, cache=None,
+                   cancelled=None):
+    """Visit the watch positions until one shows color_code
+
+    In pipelined mode sampling starts as soon as the feedback says the arm is
+    settled and the next motion is sent as soon as the verdict is known, the
+    notification of the previous motion is not waited for. Otherwise every
+    motion is waited for to its ACTION_END before sampling, as before.
+
+    Returns (slot, timings): slot is the 1-based index of the matching watch
+    position (None if there is none), or its number in slots when given,
+    timings a list of ScanTiming. Every verdict is also recorded to
+    recorder, and stored in the SlotCache cache, if given. The scan stops
+    with no slot once the threading.Event cancelled is set.
+    """
+    classifier = classifier or color.classifier
+    slots = slots or range(1, len(watch_positions) + 1)
+    timings = []
+    pending = []
+    found = None
+    for slot, position in zip(slots, watch_positions):
+        if _interrupted(None, cancelled):
+            break
+        future, sent_at, settled_at, settled_by = move_to_watch_position(actions, monitor, position, pipelined,
+                                                                         timeout)
+        if future is None:
+            continue
+        if settled_at is None:
+            break
+        if _interrupted(future, cancelled):
+            # Stopped (e.g. by a priority command), don't carry on with the scan
+            print("Motion to {} aborted, scan interrupted".format(position))
+            break
+
+        kept = []
+        found_color, confidence, frames = classifier.vote(_keep_last(color.camera_rois(camera, after=settled_at),
+                                                                     kept))
+        verdict_at = time.monotonic()
+        print("Slot {}: {} ({:.0%} of {} frames)".format(slot, found_color, confidence, frames))
+        if recorder is not None:
+            recorder.record_vision(slot, found_color, confidence)
+        if cache is not None and kept:
+            cache.update(slot, found_color, confidence, position, kept[0])
+
+        pending.append((future, settled_at))
+        timings.append(ScanTiming(
+            slot=slot, position=position, color=found_color, confidence=confidence, frames=frames,
+            move=settled_at - sent_at, vision=verdict_at - settled_at,
+            notification_lag=None, settled_by=settled_by,
+        ))
+        if found_color == color_code and not _interrupted(None, cancelled):
+            # The pick starts from here, let the motion finish properly first
+            if future.succeeded(timeout):
+                found = slot
+            break
+
+    _fill_notification_lag(timings, pending)
+    return found, timings
+
+
+def _fill_notification_lag(timings, pending):
+    # Fill in how long each motion's notification took after the arm had settled
+    for index, (future, settled_at) in enumerate(pending):
+        result = future.result(0)
+        if result is not None and timings[index].notification_lag is None:
+            timings[index] = timings[index]._replace(notification_lag=max(0.0, result.finished - settled_at))
+
+
+def scan_overview(actions, monitor, camera, slot_rois=SLOT_ROIS, position=OVERVIEW_POSITION,
+                  pipelined=True, timeout=30, classifier=None, recorder=None, cache=None):
+    """Classify every slot from the frames of one position
+
+    The ROIs of all slots are cut from the bounding box around them and
+    classified in one pass per frame (ColorClassifier.vote_slots), until
+    every slot is confident or max_frames were used. The verdicts are
+    stored in the SlotCache cache if one is given.
+
+    Returns (colors, timings, future, settled_at): colors maps slot ->
+    (color, confidence) and is None if the position couldn't be reached,
+    timings has one ScanTiming per slot (the move and vision times on the
+    first), future is the motion's ActionFuture and settled_at when the
+    arm settled.
+    """
+    classifier = classifier or color.classifier
+    future, sent_at, settled_at, settled_by = move_to_watch_position(actions, monitor, position, pipelined, timeout)
+    if settled_at is None or _aborted(future):
+        return None, [], future, settled_at
+
+    # Only the region around the ROIs is converted to HSV
+    slots, region, rois = _overview_region(slot_rois)
+    kept = []
+    labels, confidences, frames = classifier.vote_slots(
+        _keep_last(color.camera_regions(camera, region, after=settled_at), kept), rois)
+    verdict_at = time.monotonic()
+
+    colors = collections.OrderedDict()
+    timings = []
+    for slot, label, confidence, roi in zip(slots, labels, confidences, rois):
+        print("Slot {}: {} ({:.0%} of {} frames)".format(slot, label, confidence, frames))
+        if recorder is not None:
+            recorder.record_vision(slot, label, confidence)
+        view = _slot_view(kept[0], roi) if kept else None
+        if cache is not None and view is not None:
+            cache.update(slot, label, confidence, position, view)
+        colors[slot] = (label, float(confidence))
+        first = not timings
+        timings.append(ScanTiming(
+            slot=slot, position=position, color=label, confidence=float(confidence), frames=frames,
+            move=settled_at - sent_at if first else 0.0, vision=verdict_at - settled_at if first else 0.0,
+            notification_lag=None, settled_by=settled_by,
+        ))
+    return colors, timings, future, settled_at
+
+
+def scan_slots(actions, monitor, camera, color_code, watch_positions, slot_rois=SLOT_ROIS,
+               position=OVERVIEW_POSITION, pipelined=True, timeout=30, classifier=None, recorder=None, cache=None,
+               cancelled=None):
+    """Find the slot showing color_code from the overview position, visit watch positions only if unsure
+
+    Slots the overview classified with less than the classifier's
+    confidence (all of them if the overview position couldn't be reached)
+    are checked again from their watch position (watch_positions[slot - 1])
+    with scan_for_color(). Same return value as scan_for_color().
+    """
+    classifier = classifier or color.classifier
+    colors, timings, future, settled_at = scan_overview(actions, monitor, camera, slot_rois, position, pipelined,
+                                                        timeout, classifier, recorder, cache)
+    if _interrupted(future, cancelled):
+        return None, timings
+    if colors is None:
+        unsure = list(range(1, len(watch_positions) + 1))
+    else:
+        for slot, (label, confidence) in colors.items():
+            if label == color_code and confidence >= classifier.confidence:
+                # The pick starts from here, let the motion finish properly first
+                succeeded = future.succeeded(timeout)
+                _fill_notification_lag(timings, [(future, settled_at)])
+                return (slot if succeeded else None), timings
+        _fill_notification_lag(timings, [(future, settled_at)])
+        unsure = [slot for slot, (label, confidence) in colors.items()
+                  if confidence < classifier.confidence and slot <= len(watch_positions)]
+    if not unsure:
+        return None, timings
+    print("Checking slots {} from their watch positions".format(", ".join(str(slot) for slot in unsure)))
+    found, fallback_timings = scan_for_color(actions, monitor, camera, color_code,
+                                             [watch_positions[slot - 1] for slot in unsure], pipelined, timeout,
+                                             classifier, recorder, unsure, cache, cancelled)
+    return found, timings + fallback_timings
+
+
+def confirm_cached_slot(actions, monitor, camera, cache, color_code, slot_rois=SLOT_ROIS,
+                        overview_position=OVERVIEW_POSITION, pipelined=True, timeout=30, classifier=None,
+                        recorder=None, cancelled=None):
+    """Check the cached slot of color_code with one frame instead of a full scan
+
+    The arm goes back to the position the slot was seen from and takes a
+    single frame. Every cached slot visible from there whose ROI changed
+    is forgotten (SlotCache.check), then the slot's ROI is classified
+    once. Returns (slot, timings) like scan_for_color(): slot is None when
+    nothing is cached for color_code or the frame doesn't confirm it, and
+    a full scan is needed.
+    """
+    classifier = classifier or color.classifier
+    state = cache.find(color_code, classifier.confidence)
+    if state is None:
+        return None, []
+    future, sent_at, settled_at, settled_by = move_to_watch_position(actions, monitor, state.position, pipelined,
+                                                                     timeout)
+    if settled_at is None or _interrupted(future, cancelled):
+        return None, []
+
+    if state.position == overview_position:
+        slots, region, rois = _overview_region(slot_rois)
+        image = next(color.camera_regions(camera, region, after=settled_at), None)
+        views = {slot: _slot_view(image, roi) for slot, roi in zip(slots, rois)}
+    else:
+        views = {state.slot: next(color.camera_rois(camera, after=settled_at), None)}
+    view = views.get(state.slot)
+    if view is None:
+        return None, []
+    for slot, other in views.items():
+        if other is not None:
+            cache.check(slot, state.position, other)
+    label, confidence = classifier.classify(view)
+    verdict_at = time.monotonic()
+    print("Slot {}: {} ({:.0%} of 1 frame, cached {:.0f}s ago)".format(
+        state.slot, label, confidence, verdict_at - state.timestamp))
+    if recorder is not None:
+        recorder.record_vision(state.slot, label, confidence)
+    timings = [ScanTiming(
+        slot=state.slot, position=state.position, color=label, confidence=confidence, frames=1,
+        move=settled_at - sent_at, vision=verdict_at - settled_at, notification_lag=None, settled_by=settled_by,
+    )]
+    if cache.get(state.slot) is None or label != color_code or confidence < classifier.confidence:
+        cache.invalidate(state.slot)
+        return None, timings
+    cache.update(state.slot, label, confidence, state.position, view)
+    # The pick starts from here, let the motion finish properly first
+    succeeded = future.succeeded(timeout) and not _interrupted(None, cancelled)
+    _fill_notification_lag(timings, [(future, settled_at)])
+    return (state.slot if succeeded else None), timings
+
+
+def print_scan_timings(timings):
+    print("slot  position             color     frames   move  vision  notif. lag")
+    for timing in timings:
+        lag = "   n/a" if timing.notification_lag is None else "{:6.3f}".format(timing.notification_lag)
+        print("{:>4}  {:<20} {:<9} {:>6} {:6.3f}  {:6.3f}      {}".format(
+            timing.slot, timing.position, timing.color[:9], timing.frames,
+            timing.move, timing.vision, lag))
+    total = sum(timing.move + timing.vision for timing in timings)
+    saved = sum(timing.notification_lag or 0.0 for timing in timings if timing.settled_by == "feedback")
+    print("Scan took {:.3f}s, about {:.3f}s less than waiting for every notification".format(total, saved))
@@ -0,0 +1,250 @@
+import collections
+import threading
+import time
+
+from kortex_api.autogen.messages import Base_pb2
+
+import tracing
+
+
+# Outcome of one sequence run. task_times holds (task_index, seconds since
+# PlaySequence) for every SEQUENCE_TASK_COMPLETED notification.
+SequenceResult = collections.namedtuple("SequenceResult", [
+    "name", "event", "abort_details", "task_times", "submitted", "finished",
+])
+
+
+def print_task_progress(sequence_name, task_index, task_name, elapsed):
+    """Default progress callback, prints every completed task"""
+    print("Sequence {} task {} ({}) completed after {:.2f}s".format(
+        sequence_name, task_index, task_name, elapsed))
+
+
+class SequenceFuture:
+    """Waitable handle on a sequence played on the arm
+
+    Arguments:
+    name -- name of the sequence
+    task_names -- name of the action of every task, for progress reports
+    progress -- called as progress(name, task_index, task_name, elapsed)
+        for every completed task
+    on_timeout -- called as on_timeout(future) when a wait (other than a
+        poll with timeout 0) times out
+    """
+
+    def __init__(self, name, task_names, progress=print_task_progress, on_timeout=None):
+        self.name = name
+        self.task_names = task_names
+        self.progress = progress
+        self.on_timeout = on_timeout
+        self.submitted = time.monotonic()
+        self.task_times = []
+        self._event = threading.Event()
+        self._result = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the sequence completed or aborted, return False on timeout"""
+        if self._event.is_set():
+            return True
+        with tracing.span("notification", "wait sequence " + self.name):
+            finished = self._event.wait(timeout)
+        if not finished and timeout and self.on_timeout is not None:
+            self.on_timeout(self)
+        return finished
+
+    def result(self, timeout=None):
+        """Return the SequenceResult, or None if the sequence didn't finish in time"""
+        if not self.wait(timeout):
+            return None
+        return self._result
+
+    def succeeded(self, timeout=None):
+        result = self.result(timeout)
+        return result is not None and result.event == Base_pb2.SEQUENCE_COMPLETED
+
+    def _on_notification(self, notification):
+        event_id = notification.event_identifier
+        if event_id == Base_pb2.SEQUENCE_TASK_COMPLETED:
+            elapsed = time.monotonic() - self.submitted
+            self.task_times.append((notification.task_index, elapsed))
+            if self.progress is not None:
+                task_name = ""
+                if notification.task_index < len(self.task_names):
+                    task_name = self.task_names[notification.task_index]
+                self.progress(self.name, notification.task_index, task_name, elapsed)
+        elif event_id == Base_pb2.SEQUENCE_ABORTED:
+            print("Sequence aborted with error {}:{}".format(
+                notification.abort_details,
+                Base_pb2.SubErrorCodes.Name(notification.abort_details)))
+            self._finish(notification)
+        elif event_id == Base_pb2.SEQUENCE_COMPLETED:
+            print("Sequence {} completed.".format(self.name))
+            self._finish(notification)
+
+    def _finish(self, notification):
+        self._result = SequenceResult(
+            name=self.name,
+            event=notification.event_identifier,
+            abort_details=notification.abort_details,
+            task_times=list(self.task_times),
+            submitted=self.submitted,
+            finished=time.monotonic(),
+        )
+        self._event.set()
+
+
+class SequenceCompiler:
+    """Turns named lists of taught actions into device-side Sequences
+
+    A routine is a list of (action_type, action_name) steps, e.g.
+    (Base_pb2.REACH_JOINT_ANGLES, "Home") or
+    (Base_pb2.SEND_GRIPPER_COMMAND, "water_gripper_hold"). Each step becomes
+    its own task group so the tasks run one after the other on the arm
+    without a host round-trip in between.
+
+    Uploaded sequences are cached by key, a later play() of the same key only
+    sends PlaySequence. A sequence left on the arm by an earlier session is
+    reused when its tasks are unchanged and updated in place otherwise.
+    Progress is reported through one OnNotificationSequenceInfoTopic
+    subscription shared by every sequence. The cache is dropped whenever
+    the ActionRegistry's actions change, the tasks hold their handles.
+
+    Arguments:
+    base -- BaseClient of the current session
+    actions -- ActionRegistry of the same session, source of the taught actions
+    recorder -- optional TelemetryRecorder every notification is recorded to
+    """
+
+    def __init__(self, base, actions, recorder=None):
+        self.base = base
+        self.actions = actions
+        self.recorder = recorder
+        self._lock = threading.Lock()
+        self._sequences = {}
+        self._on_device = None
+        self._running = {}
+        self._notification_handle = base.OnNotificationSequenceInfoTopic(
+            self._on_notification,
+            Base_pb2.NotificationOptions()
+        )
+        actions.on_change.append(self.invalidate)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._notification_handle is not None:
+            self.base.Unsubscribe(self._notification_handle)
+            self._notification_handle = None
+
+    def compile(self, name, steps):
+        """Build the Sequence for steps, return None if a step isn't taught on the arm"""
+        sequence = Base_pb2.Sequence()
+        sequence.name = name
+        for group_identifier, (action_type, action_name) in enumerate(steps):
+            action = self.actions.get_action(action_name, action_type)
+            if action is None:
+                print("Can't find action {} for sequence {}".format(action_name, name))
+                return None
+            task = sequence.tasks.add()
+            # Tasks with different group ids are played one after the other
+            task.group_identifier = group_identifier
+            task.action.CopyFrom(action)
+        return sequence
+
+    def upload(self, key, name, steps):
+        """Return the handle of the sequence for key, creating it on the arm if needed"""
+        with self._lock:
+            if key in self._sequences:
+                return self._sequences[key][0]
+
+        sequence = self.compile(name, steps)
+        if sequence is None:
+            return None
+
+        existing = self._existing_sequence(name)
+        if existing is None:
+            print("Creating sequence {} on device".format(name))
+            handle = self.base.CreateSequence(sequence)
+        elif existing.tasks != sequence.tasks:
+            print("Updating sequence {} on device".format(name))
+            sequence.handle.CopyFrom(existing.handle)
+            self.base.UpdateSequence(sequence)
+            handle = existing.handle
+        else:
+            handle = existing.handle
+
+        task_names = [action_name for _, action_name in steps]
+        with self._lock:
+            self._sequences[key] = (handle, name, task_names)
+        return handle
+
+    def invalidate(self, key=None):
+        """Drop the cached handle of key (or of every sequence) so the next play() re-uploads"""
+        with self._lock:
+            if key is None:
+                self._sequences = {}
+            else:
+                self._sequences.pop(key, None)
+            self._on_device = None
+
+    def play(self, key, name, steps, progress=print_task_progress):
+        """Upload (once) and play the sequence, return its SequenceFuture or None"""
+        handle = self.upload(key, name, steps)
+        if handle is None:
+            return None
+        with self._lock:
+            _, name, task_names = self._sequences[key]
+            future = SequenceFuture(name, task_names, progress, self._discard)
+            # Registered before PlaySequence so no notification can be missed
+            self._running[handle.identifier] = future
+        try:
+            self.base.PlaySequence(handle)
+        except Exception:
+            with self._lock:
+                self._running.pop(handle.identifier, None)
+            # The servoing mode may not be the one the registry remembers
+            self.actions.forget_servoing_mode()
+            raise
+        return future
+
+    def _discard(self, future):
+        # A sequence that timed out isn't expected to notify any more
+        with self._lock:
+            for identifier, running in list(self._running.items()):
+                if running is future:
+                    del self._running[identifier]
+
+    def stop(self):
+        """StopSequence if one of the sequences played is still running"""
+        with self._lock:
+            running = bool(self._running)
+        if running:
+            self.base.StopSequence()
+
+    def _existing_sequence(self, name):
+        with self._lock:
+            on_device = self._on_device
+        if on_device is None:
+            on_device = {sequence.name: sequence for sequence in self.base.ReadAllSequences().sequence_list}
+            with self._lock:
+                self._on_device = on_device
+        return on_device.get(name)
+
+    def _on_notification(self, notification):
+        identifier = notification.sequence_handle.identifier
+        with self._lock:
+            future = self._running.get(identifier)
+            if self.recorder is not None:
+                self.recorder.record_sequence(notification, future.name if future is not None else "")
+            if future is None:
+                return
+            if notification.event_identifier in (Base_pb2.SEQUENCE_COMPLETED, Base_pb2.SEQUENCE_ABORTED):
+                del self._running[identifier]
+        future._on_notification(notification)
@@ -0,0 +1,599 @@
+import collections
+import threading
+import time
+
+import cv2
+import numpy as np
+from kortex_api.autogen.messages import Base_pb2, BaseCyclic_pb2
+
+import tracing
+from scan import OVERVIEW_POSITION, SLOT_ROIS
+
+# Round-trip time of one RPC (seconds): base latency, uniform jitter on top
+RPC_LATENCY = 0.004
+RPC_JITTER = 0.002
+# Some RPCs take longer on the arm than a plain round-trip
+RPC_EXTRA_LATENCY = {
+    "ReadAllActions": 0.02,
+    "ReadAllSequences": 0.02,
+    "CreateSequence": 0.03,
+    "UpdateSequence": 0.03,
+    "SetServoingMode": 0.01,
+}
+# Feedback RPCs of the cyclic client (seconds)
+CYCLIC_LATENCY = 0.001
+# Delay between the RPC of an action and its ACTION_START notification (seconds)
+START_DELAY = 0.01
+# Time the arm takes to declare a motion over once it stopped, before ACTION_END (seconds)
+END_DELAY = 0.15
+# Motion speeds the durations are derived from
+JOINT_SPEED = 40.0          # (degrees per second)
+LINEAR_SPEED = 0.15         # (meters per second)
+ANGULAR_SPEED = 40.0        # (degrees per second)
+GRIPPER_DURATION = 0.8      # (seconds)
+# Acceleration / settling time added to every motion (seconds)
+MOTION_OVERHEAD = 0.3
+# Part of MOTION_OVERHEAD at the start of a motion during which the joints
+# haven't started moving yet, though ACTION_START was sent (seconds)
+MOTION_ONSET = 0.1
+ACTUATOR_COUNT = 7
+
+# Joint angles of the positions taught on the arm (degrees)
+TAUGHT_POSITIONS = {
+    "Home": [0.0, 15.0, 180.0, 230.0, 0.0, 55.0, 90.0],
+    "Rest": [0.0, 340.0, 180.0, 214.0, 0.0, 310.0, 90.0],
+    "place_2": [20.0, 30.0, 170.0, 240.0, 10.0, 60.0, 90.0],
+}
+for _slot in (1, 2, 3):
+    _angle = -30.0 + 30.0 * (_slot - 1)
+    TAUGHT_POSITIONS["Bottle{}_Watch_Pos".format(_slot)] = [_angle, 20.0, 180.0, 240.0, 0.0, 60.0, 90.0]
+    TAUGHT_POSITIONS["Bottle{}_Top".format(_slot)] = [_angle, 35.0, 180.0, 250.0, 0.0, 65.0, 90.0]
+    TAUGHT_POSITIONS["Bottle{}_Hold_Pos".format(_slot)] = [_angle, 50.0, 180.0, 260.0, 0.0, 70.0, 90.0]
+TAUGHT_POSITIONS[OVERVIEW_POSITION] = [0.0, 10.0, 180.0, 235.0, 0.0, 50.0, 90.0]
+# Gripper commands taught on the arm, closing ratio of the fingers
+TAUGHT_GRIPPER_COMMANDS = {"open_gripper": 0.0, "water_gripper_hold": 0.6, "newobject": 0.8}
+# Color of the bottle at every slot, as seen from its watch position
+SLOT_COLORS = {1: "Red", 2: "Green", 3: "Blue"}
+# BGR of the colors the simulated camera shows
+COLOR_BGR = {"Red": (0, 0, 200), "Green": (0, 200, 0), "Blue": (200, 0, 0), "Yellow": (0, 200, 200)}
+
+# One RPC or motion of the simulated arm, start / end are time.monotonic() values
+SimulatedEvent = collections.namedtuple("SimulatedEvent", ["kind", "name", "start", "end"])
+
+
+class _Motion:
+    # Joints, tool pose and gripper held for onset seconds, then moved from
+    # rest to rest (smoothstep, the velocities ramp up and down) over the
+    # rest of the duration
+
+    def __init__(self, name, handle, start, duration, joints, pose, gripper, targets, onset=0.0):
+        self.name = name
+        self.handle = handle
+        self.start = start
+        self.duration = duration
+        self.onset = min(onset, duration)
+        self.from_state = (joints, pose, gripper)
+        self.to_state = targets
+        self.aborted = False
+        # Called with False when the motion is stopped (tasks of a sequence)
+        self.on_done = None
+
+    def finished(self, now):
+        return now >= self.start + self.duration
+
+    def state(self, now):
+        travel = self.duration - self.onset
+        t = min(1.0, max(0.0, (now - self.start - self.onset) / travel)) if travel > 0 else 1.0
+        progress = t * t * (3.0 - 2.0 * t)
+        states = []
+        for old, new in zip(self.from_state, self.to_state):
+            states.append(old + (new - old) * progress)
+        joint_velocities = (self.to_state[0] - self.from_state[0]) * 6.0 * t * (1.0 - t) / travel if travel > 0 \
+            else np.zeros(ACTUATOR_COUNT)
+        return states[0], states[1], states[2], joint_velocities
+
+
+class SimulatedArm:
+    """State, timing models and event log of a simulated Gen3 arm
+
+    Shared by SimulatedBase and SimulatedBaseCyclic. Every RPC sleeps for
+    its latency and every motion runs for a duration derived from the
+    distance to travel; both are appended to events, with their RPC names,
+    so a benchmark can count and time them.
+
+    Arguments:
+    rpc_latency -- seconds of a plain RPC round-trip
+    rpc_jitter -- uniform random seconds added to every RPC
+    motion_scale -- factor on every motion duration (e.g. 0.1 to run a
+        benchmark ten times faster than the real arm would move)
+    seed -- seed of the jitter
+    """
+
+    def __init__(self, rpc_latency=RPC_LATENCY, rpc_jitter=RPC_JITTER, motion_scale=1.0, seed=0):
+        self.rpc_latency = rpc_latency
+        self.rpc_jitter = rpc_jitter
+        self.motion_scale = motion_scale
+        self.events = []
+        self.rpc_counts = collections.Counter()
+        self.servoing_mode = Base_pb2.SINGLE_LEVEL_SERVOING
+        self._random = np.random.default_rng(seed)
+        self._lock = threading.RLock()
+        self._joints = np.array(TAUGHT_POSITIONS["Rest"])
+        self._pose = np.array([0.45, 0.0, 0.3, 90.0, 0.0, 90.0])
+        self._gripper = 0.0
+        self._motion = None
+
+    def rpc(self, name, extra=0.0):
+        """Account for one RPC and sleep for its latency"""
+        start = time.monotonic()
+        with self._lock:
+            delay = self.rpc_latency + extra + self.rpc_jitter * self._random.random()
+            self.rpc_counts[name] += 1
+        time.sleep(delay)
+        with self._lock:
+            self.events.append(SimulatedEvent("rpc", name, start, time.monotonic()))
+
+    def reset_log(self):
+        with self._lock:
+            self.events = []
+            self.rpc_counts = collections.Counter()
+
+    def state(self, now=None):
+        """(joint angles, tool pose, gripper position, joint velocities) at now"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._motion is None:
+                return self._joints, self._pose, self._gripper, np.zeros(ACTUATOR_COUNT)
+            return self._motion.state(now)
+
+    def motion_duration(self, joints=None, pose=None, gripper=None):
+        current_joints, current_pose, current_gripper, _ = self.state()
+        duration = 0.0
+        if joints is not None:
+            delta = (np.asarray(joints) - current_joints + 180.0) % 360.0 - 180.0
+            duration = max(duration, np.abs(delta).max() / JOINT_SPEED)
+        if pose is not None:
+            delta = np.asarray(pose) - current_pose
+            duration = max(duration, np.abs(delta[:3]).max() / LINEAR_SPEED, np.abs(delta[3:]).max() / ANGULAR_SPEED)
+        if gripper is not None and gripper != current_gripper:
+            duration = max(duration, GRIPPER_DURATION)
+        return (duration + MOTION_OVERHEAD) * self.motion_scale
+
+    def start_motion(self, name, handle, duration, joints=None, pose=None, gripper=None):
+        """Start moving to the targets (None keeps the current value), return the _Motion"""
+        now = time.monotonic()
+        with self._lock:
+            current_joints, current_pose, current_gripper, _ = self.state(now)
+            if self._motion is not None:
+                # Replaced before its end was notified
+                self.events.append(SimulatedEvent("motion", self._motion.name, self._motion.start,
+                                                  min(now, self._motion.start + self._motion.duration)))
+            self._settle(now)
+            if joints is not None:
+                # Shortest way around for every joint
+                joints = current_joints + (np.asarray(joints, dtype=float) - current_joints + 180.0) % 360.0 - 180.0
+            targets = (current_joints if joints is None else joints,
+                       current_pose if pose is None else np.asarray(pose, dtype=float),
+                       current_gripper if gripper is None else gripper)
+            self._motion = _Motion(name, handle, now, duration, current_joints, current_pose, current_gripper,
+                                   targets, MOTION_ONSET * self.motion_scale)
+            return self._motion
+
+    def finish_motion(self, motion, aborted=False):
+        """Freeze the arm where motion got to, return False if another motion replaced it"""
+        now = time.monotonic()
+        with self._lock:
+            if self._motion is not motion:
+                return False
+            self._settle(now)
+            # The arm stopped moving at the end of the duration, not at the notification
+            self.events.append(SimulatedEvent("motion", motion.name, motion.start,
+                                              min(now, motion.start + motion.duration)))
+            motion.aborted = aborted
+            return True
+
+    def current_motion(self):
+        with self._lock:
+            return self._motion
+
+    def set_joints(self, joints):
+        with self._lock:
+            self._settle(time.monotonic())
+            self._joints = np.asarray(joints, dtype=float) % 360.0
+
+    def move_pose(self, delta):
+        with self._lock:
+            self._settle(time.monotonic())
+            self._pose = self._pose + delta
+
+    def _settle(self, now):
+        if self._motion is not None:
+            joints, pose, gripper, _ = self._motion.state(now)
+            self._joints, self._pose, self._gripper = np.asarray(joints) % 360.0, pose, gripper
+            self._motion = None
+
+
+class SimulatedBase:
+    """Stand-in for BaseClient with the RPCs this repository uses
+
+    Actions run on the SimulatedArm: the RPC returns after its latency, the
+    ACTION_START and ACTION_END notifications come later from timer threads,
+    like from the arm's notification thread; ACTION_END comes END_DELAY
+    after the arm stopped. Stop() and a new action abort the running one
+    (a new action ends it instead if it had already stopped).
+    Sequences play their task groups one after the other and notify every
+    completed task.
+
+    Arguments:
+    arm -- SimulatedArm
+    """
+
+    def __init__(self, arm):
+        self.arm = arm
+        self._lock = threading.Lock()
+        self._next_identifier = 1000
+        self._action_callbacks = {}
+        self._sequence_callbacks = {}
+        self._actions = {}
+        self._sequences = {}
+        for name, joints in TAUGHT_POSITIONS.items():
+            action = Base_pb2.Action()
+            action.name = name
+            action.handle.action_type = Base_pb2.REACH_JOINT_ANGLES
+            for value in joints:
+                action.reach_joint_angles.joint_angles.joint_angles.add().value = value
+            self._store_action(action)
+        for name, position in TAUGHT_GRIPPER_COMMANDS.items():
+            action = Base_pb2.Action()
+            action.name = name
+            action.handle.action_type = Base_pb2.SEND_GRIPPER_COMMAND
+            action.send_gripper_command.mode = Base_pb2.GRIPPER_POSITION
+            action.send_gripper_command.gripper.finger.add().value = position
+            self._store_action(action)
+
+    def _new_identifier(self):
+        with self._lock:
+            self._next_identifier += 1
+            return self._next_identifier
+
+    def _store_action(self, action):
+        action.handle.identifier = self._new_identifier()
+        self._actions[action.handle.identifier] = action
+
+    def _later(self, delay, function, *args):
+        timer = threading.Timer(delay, function, args)
+        timer.daemon = True
+        timer.start()
+
+    def _notify_action(self, event, handle, abort_details=0):
+        notification = Base_pb2.ActionNotification()
+        notification.action_event = event
+        notification.handle.CopyFrom(handle)
+        notification.abort_details = abort_details
+        now = time.time()
+        notification.timestamp.sec = int(now)
+        notification.timestamp.usec = int((now % 1) * 1e6)
+        for callback in list(self._action_callbacks.values()):
+            callback(notification)
+
+    def _notify_sequence(self, event, handle, task_index=0, abort_details=0):
+        notification = Base_pb2.SequenceInfoNotification()
+        notification.event_identifier = event
+        notification.sequence_handle.CopyFrom(handle)
+        notification.task_index = task_index
+        notification.abort_details = abort_details
+        for callback in list(self._sequence_callbacks.values()):
+            callback(notification)
+
+    def _targets(self, action):
+        which = action.WhichOneof("action_parameters")
+        if which == "reach_joint_angles":
+            angles = [angle.value for angle in action.reach_joint_angles.joint_angles.joint_angles]
+            # Angles past the actuator count are ignored
+            return {"joints": angles[:ACTUATOR_COUNT]}
+        if which == "reach_pose":
+            pose = action.reach_pose.target_pose
+            return {"pose": [pose.x, pose.y, pose.z, pose.theta_x, pose.theta_y, pose.theta_z]}
+        if which == "send_gripper_command":
+            return {"gripper": action.send_gripper_command.gripper.finger[0].value}
+        return {}
+
+    def _run_action(self, action, handle, on_done=None, duration=None):
+        targets = self._targets(action)
+        if duration is None:
+            duration = self.arm.motion_duration(**targets)
+
+        def start():
+            previous = self.arm.current_motion()
+            motion = self.arm.start_motion(action.name, handle, duration, **targets)
+            motion.on_done = on_done
+            if previous is not None:
+                # A new action preempts the running one, which ends if it already stopped
+                if previous.finished(motion.start):
+                    self._notify_action(Base_pb2.ACTION_END, previous.handle)
+                else:
+                    self._notify_action(Base_pb2.ACTION_ABORT, previous.handle, Base_pb2.CONTROL_MANUAL_STOP)
+                if previous.on_done is not None:
+                    previous.on_done(previous.finished(motion.start))
+            self._notify_action(Base_pb2.ACTION_START, handle)
+            self._later(duration + END_DELAY, end, motion)
+
+        def end(motion):
+            if self.arm.finish_motion(motion):
+                self._notify_action(Base_pb2.ACTION_END, handle)
+                if on_done is not None:
+                    on_done(True)
+
+        self._later(START_DELAY, start)
+
+    # Notifications
+
+    def OnNotificationActionTopic(self, callback, options):
+        self.arm.rpc("OnNotificationActionTopic")
+        handle = Base_pb2.NotificationHandle()
+        handle.identifier = self._new_identifier()
+        self._action_callbacks[handle.identifier] = callback
+        return handle
+
+    def OnNotificationSequenceInfoTopic(self, callback, options):
+        self.arm.rpc("OnNotificationSequenceInfoTopic")
+        handle = Base_pb2.NotificationHandle()
+        handle.identifier = self._new_identifier()
+        self._sequence_callbacks[handle.identifier] = callback
+        return handle
+
+    def Unsubscribe(self, handle):
+        self.arm.rpc("Unsubscribe")
+        self._action_callbacks.pop(handle.identifier, None)
+        self._sequence_callbacks.pop(handle.identifier, None)
+
+    # Configuration
+
+    def GetActuatorCount(self):
+        self.arm.rpc("GetActuatorCount")
+        count = Base_pb2.ActuatorInformation()
+        count.count = ACTUATOR_COUNT
+        return count
+
+    def SetServoingMode(self, servoing_mode_information):
+        self.arm.rpc("SetServoingMode", RPC_EXTRA_LATENCY["SetServoingMode"])
+        self.arm.servoing_mode = servoing_mode_information.servoing_mode
+
+    # Actions
+
+    def ReadAllActions(self, requested_action_type):
+        self.arm.rpc("ReadAllActions", RPC_EXTRA_LATENCY["ReadAllActions"])
+        action_list = Base_pb2.ActionList()
+        for action in self._actions.values():
+            if action.handle.action_type == requested_action_type.action_type:
+                action_list.action_list.add().CopyFrom(action)
+        return action_list
+
+    def ExecuteAction(self, action):
+        self.arm.rpc("ExecuteAction")
+        handle = Base_pb2.ActionHandle()
+        handle.identifier = self._new_identifier()
+        handle.action_type = Base_pb2.REACH_POSE if action.HasField("reach_pose") else \
+            Base_pb2.REACH_JOINT_ANGLES
+        self._run_action(action, handle)
+
+    def ExecuteActionFromReference(self, action_handle):
+        self.arm.rpc("ExecuteActionFromReference")
+        action = self._actions[action_handle.identifier]
+        self._run_action(action, action.handle)
+
+    def ValidateWaypointList(self, waypoint_list):
+        self.arm.rpc("ValidateWaypointList")
+        return Base_pb2.WaypointValidationReport()
+
+    def ExecuteWaypointTrajectory(self, waypoint_list):
+        # One motion to the last waypoint, as long as the segments take one
+        # after the other without stopping in between
+        self.arm.rpc("ExecuteWaypointTrajectory")
+        _, pose, _, _ = self.arm.state()
+        duration = 0.0
+        for waypoint in waypoint_list.waypoints:
+            target = waypoint.cartesian_waypoint.pose
+            target = np.array([target.x, target.y, target.z, target.theta_x, target.theta_y, target.theta_z])
+            delta = np.abs(target - pose)
+            duration += max(delta[:3].max() / LINEAR_SPEED, delta[3:].max() / ANGULAR_SPEED)
+            pose = target
+        action = Base_pb2.Action()
+        action.name = "waypoint trajectory"
+        target = action.reach_pose.target_pose
+        target.x, target.y, target.z, target.theta_x, target.theta_y, target.theta_z = pose
+        handle = Base_pb2.ActionHandle()
+        handle.identifier = self._new_identifier()
+        handle.action_type = Base_pb2.EXECUTE_WAYPOINT_LIST
+        self._run_action(action, handle, duration=(duration + MOTION_OVERHEAD) * self.arm.motion_scale)
+
+    def Stop(self):
+        self.arm.rpc("Stop")
+        motion = self.arm.current_motion()
+        if motion is not None and self.arm.finish_motion(motion, aborted=True):
+            self._notify_action(Base_pb2.ACTION_ABORT, motion.handle, Base_pb2.CONTROL_MANUAL_STOP)
+            if motion.on_done is not None:
+                motion.on_done(False)
+
+    def GetMeasuredCartesianPose(self):
+        self.arm.rpc("GetMeasuredCartesianPose")
+        _, pose, _, _ = self.arm.state()
+        measured = Base_pb2.Pose()
+        (measured.x, measured.y, measured.z, measured.theta_x, measured.theta_y, measured.theta_z) = \
+            [float(value) for value in pose]
+        return measured
+
+    def StopSequence(self):
+        self.arm.rpc("StopSequence")
+        motion = self.arm.current_motion()
+        # Only a task of a sequence has on_done set
+        if motion is not None and motion.on_done is not None and self.arm.finish_motion(motion, aborted=True):
+            self._notify_action(Base_pb2.ACTION_ABORT, motion.handle, Base_pb2.CONTROL_MANUAL_STOP)
+            motion.on_done(False)
+
+    def SendTwistCommand(self, twist_command):
+        self.arm.rpc("SendTwistCommand")
+        twist = twist_command.twist
+        # Applied for one TWIST_LOOP_PERIOD of realtime.py, the rate it is re-sent at
+        period = 0.01
+        self.arm.move_pose(np.array([twist.linear_x, twist.linear_y, twist.linear_z,
+                                     twist.angular_x, twist.angular_y, twist.angular_z]) * period)
+
+    # Sequences
+
+    def ReadAllSequences(self):
+        self.arm.rpc("ReadAllSequences", RPC_EXTRA_LATENCY["ReadAllSequences"])
+        sequence_list = Base_pb2.SequenceList()
+        for sequence in self._sequences.values():
+            sequence_list.sequence_list.add().CopyFrom(sequence)
+        return sequence_list
+
+    def CreateSequence(self, sequence):
+        self.arm.rpc("CreateSequence", RPC_EXTRA_LATENCY["CreateSequence"])
+        stored = Base_pb2.Sequence()
+        stored.CopyFrom(sequence)
+        stored.handle.identifier = self._new_identifier()
+        self._sequences[stored.handle.identifier] = stored
+        return stored.handle
+
+    def UpdateSequence(self, sequence):
+        self.arm.rpc("UpdateSequence", RPC_EXTRA_LATENCY["UpdateSequence"])
+        stored = Base_pb2.Sequence()
+        stored.CopyFrom(sequence)
+        self._sequences[sequence.handle.identifier] = stored
+
+    def PlaySequence(self, sequence_handle):
+        self.arm.rpc("PlaySequence")
+        sequence = self._sequences[sequence_handle.identifier]
+        tasks = list(enumerate(sequence.tasks))
+        tasks.sort(key=lambda item: item[1].group_identifier)
+        handle = Base_pb2.SequenceHandle()
+        handle.CopyFrom(sequence.handle)
+
+        def play(remaining):
+            if not remaining:
+                self._notify_sequence(Base_pb2.SEQUENCE_COMPLETED, handle)
+                return
+            (index, task), rest = remaining[0], remaining[1:]
+
+            def done(ok):
+                if not ok:
+                    self._notify_sequence(Base_pb2.SEQUENCE_ABORTED, handle, index, Base_pb2.CONTROL_MANUAL_STOP)
+                    return
+                self._notify_sequence(Base_pb2.SEQUENCE_TASK_COMPLETED, handle, index)
+                play(rest)
+            action_handle = Base_pb2.ActionHandle()
+            action_handle.identifier = self._new_identifier()
+            self._run_action(task.action, action_handle, done)
+
+        self._notify_sequence(Base_pb2.SEQUENCE_STARTED, handle)
+        play(tasks)
+
+
+class SimulatedBaseCyclic:
+    """Stand-in for BaseCyclicClient, feedback comes from the SimulatedArm
+
+    Arguments:
+    arm -- SimulatedArm
+    latency -- seconds of one RefreshFeedback / Refresh round-trip
+    label -- prefix of the RPC names in the arm's log, to tell clients apart
+    """
+
+    def __init__(self, arm, latency=CYCLIC_LATENCY, label=""):
+        self.arm = arm
+        self.latency = latency
+        self.label = label
+
+    def _feedback(self):
+        joints, pose, gripper, velocities = self.arm.state()
+        feedback = BaseCyclic_pb2.Feedback()
+        (feedback.base.tool_pose_x, feedback.base.tool_pose_y, feedback.base.tool_pose_z,
+         feedback.base.tool_pose_theta_x, feedback.base.tool_pose_theta_y, feedback.base.tool_pose_theta_z) = \
+            [float(value) for value in pose]
+        for position, velocity in zip(joints, velocities):
+            actuator = feedback.actuators.add()
+            actuator.position = float(position)
+            actuator.velocity = float(velocity)
+        feedback.interconnect.gripper_feedback.motor.add().position = float(gripper) * 100.0
+        return feedback
+
+    def RefreshFeedback(self):
+        self.arm.rpc(self.label + "RefreshFeedback", self.latency - self.arm.rpc_latency)
+        return self._feedback()
+
+    def Refresh(self, command, deviceId=0, options=None):
+        self.arm.rpc(self.label + "Refresh", self.latency - self.arm.rpc_latency)
+        self.arm.set_joints([actuator.position for actuator in command.actuators])
+        return self._feedback()
+
+
+class SimulatedCamera:
+    """Stand-in for CameraService showing the bottle of the slot the arm looks at
+
+    While the arm is settled at a Bottle<N>_Watch_Pos the frames are filled
+    with SLOT_COLORS[N]. At the overview position every slot's color fills
+    its ROI of slot_rois. Elsewhere the frames are gray.
+
+    Arguments:
+    arm -- SimulatedArm
+    fps -- frames per second
+    size -- (width, height) of the frames
+    slot_colors -- slot -> color name
+    slot_rois -- slot -> [xmin, ymin, xmax, ymax] seen from the overview position
+    """
+
+    def __init__(self, arm, fps=30.0, size=(640, 480), slot_colors=SLOT_COLORS, slot_rois=SLOT_ROIS):
+        self.arm = arm
+        self.period = 1.0 / fps
+        self.size = size
+        self.slot_colors = slot_colors
+        self.slot_rois = slot_rois
+        self.frames = 0
+        self._watch = {slot: np.array(TAUGHT_POSITIONS["Bottle{}_Watch_Pos".format(slot)]) % 360.0
+                       for slot in slot_colors}
+        self._overview = np.array(TAUGHT_POSITIONS[OVERVIEW_POSITION]) % 360.0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    @tracing.traced("camera", "latest_frame")
+    def latest_frame(self, after=None, timeout=5.0):
+        now = time.monotonic()
+        # Frames come at a fixed rate, the newest one unless it isn't after 'after'
+        timestamp = np.floor(now / self.period) * self.period
+        if after is not None and timestamp <= after:
+            timestamp = (np.floor(after / self.period) + 1) * self.period
+        if timestamp - now > timeout:
+            return None, None
+        time.sleep(max(0.0, timestamp - now))
+        self.frames += 1
+        return float(timestamp), self._render()
+
+    def _render(self):
+        joints, _, _, velocities = self.arm.state()
+        color, overview = None, False
+        if not np.any(velocities):
+            for slot, watch in self._watch.items():
+                if self._at(joints, watch):
+                    color = self.slot_colors[slot]
+            overview = self._at(joints, self._overview)
+        frame = np.empty((self.size[1], self.size[0], 3), np.uint8)
+        frame[:] = COLOR_BGR.get(color, (128, 128, 128))
+        if overview:
+            for slot, (x1, y1, x2, y2) in self.slot_rois.items():
+                if slot in self.slot_colors:
+                    frame[y1:y2, x1:x2] = COLOR_BGR.get(self.slot_colors[slot], (128, 128, 128))
+        return cv2.GaussianBlur(frame, (3, 3), 0)
+
+    def _at(self, joints, position):
+        delta = (np.asarray(joints) - position + 180.0) % 360.0 - 180.0
+        return np.abs(delta).max() < 1.0
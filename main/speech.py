@@ -0,0 +1,472 @@
+import collections
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import wave
+
+import numpy as np
+
+import tracing
+
+# Length of one audio frame handed to the voice activity detector (seconds)
+FRAME_DURATION = 0.03
+# Ambient noise calibration done once when listening starts (seconds)
+CALIBRATION_DURATION = 0.5
+# Speech starts when a frame is this many times louder than the noise floor
+SPEECH_RATIO = 3.0
+# Frames above the threshold needed to open a segment
+SPEECH_START_FRAMES = 3
+# Silence that closes a segment (seconds)
+PAUSE_DURATION = 0.6
+# Audio kept from before the speech started (seconds)
+PRE_ROLL_DURATION = 0.3
+# Longest segment sent to the recognizer (seconds)
+MAX_SEGMENT_DURATION = 10.0
+# Lowest noise floor (RMS of 16-bit samples), keeps digital silence from making any hiss "speech"
+MIN_NOISE_FLOOR = 50.0
+# How fast the noise floor follows the ambient level during silence (0-1 per frame)
+NOISE_ADAPTATION = 0.05
+# Longest get_command() waits without checking the listening threads are alive (seconds)
+LIVENESS_PERIOD = 0.5
+# Vosk model used when no other is given, offline recognition is the default
+VOSK_MODEL_DIR = os.path.join(os.path.expanduser("~"), ".cache", "kinova_voiceass", "vosk-model")
+
+# A recognized utterance. latency is the time from the end of speech to the text
+# being available, duration the length of the speech segment (seconds).
+Utterance = collections.namedtuple("Utterance", ["text", "latency", "duration", "ended"])
+
+
+#
+# Audio sources, both give 16-bit mono PCM chunks
+#
+
+class MicrophoneSource:
+    """Keeps one microphone stream open (speech_recognition / PyAudio)"""
+
+    def __init__(self, device_index=None, sample_rate=16000):
+        self.device_index = device_index
+        self.sample_rate = sample_rate
+        self._microphone = None
+
+    def open(self):
+        import speech_recognition as sr
+        self._microphone = sr.Microphone(device_index=self.device_index, sample_rate=self.sample_rate)
+        self._microphone.__enter__()
+        self.sample_rate = self._microphone.SAMPLE_RATE
+
+    def read(self, frames):
+        return self._microphone.stream.read(frames)
+
+    def close(self):
+        if self._microphone is not None:
+            self._microphone.__exit__(None, None, None)
+            self._microphone = None
+
+
+class WavSource:
+    """Plays WAV files as if they came from a microphone, for tests and benchmarks
+
+    Arguments:
+    paths -- 16-bit mono WAV files, read one after the other
+    realtime -- pace the chunks like a live microphone would
+    silence -- seconds of silence inserted between and after the files
+    """
+
+    def __init__(self, paths, realtime=False, silence=1.0):
+        self.paths = list(paths)
+        self.realtime = realtime
+        self.silence = silence
+        self.sample_rate = None
+        self._chunks = None
+        self._pending = b""
+
+    def open(self):
+        with wave.open(self.paths[0], "rb") as wav:
+            self.sample_rate = wav.getframerate()
+        self._chunks = self._generate()
+
+    def _generate(self):
+        silence = bytes(2 * int(self.silence * self.sample_rate))
+        for path in self.paths:
+            with wave.open(path, "rb") as wav:
+                if wav.getsampwidth() != 2 or wav.getnchannels() != 1 or wav.getframerate() != self.sample_rate:
+                    raise ValueError("{} must be 16-bit mono at {} Hz".format(path, self.sample_rate))
+                yield wav.readframes(wav.getnframes())
+            yield silence
+
+    def read(self, frames):
+        chunk = b""
+        wanted = 2 * frames
+        while len(chunk) < wanted:
+            if not self._pending:
+                self._pending = next(self._chunks, None)
+                if self._pending is None:
+                    raise EOFError
+            take = wanted - len(chunk)
+            chunk += self._pending[:take]
+            self._pending = self._pending[take:]
+        if self.realtime:
+            time.sleep(frames / self.sample_rate)
+        return chunk
+
+    def close(self):
+        self._chunks = None
+
+
+#
+# Recognizer backends: recognize(pcm, sample_rate) returns the text or None
+#
+
+class VoskBackend:
+    """Offline recognition with a local Vosk model directory
+
+    Raises RuntimeError when vosk isn't installed or the model is missing.
+    """
+
+    def __init__(self, model_path=VOSK_MODEL_DIR, phrases=None):
+        try:
+            import vosk
+        except ImportError:
+            raise RuntimeError("vosk is not installed, needed for offline speech recognition")
+        if not os.path.isdir(model_path):
+            raise RuntimeError("No Vosk model in {}".format(model_path))
+        self._vosk = vosk
+        self._model = vosk.Model(model_path)
+        # Restricting the vocabulary to the known commands helps a lot on short phrases
+        self._grammar = json.dumps(list(phrases) + ["[unk]"]) if phrases else None
+
+    def recognize(self, pcm, sample_rate):
+        if self._grammar is None:
+            recognizer = self._vosk.KaldiRecognizer(self._model, sample_rate)
+        else:
+            recognizer = self._vosk.KaldiRecognizer(self._model, sample_rate, self._grammar)
+        recognizer.AcceptWaveform(pcm)
+        text = json.loads(recognizer.FinalResult()).get("text", "")
+        return text or None
+
+
+class GoogleBackend:
+    """Online recognition through speech_recognition, the previous behaviour"""
+
+    def __init__(self):
+        import speech_recognition as sr
+        self._sr = sr
+        self._recognizer = sr.Recognizer()
+
+    def recognize(self, pcm, sample_rate):
+        audio = self._sr.AudioData(pcm, sample_rate, 2)
+        try:
+            return self._recognizer.recognize_google(audio)
+        except self._sr.UnknownValueError:
+            return None
+        except self._sr.RequestError as e:
+            print(f"Could not request results from Google Speech Recognition service; {e}")
+            return None
+
+
+class ListeningService:
+    """Continuous listening with voice activity detection and a recognizer thread
+
+    The audio source stays open for the whole session. Ambient noise is
+    calibrated once, then the noise floor keeps following the room during
+    silence. Speech segments are cut by energy and handed to the recognizer
+    backend on a worker thread, recognized commands come out of get_command().
+    If listening stops on its own (the source failed or ran out), error
+    holds the cause and get_command() raises instead of waiting.
+
+    Arguments:
+    backend -- object with recognize(pcm, sample_rate) -> text or None
+    source -- MicrophoneSource (default) or WavSource
+    """
+
+    def __init__(self, backend, source=None):
+        self.backend = backend
+        self.source = source or MicrophoneSource()
+        self.commands = queue.Queue()
+        self.noise_floor = None
+        self.error = None
+        self._segments = queue.Queue()
+        self._running = False
+        self._threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.source.open()
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._listen, name="listen", daemon=True),
+            threading.Thread(target=self._recognize, name="recognize", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.source.close()
+
+    def get_command(self, timeout=None):
+        """Return the next Utterance, or None if nothing was recognized in time
+
+        Raises RuntimeError, with error as its cause, once the listening
+        threads are gone and every recognized command was returned.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            period = LIVENESS_PERIOD if deadline is None else min(LIVENESS_PERIOD, deadline - time.monotonic())
+            try:
+                return self.commands.get(timeout=max(0.0, period))
+            except queue.Empty:
+                pass
+            if self._threads and not any(thread.is_alive() for thread in self._threads) and self.commands.empty():
+                raise RuntimeError("Listening stopped: {}".format(self.error or "end of audio")) from self.error
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+
+    def _listen(self):
+        try:
+            self._segment_audio()
+        except EOFError:
+            pass
+        except Exception as e:
+            print("Listening failed: {}".format(e))
+            self.error = e
+        finally:
+            # Tell the recognizer thread there is nothing more to come
+            self._segments.put(None)
+
+    def _segment_audio(self):
+        sample_rate = self.source.sample_rate
+        frame_size = int(sample_rate * FRAME_DURATION)
+
+        def next_frame():
+            chunk = self.source.read(frame_size)
+            samples = np.frombuffer(chunk, dtype=np.int16).astype(np.float32)
+            return chunk, float(np.sqrt(np.mean(samples * samples)))
+
+        # One-time ambient noise calibration
+        calibration = [next_frame()[1] for _ in range(max(1, int(CALIBRATION_DURATION / FRAME_DURATION)))]
+        self.noise_floor = max(float(np.mean(calibration)), MIN_NOISE_FLOOR)
+
+        pre_roll = collections.deque(maxlen=int(PRE_ROLL_DURATION / FRAME_DURATION))
+        pause_frames = int(PAUSE_DURATION / FRAME_DURATION)
+        max_frames = int(MAX_SEGMENT_DURATION / FRAME_DURATION)
+        segment = None
+        loud_frames = 0
+        quiet_frames = 0
+        last_loud = None
+        while self._running:
+            chunk, energy = next_frame()
+            loud = energy > self.noise_floor * SPEECH_RATIO
+            if loud:
+                last_loud = time.monotonic()
+
+            if segment is None:
+                pre_roll.append(chunk)
+                loud_frames = loud_frames + 1 if loud else 0
+                if not loud:
+                    # Follow slow changes of the room noise while nobody speaks
+                    self.noise_floor += NOISE_ADAPTATION * (energy - self.noise_floor)
+                    self.noise_floor = max(self.noise_floor, MIN_NOISE_FLOOR)
+                if loud_frames >= SPEECH_START_FRAMES:
+                    segment = list(pre_roll)
+                    quiet_frames = 0
+                continue
+
+            segment.append(chunk)
+            quiet_frames = 0 if loud else quiet_frames + 1
+            if quiet_frames >= pause_frames or len(segment) >= max_frames:
+                # Speech ended with its last loud frame
+                self._segments.put((b"".join(segment), last_loud, len(segment) * FRAME_DURATION))
+                segment = None
+                loud_frames = 0
+                pre_roll.clear()
+
+    def _recognize(self):
+        while True:
+            item = self._segments.get()
+            if item is None:
+                break
+            pcm, ended, duration = item
+            try:
+                text = self.backend.recognize(pcm, self.source.sample_rate)
+            except Exception as e:
+                print("Speech recognition failed: {}".format(e))
+                continue
+            latency = time.monotonic() - ended
+            if text:
+                print("You said: {} ({:.0f} ms after you stopped)".format(text, latency * 1000))
+                self.commands.put(Utterance(text, latency, duration, ended))
+            else:
+                print("Sorry, I did not understand that.")
+
+
+class SpeechWorker:
+    """Text-to-speech on a background thread with one reused pyttsx3 engine
+
+    say() only queues the text, so announcements play while the arm moves.
+    Priority messages jump the queue, interrupting ones also cut the current
+    utterance and drop everything queued. A message already playing or
+    waiting is not queued twice. Fixed phrases can be rendered to WAV files
+    once and then played from the cache (needs the optional simpleaudio
+    package, the engine is used otherwise).
+
+    Arguments:
+    rate -- speech rate in words per minute, engine default when None
+    cache_dir -- directory of the rendered phrases, no cache when None
+    phrases -- phrases to render in the background after start()
+    """
+
+    def __init__(self, rate=None, cache_dir=None, phrases=()):
+        self.rate = rate
+        self.cache_dir = cache_dir
+        self.phrases = list(phrases)
+        self._queue = queue.PriorityQueue()
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._current = None
+        self._queued = set()
+        # Messages queued before the last interrupting one (lower counter) are dropped
+        self._cutoff = 0
+        self._interrupt = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._running = False
+        self._thread = None
+        self._cache = {}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="speech", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def say(self, text, priority=False, interrupt=False):
+        """Queue text, return False if the same text is already playing or queued"""
+        with self._lock:
+            if not interrupt and (text == self._current or text in self._queued):
+                return False
+            self._counter += 1
+            if interrupt:
+                self._drain()
+                self._cutoff = self._counter
+                self._interrupt.set()
+            self._queued.add(text)
+            self._idle.clear()
+            # Lower sorts first: interrupting, then priority, then in order of arrival
+            rank = 0 if interrupt else 1 if priority else 2
+            self._queue.put((rank, self._counter, text))
+        return True
+
+    def wait_idle(self, timeout=None):
+        """Block until everything queued has been said"""
+        return self._idle.wait(timeout)
+
+    def _drain(self):
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._queued.clear()
+
+    def _run(self):
+        import pyttsx3
+        engine = pyttsx3.init()
+        if self.rate is not None:
+            engine.setProperty("rate", self.rate)
+        if self.cache_dir and self.phrases:
+            self._render_cache(engine)
+
+        finished = threading.Event()
+        engine.connect("finished-utterance", lambda name, completed: finished.set())
+        # External loop so this thread can stop the engine between iterations
+        engine.startLoop(False)
+        try:
+            while self._running:
+                try:
+                    _, counter, text = self._queue.get(timeout=0.05)
+                except queue.Empty:
+                    with self._lock:
+                        if self._queue.empty() and self._current is None:
+                            self._idle.set()
+                    continue
+                with self._lock:
+                    if counter < self._cutoff:
+                        # Taken off the queue just before an interrupt drained it
+                        continue
+                    self._queued.discard(text)
+                    self._current = text
+                    self._interrupt.clear()
+
+                with tracing.span("speech", "utterance", {"text": text}):
+                    if not self._play_cached(text):
+                        finished.clear()
+                        engine.say(text)
+                        while self._running and not finished.is_set():
+                            engine.iterate()
+                            if self._interrupt.is_set():
+                                engine.stop()
+                                break
+                            time.sleep(0.01)
+
+                with self._lock:
+                    self._current = None
+        finally:
+            engine.endLoop()
+
+    def _cache_path(self, text):
+        name = hashlib.sha1(text.encode("utf-8")).hexdigest()[:16] + ".wav"
+        return os.path.join(self.cache_dir, name)
+
+    def _render_cache(self, engine):
+        try:
+            import simpleaudio
+        except ImportError:
+            print("simpleaudio is not installed, phrases won't be cached")
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        missing = [text for text in self.phrases if not os.path.exists(self._cache_path(text))]
+        for text in missing:
+            engine.save_to_file(text, self._cache_path(text))
+        if missing:
+            engine.runAndWait()
+        for text in self.phrases:
+            if os.path.exists(self._cache_path(text)):
+                self._cache[text] = simpleaudio.WaveObject.from_wave_file(self._cache_path(text))
+
+    def _play_cached(self, text):
+        wave_object = self._cache.get(text)
+        if wave_object is None:
+            return False
+        play = wave_object.play()
+        while play.is_playing():
+            if not self._running or self._interrupt.is_set():
+                play.stop()
+                break
+            time.sleep(0.01)
+        return True
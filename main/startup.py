@@ -0,0 +1,142 @@
+import collections
+import contextlib
+import importlib
+import threading
+import time
+
+# Seconds from the start of the imports to the first command prompt we want to stay under
+STARTUP_BUDGET = 2.0
+
+
+class StartupProfile:
+    """Import and initialization times of the subsystems, in the order they started
+
+    Recording is always on (a few perf_counter() calls per subsystem),
+    report() prints it.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_command = None
+        self._lock = threading.Lock()
+        # name -> [import seconds, init seconds, loaded on a background thread]
+        self._times = collections.OrderedDict()
+
+    def add(self, name, kind, seconds, background=False):
+        """Add seconds to the "import" or "init" time of name"""
+        with self._lock:
+            entry = self._times.setdefault(name, [0.0, 0.0, background])
+            entry[0 if kind == "import" else 1] += seconds
+
+    @contextlib.contextmanager
+    def measure(self, name, kind="init", background=False):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, kind, time.perf_counter() - started, background)
+
+    def mark_ready(self):
+        """Note the time of the first command prompt, later calls are ignored"""
+        if self.first_command is None:
+            self.first_command = time.perf_counter() - self.started
+
+    def report(self, budget=STARTUP_BUDGET):
+        """Print the breakdown, return False if the first prompt came later than budget"""
+        with self._lock:
+            times = list(self._times.items())
+        print("subsystem              import    init")
+        for name, (import_time, init_time, background) in times:
+            print("{:<20} {:8.3f} {:7.3f}{}".format(name, import_time, init_time,
+                                                    "  (background)" if background else ""))
+        if self.first_command is None:
+            return True
+        print("Time to first command: {:.3f}s (budget {:.3f}s)".format(self.first_command, budget))
+        if self.first_command > budget:
+            print("Startup is over budget")
+            return False
+        return True
+
+
+# Profile of this process
+PROFILE = StartupProfile()
+
+
+class Subsystem:
+    """A heavy part of the program, imported and created the first time it is used
+
+    get() imports the modules, calls create() and keeps what it returns;
+    concurrent callers wait for the first one. preload() does the same on a
+    background thread, so the cost is paid while the operator gives the
+    first commands. A module of imports that can't be imported is reported
+    and skipped, create() decides whether it can do without it (e.g. the
+    speech worker's own thread fails as it did before).
+
+    Arguments:
+    name -- shown in the startup profile
+    create -- create() returns the subsystem's object
+    imports -- modules imported (and timed) before create()
+    close -- close(obj) releases the object, called by close() if it was created
+    profile -- StartupProfile the times are added to
+    """
+
+    def __init__(self, name, create, imports=(), close=None, profile=PROFILE):
+        self.name = name
+        self.create = create
+        self.imports = imports
+        self.close_function = close
+        self.profile = profile
+        self._object = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def get(self):
+        if self._loaded:
+            return self._object
+        with self._lock:
+            if not self._loaded:
+                background = threading.current_thread() is self._thread
+                for module in self.imports:
+                    with self.profile.measure(self.name, "import", background):
+                        try:
+                            importlib.import_module(module)
+                        except ImportError as e:
+                            print("{}: can't import {} ({})".format(self.name, module, e))
+                with self.profile.measure(self.name, "init", background):
+                    self._object = self.create()
+                self._loaded = True
+        return self._object
+
+    def preload(self):
+        """Start loading on a background thread, return at once"""
+        if self._thread is None and not self._loaded:
+            self._thread = threading.Thread(target=self._preload, name="preload-" + self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """Wait for a preload() to finish"""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def close(self):
+        """Release the object if it was created, the next get() creates a new one"""
+        self.wait()
+        with self._lock:
+            if self._loaded and self.close_function is not None:
+                self.close_function(self._object)
+            self._object = None
+            self._loaded = False
+            self._thread = None
+
+    def _preload(self):
+        try:
+            self.get()
+        except Exception as e:
+            # get() raises it again when the subsystem is used
+            print("Preloading {} failed: {}".format(self.name, e))
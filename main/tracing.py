@@ -0,0 +1,171 @@
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+# Parts of the program spans can be turned on for
+SUBSYSTEMS = (
+    "command",       # voiceass commands run by the executor
+    "rpc",           # Kortex RPCs
+    "notification",  # waits for action notifications, and the notifications themselves
+    "camera",        # frame reads
+    "vision",        # color classification
+    "inference",     # YOLO inference
+    "speech",        # listening, speaking
+)
+# Events kept in memory, the oldest are dropped past this
+MAX_EVENTS = 1000000
+
+# Subsystems being traced, checked by every span() / traced() call
+_enabled = frozenset()
+_events = collections.deque(maxlen=MAX_EVENTS)
+_thread_names = {}
+_started = time.perf_counter()
+
+
+def enable(*subsystems):
+    """Trace the given subsystems (every one of SUBSYSTEMS when none is given)"""
+    global _enabled
+    subsystems = subsystems or SUBSYSTEMS
+    unknown = set(subsystems) - set(SUBSYSTEMS)
+    if unknown:
+        raise ValueError("Unknown subsystems {}, choose from {}".format(sorted(unknown), SUBSYSTEMS))
+    _enabled = _enabled | frozenset(subsystems)
+
+
+def disable(*subsystems):
+    """Stop tracing the given subsystems (all of them when none is given)"""
+    global _enabled
+    _enabled = _enabled - frozenset(subsystems) if subsystems else frozenset()
+
+
+def enabled(subsystem):
+    return subsystem in _enabled
+
+
+def _now():
+    # Microseconds since the module was loaded, the unit of Chrome traces
+    return (time.perf_counter() - _started) * 1e6
+
+
+def _thread_id():
+    thread = threading.current_thread()
+    if thread.ident not in _thread_names:
+        _thread_names[thread.ident] = thread.name
+    return thread.ident
+
+
+class _Span:
+    __slots__ = ("subsystem", "name", "args", "start")
+
+    def __init__(self, subsystem, name, args):
+        self.subsystem = subsystem
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = _now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event = {
+            "name": self.name, "cat": self.subsystem, "ph": "X", "ts": self.start, "dur": _now() - self.start,
+            "pid": os.getpid(), "tid": _thread_id(),
+        }
+        if self.args or exc_type is not None:
+            event["args"] = dict(self.args or (), **({"error": repr(exc_value)} if exc_type is not None else {}))
+        _events.append(event)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(subsystem, name, args=None):
+    """Context manager timing its block as a span of subsystem
+
+    Spans on the same thread nest like the blocks do. When subsystem isn't
+    traced this is a set lookup returning a shared no-op object.
+    """
+    if subsystem not in _enabled:
+        return _NULL_SPAN
+    return _Span(subsystem, name, args)
+
+
+def instant(subsystem, name, args=None):
+    """Record a point in time, e.g. a notification arriving"""
+    if subsystem not in _enabled:
+        return
+    event = {"name": name, "cat": subsystem, "ph": "i", "s": "t", "ts": _now(), "pid": os.getpid(),
+             "tid": _thread_id()}
+    if args:
+        event["args"] = args
+    _events.append(event)
+
+
+def traced(subsystem, name=None):
+    """Decorator making every call of the function a span of subsystem"""
+    def decorate(function):
+        label = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if subsystem not in _enabled:
+                return function(*args, **kwargs)
+            with _Span(subsystem, label, None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class TracedClient:
+    """Wraps a Kortex client (BaseClient, BaseCyclicClient...) so every RPC is an "rpc" span
+
+    Method wrappers are made on first use and kept, an untraced call costs
+    one extra function call.
+
+    Arguments:
+    client -- the client to wrap
+    prefix -- put before the method names in the trace, e.g. "Base."
+    """
+
+    def __init__(self, client, prefix=""):
+        self._client = client
+        self._prefix = prefix
+
+    def __getattr__(self, attribute):
+        value = getattr(self._client, attribute)
+        if callable(value) and not attribute.startswith("_"):
+            value = traced("rpc", self._prefix + attribute)(value)
+            # Found in the instance from now on, __getattr__ isn't called again
+            setattr(self, attribute, value)
+        return value
+
+
+def clear():
+    _events.clear()
+
+
+def events():
+    return list(_events)
+
+
+def export(path):
+    """Write the events as Chrome / Perfetto trace JSON (open in chrome://tracing or ui.perfetto.dev)"""
+    metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                for tid, name in list(_thread_names.items())]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": metadata + list(_events), "displayTimeUnit": "ms"}, f)
+    print("Trace of {} events written to {}".format(len(_events), path))
@@ -7,29 +7,46 @@ from kortex_api.SessionManager import SessionManager
 from kortex_api.autogen.messages import Session_pb2
 
 import numpy as np
-import cv2
 
-def parseConnectionArguments(parser = argparse.ArgumentParser()):
+def parseConnectionArguments(parser = argparse.ArgumentParser(), argv = None):
     parser.add_argument("--ip", type=str, help="IP address of destination", default="192.168.1.10")
     parser.add_argument("-u", "--username", type=str, help="username to login", default="admin")
     parser.add_argument("-p", "--password", type=str, help="password to login", default="admin")
-    return parser.parse_args()
-
-def get_limits(color):
+    return parser.parse_args(argv)
+
+# Hue bins used to name colors, in OpenCV HSV units (hue 0-180).
+# (name, lower, upper): lower <= hue < upper, a bin with lower > upper wraps
+# around 180 (red). Shared by get_limits and color.ColorClassifier.
+COLOR_HUE_BINS = [
+    ("Red", 165, 15),
+    ("Yellow", 15, 35),
+    ("Green", 35, 85),
+    ("Blue", 85, 125),
+    ("Purple", 125, 165),
+]
+# Pixels at or below these are too dull / dark to have a reliable hue, for the
+# get_limits masks and the classifier alike
+SATURATION_MIN = 50
+VALUE_MIN = 50
+
+def get_limits(color, saturation_min=SATURATION_MIN, value_min=VALUE_MIN, hue_bins=COLOR_HUE_BINS):
+    # Imported here so scripts that only connect don't load OpenCV
+    import cv2
     c = np.uint8([[color]])  # BGR values
     hsvC = cv2.cvtColor(c, cv2.COLOR_BGR2HSV)
 
-    hue = hsvC[0][0][0]  # Get the hue value
+    hue = int(hsvC[0][0][0])  # Get the hue value
 
-    # Handle red hue wrap-around
-    if hue >= 165:  # Upper limit for divided red hue
-        lowerLimit = np.array([hue - 10, 100, 100], dtype=np.uint8)
+    # Handle red hue wrap-around, using the same boundaries as the classifier
+    red_upper_start, red_lower_end = [(lower, upper) for name, lower, upper in hue_bins if name == "Red"][0]
+    if hue >= red_upper_start:  # Upper limit for divided red hue
+        lowerLimit = np.array([hue - 10, saturation_min, value_min], dtype=np.uint8)
         upperLimit = np.array([180, 255, 255], dtype=np.uint8)
-    elif hue <= 15:  # Lower limit for divided red hue
-        lowerLimit = np.array([0, 100, 100], dtype=np.uint8)
+    elif hue <= red_lower_end:  # Lower limit for divided red hue
+        lowerLimit = np.array([0, saturation_min, value_min], dtype=np.uint8)
         upperLimit = np.array([hue + 10, 255, 255], dtype=np.uint8)
     else:
-        lowerLimit = np.array([hue - 10, 100, 100], dtype=np.uint8)
+        lowerLimit = np.array([hue - 10, saturation_min, value_min], dtype=np.uint8)
         upperLimit = np.array([hue + 10, 255, 255], dtype=np.uint8)
 
     return lowerLimit, upperLimit
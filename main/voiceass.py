@@ -1,18 +1,34 @@
+import time
+_IMPORTS_STARTED = time.perf_counter()
+
+import argparse
+import asyncio
+import collections
+import contextlib
 import os
 import sys
 import threading
-import time
 
-import pyttsx3
-import speech_recognition as sr
 from kortex_api.autogen.client_stubs.BaseClientRpc import BaseClient
 from kortex_api.autogen.client_stubs.BaseCyclicClientRpc import BaseCyclicClient
 from kortex_api.autogen.messages import Base_pb2
 
+import tracing
 import utilities
-# import color
-import cv2
-import numpy as np
+from utilities import COLOR_HUE_BINS
+from actions import ActionNotifier, ActionRegistry
+from sequences import SequenceCompiler
+from commands import Command, CommandRegistry, apply_pose_delta, jog_waypoints, pose_delta
+from feedback import FeedbackMonitor
+from recorder import TelemetryRecorder
+from executor import CommandExecutor
+from realtime import RealTimeJogger, print_loop_metrics
+from startup import PROFILE, Subsystem
+from workspace import SLOT_TTL, SlotCache
+# Text-to-speech, speech recognition and vision (cv2) are imported when
+# first used or preloaded, see Subsystem
+
+PROFILE.add("voiceass", "import", time.perf_counter() - _IMPORTS_STARTED)
 
 # import imageCapture as ic
 # from gripper_close import close_gripper
@@ -20,460 +36,663 @@ import numpy as np
 
 # Maximum allowed waiting time during actions (in seconds)
 TIMEOUT_DURATION = 30
-
-"""
-        A Helper Function to monitor robot actions and signals an event when an action is finished (either successfully or aborted).
- This helps the program know when to proceed to the next step.
-"""
-def check_for_end_or_abort(e):
-    """Return a closure checking for END or ABORT notifications
-
-    Arguments:
-    e -- event to signal when the action is completed
-        (will be set when an END or ABORT occurs)
-    """
-    def check(notification, e = e):
-        print("EVENT : " + \
-              Base_pb2.ActionEvent.Name(notification.action_event))
-        if notification.action_event == Base_pb2.ACTION_END or notification.action_event == Base_pb2.ACTION_ABORT:
-            e.set()
-    return check
-
-def cartesian_action_movement(base, base_cyclic, action_name):
+# Oldest polled tool pose (seconds) a relative jog target may be computed from
+POSE_MAX_AGE = 0.1
+
+# Fixed announcements, rendered once into PHRASE_CACHE_DIR
+PHRASES = [
+    "Going Home",
+    "Going to rest position",
+    "Thank you Very much!",
+    "Please Check is you have that color or it's my camera's fault!",
+    "Please hold the image for 5 seconds",
+]
+PHRASE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "kinova_voiceass", "phrases")
+
+# Color codes the operator can ask for
+COLOR_NAMES = [name.lower() for name, _, _ in COLOR_HUE_BINS]
+
+def _create_speaker():
+    from speech import SpeechWorker
+    return SpeechWorker(cache_dir=PHRASE_CACHE_DIR, phrases=PHRASES).start()
+
+def _stop_speaker(worker):
+    # Let the last announcement finish
+    worker.wait_idle(TIMEOUT_DURATION)
+    worker.stop()
+
+# Session text-to-speech worker, started by the first speak_text() or preload()
+speaker = Subsystem("text-to-speech", _create_speaker, ("speech", "pyttsx3"), _stop_speaker)
+
+def current_tool_pose(actions, monitor):
+    # Pose polled in the background, no RefreshFeedback round-trip, unless
+    # the polling stalled: a jog from an old pose would end up elsewhere
+    sample = monitor.latest(max_age=POSE_MAX_AGE)
+    if sample is not None:
+        return sample.tool_pose
+    print("Feedback is stale, reading the tool pose from the arm")
+    pose = actions.base.GetMeasuredCartesianPose()
+    return [pose.x, pose.y, pose.z, pose.theta_x, pose.theta_y, pose.theta_z]
+
+def cartesian_action_movement(actions, monitor, action_name):
     print("Starting Cartesian action movement ...")
     action = Base_pb2.Action()
     action.name = "Example Cartesian action movement"
     action.application_data = ""
 
-    feedback = base_cyclic.RefreshFeedback()
-
-    if action_name == "pick":
-        feedback.base.tool_pose_y += 0.35 # (meters)
-    elif action_name == "drop":
-        feedback.base.tool_pose_z -= 0.15 # (meters)
-    elif action_name == "up":
-        feedback.base.tool_pose_z += 0.15 # (meters)
-    elif action_name == "rest":
-        feedback.base.tool_pose_z -= 0.045 # (meters)
-    elif action_name == "right":
-        feedback.base.tool_pose_theta_z += 10
-    elif action_name == "left":
-        feedback.base.tool_pose_theta_z -= 10
-    elif action_name == "front":
-        feedback.base.tool_pose_y += 0.1
-    elif action_name == "back":
-        feedback.base.tool_pose_y -= 0.1
-    elif action_name == "go_left":
-        feedback.base.tool_pose_y -= 0.05
-    elif action_name == "go_right":
-        feedback.base.tool_pose_y += 0.05
-    elif action_name == "go_up":
-        feedback.base.tool_pose_z += 0.05
-    elif action_name == "go_down":
-        feedback.base.tool_pose_z -= 0.0
-    elif action_name == "go_back":
-        feedback.base.tool_pose_x -= 0.05
-    elif action_name == "go_forward":
-        feedback.base.tool_pose_x += 0.05
-    elif action_name == "turn_left":
-        feedback.base.tool_pose_theta_z -= 90
-    elif action_name == "turn_right":
-        feedback.base.tool_pose_theta_z += 90
-    elif action_name == "turn_around":
-        feedback.base.tool_pose_theta_z -= 180
-
-
+    pose = current_tool_pose(actions, monitor)
 
+    # One vector add of the command's row of the delta table
+    x, y, z, theta_x, theta_y, theta_z = apply_pose_delta(pose, action_name)
 
     cartesian_pose = action.reach_pose.target_pose
-    cartesian_pose.x = feedback.base.tool_pose_x  # (meters)
-    cartesian_pose.y = feedback.base.tool_pose_y # (meters)
-    cartesian_pose.z = feedback.base.tool_pose_z   # (meters)
-    cartesian_pose.theta_x = feedback.base.tool_pose_theta_x  # (degrees)
-    cartesian_pose.theta_y = feedback.base.tool_pose_theta_y  # (degrees)
-    cartesian_pose.theta_z = feedback.base.tool_pose_theta_z  # (degrees)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
+    cartesian_pose.x = x  # (meters)
+    cartesian_pose.y = y # (meters)
+    cartesian_pose.z = z   # (meters)
+    cartesian_pose.theta_x = theta_x  # (degrees)
+    cartesian_pose.theta_y = theta_y  # (degrees)
+    cartesian_pose.theta_z = theta_z  # (degrees)
 
     print("Executing action")
-    base.ExecuteAction(action)
+    future = actions.notifier.execute_action(action)
 
     print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
+    result = future.result(TIMEOUT_DURATION)
 
-    if finished:
-        print("Cartesian movement completed")
-    else:
+    if result is None:
         print("Timeout on action notification wait")
-    return finished
-
-def move_to_a_position(base, position):
-    # Make sure the arm is in Single Level Servoing mode
-    base_servo_mode = Base_pb2.ServoingModeInformation()
-    base_servo_mode.servoing_mode = Base_pb2.SINGLE_LEVEL_SERVOING
-    base.SetServoingMode(base_servo_mode)
-
-    # Move arm to ready position
-    print("Moving the arm to a safe position")
-    action_type = Base_pb2.RequestedActionType()
-    action_type.action_type = Base_pb2.REACH_JOINT_ANGLES
-    action_list = base.ReadAllActions(action_type)
-    action_handle_1 = None
-    action_handle_2 = None
-    for action in action_list.action_list:
-        if action.name == position:
-            action_handle_1 = action.handle
-
-    if action_handle_1 == None:
-        print("Can't reach safe position. Exiting")
-        sys.exit(0)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    base.ExecuteActionFromReference(action_handle_1)
-
+        return False
+    if result.event != Base_pb2.ACTION_END:
+        print("Cartesian movement aborted")
+        return False
+    print("Cartesian movement completed")
+    return True
+
+def cartesian_trajectory_movement(actions, monitor, action_names):
+    # Jog steps as one blended waypoint trajectory, the arm doesn't stop between them
+    print("Starting Cartesian trajectory: {}".format(", ".join(action_names)))
+    poses, radii = jog_waypoints(current_tool_pose(actions, monitor), action_names)
+    if not len(poses):
+        return True
+    waypoints = Base_pb2.WaypointList()
+    waypoints.duration = 0.0
+    waypoints.use_optimal_blending = False
+    for index, (target, radius) in enumerate(zip(poses, radii)):
+        waypoint = waypoints.waypoints.add()
+        waypoint.name = "waypoint_{}".format(index)
+        cartesian_waypoint = waypoint.cartesian_waypoint
+        x, y, z, theta_x, theta_y, theta_z = target
+        cartesian_waypoint.pose.x = x  # (meters)
+        cartesian_waypoint.pose.y = y  # (meters)
+        cartesian_waypoint.pose.z = z  # (meters)
+        cartesian_waypoint.pose.theta_x = theta_x  # (degrees)
+        cartesian_waypoint.pose.theta_y = theta_y  # (degrees)
+        cartesian_waypoint.pose.theta_z = theta_z  # (degrees)
+        cartesian_waypoint.reference_frame = Base_pb2.CARTESIAN_REFERENCE_FRAME_BASE
+        cartesian_waypoint.blending_radius = radius  # (meters)
+
+    report = actions.base.ValidateWaypointList(waypoints)
+    if len(report.trajectory_error_report.trajectory_error_elements):
+        print("The arm rejected the trajectory, moving one step at a time")
+        # all() stops at the first step that didn't complete (e.g. stopped)
+        return all(cartesian_action_movement(actions, monitor, name) for name in action_names)
+
+    print("Executing trajectory")
+    future = actions.notifier.execute_waypoint_trajectory(waypoints, "jog " + " ".join(action_names))
+
+    print("Waiting for trajectory to finish ...")
+    result = future.result(TIMEOUT_DURATION * len(poses))
+
+    if result is None:
+        print("Timeout on trajectory notification wait")
+        return False
+    if result.event != Base_pb2.ACTION_END:
+        print("Cartesian trajectory aborted")
+        return False
+    print("Cartesian trajectory completed")
+    return True
+
+def execute_stored_action(actions, name, action_type):
+    # Make sure the arm is in Single Level Servoing mode (only sent when it changed)
+    actions.set_servoing_mode(Base_pb2.SINGLE_LEVEL_SERVOING)
+
+    # The handle comes from the session's action index, no ReadAllActions per move
+    future = actions.execute(name, action_type)
+    if future == None:
+        # Not taught on this arm, the command fails and the session carries on
+        print("Can't find the stored action {}".format(name))
+        return False
 
     # Leave time to action to complete
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
+    result = future.result(TIMEOUT_DURATION)
 
-    if not finished:
+    if result is None:
         print("Timeout on action notification wait")
-    return finished
-
-def open_gripper(base):
-    # Make sure the arm is in Single Level Servoing mode
-    base_servo_mode = Base_pb2.ServoingModeInformation()
-    base_servo_mode.servoing_mode = Base_pb2.SINGLE_LEVEL_SERVOING
-    base.SetServoingMode(base_servo_mode)
-
-    # Move arm to ready position
+        return False
+    if result.event != Base_pb2.ACTION_END:
+        # e.g. stopped by a priority command
+        print("Action {} aborted".format(name))
+        return False
+    return True
+
+def move_to_a_position(actions, position):
+    # Move arm to the taught position
     print("Moving the arm to a safe position")
-    action_type = Base_pb2.RequestedActionType()
-    action_type.action_type = Base_pb2.SEND_GRIPPER_COMMAND
-    action_list = base.ReadAllActions(action_type)
-    action_handle_1 = None
-    action_handle_2 = None
-    for action in action_list.action_list:
-        if action.name == "open_gripper":
-            action_handle_1 = action.handle
-        # print(action.name)
-        # print(action.handle)
-
-    if action_handle_1 == None:
-        print("Can't reach safe position. Exiting")
-        sys.exit(0)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    base.ExecuteActionFromReference(action_handle_1)
-
-    # Leave time to action to complete
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-    if not finished:
-        print("Timeout on action notification wait")
-    return finished
-
+    return execute_stored_action(actions, position, Base_pb2.REACH_JOINT_ANGLES)
 
-def gripper_close(base):
-    # Make sure the arm is in Single Level Servoing mode
-    base_servo_mode = Base_pb2.ServoingModeInformation()
-    base_servo_mode.servoing_mode = Base_pb2.SINGLE_LEVEL_SERVOING
-    base.SetServoingMode(base_servo_mode)
-
-    # Move arm to ready position
+def open_gripper(actions):
     print("Moving the arm to a safe position")
-    action_type = Base_pb2.RequestedActionType()
-    action_type.action_type = Base_pb2.SEND_GRIPPER_COMMAND
-    action_list = base.ReadAllActions(action_type)
-    action_handle_1 = None
-    action_handle_2 = None
-    for action in action_list.action_list:
-        if action.name == "water_gripper_hold":
-            action_handle_1 = action.handle
-        # print(action.name)
-        # print(action.handle)
-
-    if action_handle_1 == None:
-        print("Can't reach safe position. Exiting")
-        sys.exit(0)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    base.ExecuteActionFromReference(action_handle_1)
-
-    # Leave time to action to complete
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
+    return execute_stored_action(actions, "open_gripper", Base_pb2.SEND_GRIPPER_COMMAND)
 
-    if not finished:
-        print("Timeout on action notification wait")
-    return finished
 
-def gripper_close_new(base):
-    # Make sure the arm is in Single Level Servoing mode
-    base_servo_mode = Base_pb2.ServoingModeInformation()
-    base_servo_mode.servoing_mode = Base_pb2.SINGLE_LEVEL_SERVOING
-    base.SetServoingMode(base_servo_mode)
-
-    # Move arm to ready position
+def gripper_close(actions):
     print("Moving the arm to a safe position")
-    action_type = Base_pb2.RequestedActionType()
-    action_type.action_type = Base_pb2.SEND_GRIPPER_COMMAND
-    action_list = base.ReadAllActions(action_type)
-    action_handle_1 = None
-    action_handle_2 = None
-    for action in action_list.action_list:
-        if action.name == "newobject":
-            action_handle_1 = action.handle
-        # print(action.name)
-        # print(action.handle)
-
-    if action_handle_1 == None:
-        print("Can't reach safe position. Exiting")
-        sys.exit(0)
-
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    base.ExecuteActionFromReference(action_handle_1)
-
-    # Leave time to action to complete
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-
-    if not finished:
-        print("Timeout on action notification wait")
-    return finished
-
-def listen(timeout_duration=5):
-    # Create an instance of the Recognizer class
-    recognizer = sr.Recognizer()
+    return execute_stored_action(actions, "water_gripper_hold", Base_pb2.SEND_GRIPPER_COMMAND)
 
+def gripper_close_new(actions):
+    print("Moving the arm to a safe position")
+    return execute_stored_action(actions, "newobject", Base_pb2.SEND_GRIPPER_COMMAND)
+
+def pick_up_bottle_steps(slot):
+    top = "Bottle{}_Top".format(slot)
+    return [
+        (Base_pb2.REACH_JOINT_ANGLES, top),
+        (Base_pb2.REACH_JOINT_ANGLES, "Bottle{}_Hold_Pos".format(slot)),
+        (Base_pb2.SEND_GRIPPER_COMMAND, "water_gripper_hold"),
+        (Base_pb2.REACH_JOINT_ANGLES, top),
+        (Base_pb2.REACH_JOINT_ANGLES, "Home"),
+        (Base_pb2.REACH_JOINT_ANGLES, "Rest"),
+    ]
+
+def pick_up_bottle(sequences, slot):
+    # Make sure the arm is in Single Level Servoing mode (only sent when it changed)
+    sequences.actions.set_servoing_mode(Base_pb2.SINGLE_LEVEL_SERVOING)
+
+    # Uploaded on the first pick from this slot, replayed by handle afterwards
+    steps = pick_up_bottle_steps(slot)
+    future = sequences.play("pick_bottle_{}".format(slot), "Pick_Bottle{}".format(slot), steps)
+    if future == None:
+        print("Can't build the pick up sequence")
+        return False
+
+    print("Waiting for pick up sequence to finish ...")
+    result = future.result(TIMEOUT_DURATION * len(steps))
+
+    if result is None:
+        print("Timeout on sequence notification wait")
+        return False
+    return result.event == Base_pb2.SEQUENCE_COMPLETED
+
+def listen(listener, timeout_duration=5):
+    # The listening service keeps the microphone open and recognizes on its own thread
+    with tracing.span("speech", "listen"):
+        utterance = listener.get_command(timeout_duration)
+    if utterance is None:
+        print("Listening timed out while waiting for phrase to start.")
+        return None
+    return utterance.text
+
+def create_listener(args):
+    from speech import VOSK_MODEL_DIR, GoogleBackend, ListeningService, VoskBackend
+    # Offline Vosk recognition, no network round-trip per command, unless
+    # the online Google service is asked for
+    if args.online_speech:
+        backend = GoogleBackend()
+    else:
+        try:
+            # Only the known command phrases (and color names) can be recognized
+            backend = VoskBackend(args.vosk_model or VOSK_MODEL_DIR, COMMANDS.phrases() + COLOR_NAMES)
+        except RuntimeError as e:
+            raise RuntimeError("{}, give a model with --vosk-model or use --online-speech".format(e))
+    return ListeningService(backend).start()
+
+def read_command(session, prompt):
+    # Next operator command, spoken when voice input is on, typed otherwise
+    if session.listener is None:
+        return input(prompt)
+    print(prompt)
+    text = None
     try:
-        with sr.Microphone() as mic:
-            recognizer.adjust_for_ambient_noise(mic, duration=0.2)
-            print("Listening...")
-
-            # Set a timeout for listening
-            audio = recognizer.listen(mic, timeout=timeout_duration)
-
-            # Convert speech to text
-            text = recognizer.recognize_google(audio)
-            print("You said: " + text)
-            return text
+        while text is None:
+            text = listen(session.listener.get(), timeout_duration=None)
+    except RuntimeError as e:
+        # The microphone or the recognizer is gone, the operator can still type
+        print("{}, type the command instead".format(e))
+        return input(prompt)
+    return text.lower()
+
+def speak_text(text, priority=False, interrupt=False):
+    # Queued on the speech thread (one engine for the session), returns at once
+    # so the announcement plays while the arm moves
+    with tracing.span("speech", "speak_text", {"text": text}):
+        speaker.get().say(text, priority=priority, interrupt=interrupt)
+    return None
 
-    except sr.UnknownValueError:
-        print("Sorry, I did not understand that.")
-        return None
+# Session-wide robot services shared by the commands. cancelled is the
+# threading.Event set when the running command is preempted, the handlers
+# check it between their steps.
+RobotSession = collections.namedtuple("RobotSession", [
+    "base", "base_cyclic", "monitor", "actions", "sequences", "camera", "listener", "jogger", "recorder", "slots",
+    "cancelled", "args",
+])
+
+def stop_motion(session):
+    # The running sequence (pick up) and the running action
+    session.sequences.stop()
+    session.base.Stop()
+
+# Spoken / typed commands, handlers run on the executor's robot thread and
+# block until the command is done
+COMMANDS = CommandRegistry()
+# Cartesian jog commands -> their row of the jog delta table
+JOG_STEPS = {}
+# Commands command_loop asks a color code for before they run
+COLOR_COMMANDS = {"pick up"}
+
+def jog(session, action_names):
+    # One or more Cartesian jog steps
+    if session.args.realtime_jog:
+        # Streamed twist, no planning and no notification round-trip
+        for name in action_names:
+            if session.cancelled.is_set() or not session.jogger.jog_delta(pose_delta(name)):
+                return False
+        return True
+    if len(action_names) == 1:
+        return cartesian_action_movement(session.actions, session.monitor, action_names[0])
+    return cartesian_trajectory_movement(session.actions, session.monitor, action_names)
+
+def jog_command(name, action_name, synonyms=()):
+    JOG_STEPS[name] = action_name
+    COMMANDS.add(name, lambda session, color_code=None: jog(session, [action_name]), synonyms)
+
+def chain_error(commands):
+    """Why commands can't run as one chain, None if they can
+
+    A chain has no priority command (it would have to preempt the chain
+    itself) and no command taking a color code (there is one prompt per
+    command line), those have to be given on their own.
+    """
+    for command in commands:
+        if command.priority:
+            return "{} can't be chained, please say it on its own".format(command.name)
+        if command.name in COLOR_COMMANDS:
+            return "{} needs a color, please say it on its own".format(command.name)
+    return None
 
-    except sr.RequestError as e:
-        print(f"Could not request results from Google Speech Recognition service; {e}")
-        return None
+def chain_command(commands):
+    """Command running commands in order, every run of consecutive jogs as one trajectory
 
-    except sr.WaitTimeoutError:
-        print("Listening timed out while waiting for phrase to start.")
+    The commands must pass chain_error().
+    """
+    def run(session, color_code=None):
+        success = True
+        steps = []
+        for command in list(commands) + [None]:
+            if not success or session.cancelled.is_set():
+                return False
+            if command is not None and command.name in JOG_STEPS:
+                steps.append(JOG_STEPS[command.name])
+                continue
+            if steps:
+                success &= bool(jog(session, steps))
+                steps = []
+            if command is not None:
+                success &= bool(command.handler(session, color_code))
+        return success
+    return Command(" then ".join(command.name for command in commands), run, False)
+
+def lookup_command(text):
+    """Command for text, a chain_command() for a chained phrase, None if a step is unknown
+
+    Raises ValueError with chain_error() for a chain that isn't allowed.
+    """
+    matches = COMMANDS.lookup_chain(text)
+    if any(match.command is None for match in matches):
         return None
+    for match in matches:
+        if match.distance:
+            print("Understood '{}' as '{}'".format(match.text, match.command.name))
+    if len(matches) == 1:
+        return matches[0].command
+    commands = [match.command for match in matches]
+    error = chain_error(commands)
+    if error is not None:
+        raise ValueError(error)
+    return chain_command(commands)
+
+def jog_steps(command):
+    """Jog delta names of a jog command or a chain of jogs only, None for any other command"""
+    names = command.name.split(" then ")
+    if all(name in JOG_STEPS for name in names):
+        return [JOG_STEPS[name] for name in names]
+    return None
 
-def speak_text(text):
-    # Initialize the text-to-speech engine
-    engine = pyttsx3.init()
+class JogCoalescer:
+    """Collects the jog steps given within window seconds of each other into one trajectory
 
-    # Say the text
-    engine.say(text)
+    add() restarts the window, the steps are submitted to the executor
+    when it closes or when flush() is called (before any other command).
 
-    # Wait for the speech to complete
-    engine.runAndWait()
-    return None
+    Arguments:
+    executor -- CommandExecutor the trajectory is submitted to
+    session -- RobotSession passed to the handler
+    window -- seconds to wait for another jog, 0 submits at once
+    """
 
-# Define a function to get the dominant color in a given region of interest (ROI)
-def get_dominant_color(hsv_roi):
-    # Calculate the mean of each channel in the HSV space
-    mean_hue = np.mean(hsv_roi[:, :, 0])
-    mean_saturation = np.mean(hsv_roi[:, :, 1])
-    mean_value = np.mean(hsv_roi[:, :, 2])
-
-    # Determine the color based on the hue
-    if mean_saturation > 50 and mean_value > 50:
-        if 0 <= mean_hue < 15 or 165 < mean_hue <= 180:
-            color = "Red"
-        elif 15 <= mean_hue < 35:
-            color = "Yellow"
-        elif 35 <= mean_hue < 85:
-            color = "Green"
-        elif 85 <= mean_hue < 125:
-            color = "Blue"
-        elif 125 <= mean_hue < 165:
-            color = "Purple"
+    def __init__(self, executor, session, window):
+        self.executor = executor
+        self.session = session
+        self.window = window
+        self._steps = []
+        self._timer = None
+
+    async def add(self, action_names):
+        self._steps.extend(action_names)
+        self._cancel_timer()
+        if self.window > 0:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.window, lambda: asyncio.ensure_future(self.flush()))
         else:
-            color = "Unknown"
-    else:
-        color = "Gray or Black (Low Saturation/Value)"
-
-    return color
-def get_the_color(color_code):
-    # Access the internal camera with ID 1
-    # Use IP camera ("rtsp://192.168.1.10/color")
-    cap = cv2.VideoCapture("rtsp://192.168.1.10/color")
-    print("I'm in the Color Code")
-
-    if not cap.isOpened():
-        print("Error: Could not open camera.")
-        exit()
-
-    # Parameters for capturing multiple frames
-    num_frames = 10  # Number of frames to capture
-    colors_detected = []
-
-    for _ in range(num_frames):
-        # Capture a single frame
-        ret, frame = cap.read()
-        if not ret:
-            print("Failed to grab frame")
+            await self.flush()
+
+    async def flush(self):
+        self._cancel_timer()
+        steps, self._steps = self._steps, []
+        if steps:
+            if len(steps) > 1:
+                print("Coalesced {} jog steps into one trajectory".format(len(steps)))
+            await self.executor.submit("jog " + " ".join(steps), jog, self.session, steps)
+
+    def clear(self):
+        """Drop the steps not submitted yet"""
+        self._cancel_timer()
+        self._steps = []
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+def joint_jog_command(name, velocities, duration, synonyms=()):
+    def jog(session, color_code=None):
+        # Low-level servoing over the UDP router
+        metrics = session.jogger.jog_joints(velocities, duration)
+        print_loop_metrics("Joint jog", metrics)
+        return not session.cancelled.is_set()
+    COMMANDS.add(name, jog, synonyms)
+
+jog_command('go left', "go_left", ["move left"])
+jog_command('go right', "go_right", ["move right"])
+jog_command('go up', "go_up", ["move up"])
+jog_command('go down', "go_down", ["move down"])
+jog_command('turn left', "turn_left")
+jog_command('turn right', "turn_right")
+jog_command('go forward', "go_forward", ["go_forward", "move forward"])
+jog_command('go back', "go_back", ["move back", "go backward"])
+jog_command('turn around', "turn_around")
+joint_jog_command('rotate base left', [-10.0], 1.0)
+joint_jog_command('rotate base right', [10.0], 1.0)
+
+@COMMANDS.command('go home', ["home"])
+def go_home(session, color_code=None):
+    speak_text("Going Home")
+    return move_to_a_position(session.actions, "Home")
+
+@COMMANDS.command('take rest', ["rest", "go to rest"])
+def take_rest(session, color_code=None):
+    speak_text("Going to rest position")
+    return move_to_a_position(session.actions, "Rest")
+
+@COMMANDS.command('hold object', ["grab object"])
+def hold_object(session, color_code=None):
+    return gripper_close_new(session.actions)
+
+# Priority commands abort the running action and skip the queue
+@COMMANDS.command('stop', ["exit", "quit"], priority=True)
+def stop_and_rest(session, color_code=None):
+    speak_text("Thank you Very much!", interrupt=True)
+    success = move_to_a_position(session.actions, "Home")
+    success &= move_to_a_position(session.actions, "Rest")
+    return success
+
+@COMMANDS.command('cancel', ["halt"], priority=True)
+def cancel(session, color_code=None):
+    # The running action was already stopped by the executor
+    print("Cancelled")
+    return True
+
+@COMMANDS.command('pick up', ["pick up bottle", "pickup"])
+def pick_up(session, color_code=None):
+    # color_code is asked by command_loop, input() belongs to the operator thread
+    from scan import confirm_cached_slot, load_slot_rois, print_scan_timings, scan_for_color, scan_slots
+    # Every step gives up once the command is stopped or a motion didn't complete
+    if not open_gripper(session.actions) or session.cancelled.is_set():
+        return False
+    pos = ["Bottle1_Watch_Pos", "Bottle2_Watch_Pos", "Bottle3_Watch_Pos"]
+    if not move_to_a_position(session.actions, "Home") or session.cancelled.is_set():
+        return False
+    camera = session.camera.get()
+    pipelined = not session.args.sequential_scan
+    slot_rois = load_slot_rois(session.args.slot_rois) if session.args.slot_rois else load_slot_rois()
+    slot, timings = None, []
+    if session.slots is not None:
+        # A slot seen recently only needs one frame to confirm it
+        slot, timings = confirm_cached_slot(session.actions, session.monitor, camera, session.slots, color_code,
+                                            slot_rois, pipelined=pipelined, timeout=TIMEOUT_DURATION,
+                                            recorder=session.recorder, cancelled=session.cancelled)
+    if slot is None and session.args.overview_scan:
+        # Every slot from one frame, the watch positions only for unsure slots
+        slot, scanned = scan_slots(session.actions, session.monitor, camera, color_code, pos, slot_rois,
+                                   pipelined=pipelined, timeout=TIMEOUT_DURATION, recorder=session.recorder,
+                                   cache=session.slots, cancelled=session.cancelled)
+        timings += scanned
+    elif slot is None:
+        # Sample as soon as the arm is settled, move on as soon as the verdict is in
+        slot, scanned = scan_for_color(session.actions, session.monitor, camera, color_code, pos,
+                                       pipelined=pipelined, timeout=TIMEOUT_DURATION, recorder=session.recorder,
+                                       cache=session.slots, cancelled=session.cancelled)
+        timings += scanned
+    print_scan_timings(timings)
+    if session.cancelled.is_set():
+        return False
+    if slot is None:
+        speak_text("Please Check is you have that color or it's my camera's fault!")
+        return False
+    # Top -> Hold -> close -> Top -> Home -> Rest as one device-side sequence
+    picked = pick_up_bottle(session.sequences, slot)
+    if picked and session.slots is not None:
+        # The bottle is gone, the slot has to be seen again
+        session.slots.invalidate(slot)
+    # open_gripper(session.actions)
+    return picked
+
+@COMMANDS.command('open gripper', ["drop", "release"])
+def open_gripper_command(session, color_code=None):
+    return open_gripper(session.actions)
+
+@COMMANDS.command('capture image', ["take picture"])
+def capture_image(session, color_code=None):
+    speak_text("Please hold the image for 5 seconds")
+    # ic.capture_image(0)
+    return True
+
+async def command_loop(session):
+    loop = asyncio.get_running_loop()
+    executor = CommandExecutor(session.base, cancelled=session.cancelled, stop=lambda: stop_motion(session))
+    worker = asyncio.create_task(executor.run())
+    # Jogs given in a row are sent as one trajectory
+    jogs = JogCoalescer(executor, session, session.args.coalesce_window)
+    PROFILE.mark_ready()
+    # speak_text("What do you want me to do?")
+    while True:
+        # Operator input runs on its own thread so commands can be given while the arm moves
+        command1 = await loop.run_in_executor(None, read_command, session, "What do you want me to do now?: ")
+        # "go left then up then forward" is one command per step
+        try:
+            command = lookup_command(command1)
+        except ValueError as e:
+            # A chain with a step that must be given on its own
+            print(e)
+            speak_text(str(e))
             continue
-
-        # Define the region of interest (ROI) in the center of the frame
-        height, width, _ = frame.shape
-        cx, cy = width // 2, height // 2
-        roi_size = 50  # Size of the central area
-        roi = frame[cy - roi_size:cy + roi_size, cx - roi_size:cx + roi_size]
-
-        # Convert the ROI to HSV color space
-        hsv_roi = cv2.cvtColor(roi, cv2.COLOR_BGR2HSV)
-
-        # Get the dominant color in the ROI and add it to the list
-        dominant_color = get_dominant_color(hsv_roi)
-        colors_detected.append(dominant_color)
-
-    # Release the camera after capturing the frames
-    cap.release()
-
-    # Calculate the most frequently detected color
-    if colors_detected:
-        most_common_color = max(set(colors_detected), key=colors_detected.count)
-        print("Detected color (most common across frames):", most_common_color)
-        if most_common_color == color_code:
-            return True
+        if command is None:
+            # Unknown commands are reported, never mapped to some default action
+            print("Sorry, I don't know the command '{}'".format(command1))
+            continue
+        if session.recorder is not None:
+            session.recorder.record_command(command.name)
+        steps = jog_steps(command)
+        if steps is not None:
+            await jogs.add(steps)
+            continue
+        if command.priority:
+            # Jogs given before "stop" or "cancel" are dropped, not started
+            jogs.clear()
         else:
-            return False
-    else:
-        print("No color detected.")
+            await jogs.flush()
+        color_code = None
+        if command.name in COLOR_COMMANDS:
+            color_code = await loop.run_in_executor(None, read_command, session,
+                                                    "Which color code would you like to pickup?: ")
+            color_code = color_code.capitalize()
+        await executor.submit(command.name, command.handler, session, color_code, priority=command.priority)
+        if command.name == 'stop':
+            break
+    await executor.close()
+    await worker
+    return executor.success
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sequential-scan", action="store_true",
+                        help="wait for every watch position's notification before checking the color")
+    parser.add_argument("--overview-scan", action="store_true",
+                        help="classify every bottle slot from one frame at the overview position, "
+                             "visit the watch positions only for slots it is unsure of")
+    parser.add_argument("--slot-rois", type=str, default=None, metavar="FILE",
+                        help="slot ROIs of the overview scan (default: scan.SLOT_ROIS_PATH or scan.SLOT_ROIS)")
+    parser.add_argument("--slot-ttl", type=float, default=SLOT_TTL,
+                        help="seconds a scanned slot color is trusted for the next picks, 0 to always scan")
+    parser.add_argument("--coalesce-window", type=float, default=0.0, metavar="SECONDS",
+                        help="jogs given within this many seconds of each other run as one blended trajectory "
+                             "(chained phrases like 'go left then up' always do)")
+    parser.add_argument("--realtime-jog", action="store_true",
+                        help="stream velocity commands for jogs instead of planning reach_pose actions")
+    parser.add_argument("--voice", action="store_true", help="take commands from the microphone")
+    parser.add_argument("--vosk-model", type=str, default=None,
+                        help="Vosk model directory for offline speech recognition (default: speech.VOSK_MODEL_DIR)")
+    parser.add_argument("--online-speech", action="store_true",
+                        help="recognize speech with the online Google service instead of a local Vosk model")
+    parser.add_argument("--record", type=str, default=None, metavar="DIR",
+                        help="record feedback, notifications, commands and color verdicts to DIR")
+    parser.add_argument("--no-preload", action="store_true",
+                        help="load text-to-speech, speech recognition and vision on first use only")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print the import and initialization time of every subsystem and exit")
+    parser.add_argument("--trace", type=str, default=None, metavar="FILE",
+                        help="write timing spans of the session to FILE as Chrome trace JSON "
+                             "(open in chrome://tracing or ui.perfetto.dev)")
+    parser.add_argument("--trace-subsystems", type=str, default=",".join(tracing.SUBSYSTEMS), metavar="NAMES",
+                        help="comma separated subsystems traced with --trace, from: " + ", ".join(tracing.SUBSYSTEMS))
+    return parser
+
+def open_session(base, base_cyclic, base_cyclic_rt, args, camera=None, cancelled=None):
+    """Start the session-wide services on the given clients, return the RobotSession
+
+    cancelled is the session's threading.Event for preempted commands, a
+    new one if None.
+    """
+    if args.trace:
+        # Without --trace the clients aren't wrapped at all
+        tracing.enable(*[name.strip() for name in args.trace_subsystems.split(",") if name.strip()])
+        base = tracing.TracedClient(base, "Base.")
+        base_cyclic = tracing.TracedClient(base_cyclic, "BaseCyclic.")
+        base_cyclic_rt = tracing.TracedClient(base_cyclic_rt, "BaseCyclic.")
+    # Tool pose, joints and gripper polled in the background for the whole session
+    monitor = FeedbackMonitor(base_cyclic).start()
+    # Everything that happens in the shift, written to disk off the control path
+    recorder = None
+    if args.record:
+        recorder = TelemetryRecorder(args.record, monitor.actuator_count).start()
+        monitor.recorder = recorder
+    # One action notification subscription for the whole session,
+    # stored actions are read once per session instead of once per move
+    notifier = ActionNotifier(base, recorder)
+    actions = ActionRegistry(base, notifier)
+    sequences = SequenceCompiler(base, actions, recorder)
+    # The camera stream is opened once, on first use, and read in the background
+    camera = vision_subsystem(camera)
+    # The microphone stays open and is calibrated once for the whole session
+    listener = None
+    if args.voice:
+        listener = Subsystem("speech recognition", lambda: create_listener(args),
+                             ("speech", "speech_recognition" if args.online_speech else "vosk"),
+                             lambda service: service.stop())
+    cancelled = cancelled if cancelled is not None else threading.Event()
+    # Real-time jogging streams over the UDP router
+    jogger = RealTimeJogger(base, base_cyclic_rt, actions, recorder, cancelled)
+    # Slot colors of earlier scans, confirmed with one frame on the next picks
+    slots = SlotCache(args.slot_ttl) if args.slot_ttl > 0 else None
+    return RobotSession(base, base_cyclic, monitor, actions, sequences, camera, listener, jogger, recorder, slots,
+                        cancelled, args)
+
+def vision_subsystem(camera=None):
+    """Subsystem of the camera, a CameraService unless camera is given"""
+    def create():
+        from camera import CameraService
+        return (camera or CameraService()).start()
+    return Subsystem("vision", create, ("cv2", "camera", "scan"), lambda service: service.stop())
+
+def preload(session):
+    """Load the subsystems the session may use on background threads"""
+    speaker.preload()
+    session.camera.preload()
+    if session.listener is not None:
+        session.listener.preload()
+
+def close_session(session):
+    if session.listener is not None:
+        session.listener.close()
+    # A session opened after this one starts its own speech worker
+    speaker.close()
+    session.camera.close()
+    session.monitor.stop()
+    session.sequences.close()
+    session.actions.notifier.close()
+    if session.recorder is not None:
+        session.recorder.stop()
+    if session.args.trace:
+        tracing.export(session.args.trace)
 
 def main():
     # Import the utilities helper module
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
     # Parse arguments
-    args = utilities.parseConnectionArguments()
-    success = True
+    args = utilities.parseConnectionArguments(create_parser())
     # Create connection to the device and get the router
-    with utilities.DeviceConnection.createTcpConnection(args) as router,utilities.DeviceConnection.createUdpConnection(
-            args) as router_real_time:
+    with contextlib.ExitStack() as connections:
+        with PROFILE.measure("connection"):
+            router = connections.enter_context(utilities.DeviceConnection.createTcpConnection(args))
+            router_real_time = connections.enter_context(utilities.DeviceConnection.createUdpConnection(args))
         # Create required services
         base = BaseClient(router)
         base_cyclic = BaseCyclicClient(router)
-        # speak_text("What do you want me to do?")
-        while True:
-            # str1 = listen()
-            command1 = input("What do you want me to do now?: ")
-            if command1 == 'go left':
-                success &= cartesian_action_movement(base, base_cyclic, "go_left")
-            elif command1 == 'go right':
-                success &= cartesian_action_movement(base, base_cyclic, "go_right")
-            elif command1 == 'go up':
-                success &= cartesian_action_movement(base, base_cyclic, "go_up")
-            elif command1 == 'go down':
-                success &= cartesian_action_movement(base, base_cyclic, "go_down")
-            elif command1 == 'turn left':
-                success &= cartesian_action_movement(base, base_cyclic, "turn_left")
-            elif command1 == 'turn right':
-                success &= cartesian_action_movement(base, base_cyclic, "turn_right")
-            elif command1 == 'go_forward':
-                success &= cartesian_action_movement(base, base_cyclic, "go_forward")
-            elif command1 == 'go back':
-                success &= cartesian_action_movement(base, base_cyclic, "go_back")
-            elif command1 == 'go home':
-                speak_text("Going Home")
-                success &= move_to_a_position(base, "Home")
-            elif command1 == 'take rest':
-                speak_text("Going to rest position")
-                success &= move_to_a_position(base, "Rest")
-            elif command1 == 'turn around':
-                success &= cartesian_action_movement(base, base_cyclic, "turn_around")
-            elif command1 == 'hold object':
-                success &= gripper_close_new(base)
-            elif command1 == 'stop':
-                speak_text("Thank you Very much!")
-                success &= move_to_a_position(base, "Home")
-                success &= move_to_a_position(base, "Rest")
-                break
-            elif command1 == 'pick up':
-                success &= open_gripper(base)
-                pos = ["Bottle1_Watch_Pos", "Bottle2_Watch_Pos", "Bottle3_Watch_Pos"]
-                success = True
-                color_code = input("Which color code would you like to pickup?: ")
-                success &= move_to_a_position(base, "Home")
-                for i in range(3):
-                    success &= move_to_a_position(base, pos[i])
-                    # time.sleep(1)
-                    if get_the_color(color_code):
-                        if i == 0:
-                            success &= move_to_a_position(base, "Bottle1_Top")
-                            success &= move_to_a_position(base, "Bottle1_Hold_Pos")
-                            success &= gripper_close(base)
-                            success &= move_to_a_position(base, "Bottle1_Top")
-                            success &= move_to_a_position(base, "Home")
-                            success &= move_to_a_position(base, "Rest")
-                            # success &= open_gripper(base)
-                            break
-                        elif i == 1:
-                            # success &= move_to_a_position(base, "Home")
-                            success &= move_to_a_position(base, "Bottle2_Top")
-                            success &= move_to_a_position(base, "Bottle2_Hold_Pos")
-                            success &= gripper_close(base)
-                            success &= move_to_a_position(base, "Bottle2_Top")
-                            success &= move_to_a_position(base, "Home")
-                            success &= move_to_a_position(base, "Rest")
-                            # success &= open_gripper(base)
-                            break
-                        elif i == 2:
-                            # success &= move_to_a_position(base, "Home")
-                            success &= move_to_a_position(base, "Bottle3_Top")
-                            success &= move_to_a_position(base, "Bottle3_Hold_Pos")
-                            success &= gripper_close(base)
-                            success &= move_to_a_position(base, "Bottle3_Top")
-                            success &= move_to_a_position(base, "Home")
-                            success &= move_to_a_position(base, "Rest")
-                            # success &= open_gripper(base)
-                            break
-                else:
-                    speak_text("Please Check is you have that color or it's my camera's fault!")
-            elif command1 == 'open gripper' or 'drop':
-                success &= open_gripper(base)
-            elif command1 == 'capture image':
-                speak_text("Please hold the image for 5 seconds")
-                # ic.capture_image(0)
+        with PROFILE.measure("session"):
+            session = open_session(base, base_cyclic, BaseCyclicClient(router_real_time), args)
+        # Closed before the connections, also when the command loop raises
+        connections.callback(close_session, session)
+        if args.profile_startup:
+            # The command loop would be ready now, load everything else to time it
+            PROFILE.mark_ready()
+            preload(session)
+            for subsystem in (speaker, session.camera, session.listener):
+                if subsystem is not None:
+                    subsystem.wait()
+            within_budget = PROFILE.report()
+            return 0 if within_budget else 1
+        if not args.no_preload:
+            preload(session)
+        success = asyncio.run(command_loop(session))
     return 0 if success else 1
 
 
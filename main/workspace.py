@@ -0,0 +1,105 @@
+import collections
+import threading
+import time
+
+import numpy as np
+
+# Seconds a slot's color is trusted without the slot being seen again
+SLOT_TTL = 120.0
+# Mean HSV difference (0-255 per channel, hue on its 0-180 circle) between
+# a slot's ROI and the one its color was read from that counts as a change
+SLOT_CHANGE_THRESHOLD = 12.0
+
+# Last known state of a bottle slot: color and confidence of the verdict,
+# when it was made (time.monotonic()), the stored position the camera saw
+# the slot from and the HSV ROI the verdict was read from
+SlotState = collections.namedtuple("SlotState", [
+    "slot", "color", "confidence", "timestamp", "position", "reference",
+])
+
+
+def roi_difference(hsv_roi, reference):
+    """Mean absolute difference of two HSV ROIs of the same shape"""
+    a = np.asarray(hsv_roi, dtype=np.int16)
+    b = np.asarray(reference, dtype=np.int16)
+    hue = np.abs(a[..., 0] - b[..., 0])
+    hue = np.minimum(hue, 180 - hue)
+    return float((hue.mean() + np.abs(a[..., 1:] - b[..., 1:]).mean(axis=(0, 1)).sum()) / 3.0)
+
+
+class SlotCache:
+    """Colors of the bottle slots, so a pick can skip rescanning an unchanged cell
+
+    Scans update() the slots they read. A slot is forgotten when its entry
+    is older than ttl, when a pick from it completed (invalidate()), or
+    when check() finds its ROI differs from the reference by more than
+    change_threshold, e.g. a bottle was swapped. Safe to use from the
+    robot thread and the daemon's clients at once.
+
+    Arguments:
+    ttl -- seconds an entry stays valid
+    change_threshold -- roi_difference() above which a slot counts as changed
+    """
+
+    def __init__(self, ttl=SLOT_TTL, change_threshold=SLOT_CHANGE_THRESHOLD):
+        self.ttl = ttl
+        self.change_threshold = change_threshold
+        self._lock = threading.Lock()
+        self._slots = {}
+
+    def __len__(self):
+        return len(self.slots())
+
+    def update(self, slot, color, confidence, position, reference, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._slots[slot] = SlotState(slot, color, float(confidence), now, position, np.array(reference))
+
+    def get(self, slot, now=None):
+        """The slot's SlotState, None if unknown or expired"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            state = self._slots.get(slot)
+            if state is not None and now - state.timestamp > self.ttl:
+                del self._slots[slot]
+                return None
+            return state
+
+    def slots(self, now=None):
+        """Every valid SlotState, by slot number"""
+        with self._lock:
+            slots = list(self._slots)
+        states = [self.get(slot, now) for slot in sorted(slots)]
+        return [state for state in states if state is not None]
+
+    def find(self, color, min_confidence=0.0, now=None):
+        """Most recently seen valid slot of color, None if there is none"""
+        states = [state for state in self.slots(now) if state.color == color and state.confidence >= min_confidence]
+        return max(states, key=lambda state: state.timestamp) if states else None
+
+    def check(self, slot, position, hsv_roi):
+        """Forget the slot if hsv_roi, seen from position, differs from its reference
+
+        Returns True if the slot is still valid. A ROI seen from another
+        position than the reference, of another shape or empty (the slot is
+        outside of the frame) can't be compared and leaves the entry alone.
+        """
+        state = self.get(slot)
+        if state is None:
+            return False
+        if state.position != position or np.shape(hsv_roi) != state.reference.shape or np.size(hsv_roi) == 0:
+            return True
+        difference = roi_difference(hsv_roi, state.reference)
+        if difference > self.change_threshold:
+            print("Slot {} changed since it was scanned ({:.1f}), forgetting its color".format(slot, difference))
+            self.invalidate(slot)
+            return False
+        return True
+
+    def invalidate(self, slot=None):
+        """Forget one slot, or every slot when slot is None"""
+        with self._lock:
+            if slot is None:
+                self._slots.clear()
+            else:
+                self._slots.pop(slot, None)